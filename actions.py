@@ -1,7 +1,26 @@
-from typing import Iterator, List, Mapping, Union
+import logging
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, List, Mapping, Optional, Union
 from waifuc.action import ProcessAction
 from waifuc.model import ImageItem
-from waifuc.action import TaggingAction, BaseAction
+from waifuc.action import TaggingAction, BaseAction, TagRemoveUnderlineAction
+
+from dedup import DedupIndex, phash
+from score_matrix import ScoreMatrixWriter
+from tag_cache import TagCache, hash_image, tagger_fingerprint
+from tagger import (
+    STUB_METHOD,
+    get_stub_tags,
+    get_tagger_labels,
+    get_wd14_tags_batch,
+    is_wd14_method,
+    predict_scores_batch,
+    scores_to_tags,
+)
+
+DEFAULT_TAGGING_METHOD = "wd14_convnextv2"
 
 
 class TagAddAction(ProcessAction):
@@ -17,12 +36,41 @@ class TagAddAction(ProcessAction):
         return ImageItem(item.image, {**item.meta, "tags": tags})
 
 
+class CountAction(ProcessAction):
+    def __init__(self):
+        self.count = 0
+
+    def process(self, item: ImageItem) -> ImageItem:
+        self.count += 1
+        return item
+
+    def reset(self):
+        self.count = 0
+
+
+class ShardFilenameAction(ProcessAction):
+    def __init__(self, shard_index: int):
+        self.shard_index = shard_index
+        self.untitles = 0
+
+    def process(self, item: ImageItem) -> ImageItem:
+        if "filename" in item.meta:
+            return item
+        self.untitles += 1
+        filename = f"untitled_{self.shard_index}_{self.untitles}.png"
+        return ImageItem(item.image, {**item.meta, "filename": filename})
+
+    def reset(self):
+        self.untitles = 0
+
+
 class TagFilterAnyOfAction(BaseAction):
     def __init__(
         self,
         tags: Union[List[str], Mapping[str, float]],
-        method: str = "wd14_convnextv2",
+        method: Optional[str] = None,
         reversed: bool = False,
+        cache: Optional[TagCache] = None,
         **kwargs,
     ):
         if isinstance(tags, (list, tuple)):
@@ -31,12 +79,30 @@ class TagFilterAnyOfAction(BaseAction):
             self.tags = dict(tags)
         else:
             raise TypeError(f"Unknown type of tags - {tags!r}.")
-        self.tagger = TaggingAction(method, force=False, **kwargs)
+        # When method is None, any tags already on the item are used regardless of the model that produced them
+        self.method = method
+        self.cache = cache
+        self.tagger_kwargs = kwargs
         self.reversed = reversed
+        self.remove_underline = TagRemoveUnderlineAction()
+
+    def get_scores(self, item: ImageItem) -> Mapping[str, float]:
+        tags = item.meta.get("tags")
+        if tags is not None and (
+            self.method is None or item.meta.get("tagger") == self.method
+        ):
+            return tags
+
+        # Only score the item with the required model, its tags are left untouched
+        tagger = get_shared_tagging_action(
+            self.method or DEFAULT_TAGGING_METHOD, self.cache, **self.tagger_kwargs
+        )
+        # Raw tagger output has underscores, the filter tags have spaces like the tags of the pipeline
+        tagged = self.remove_underline.process(tagger.process(ImageItem(item.image, {})))
+        return tagged.meta["tags"]
 
     def iter(self, item: ImageItem) -> Iterator[ImageItem]:
-        item = self.tagger(item)
-        tags = item.meta["tags"]
+        tags = self.get_scores(item)
 
         valid = self.reversed
         for tag, min_score in self.tags.items():
@@ -50,5 +116,290 @@ class TagFilterAnyOfAction(BaseAction):
         if valid:
             yield item
 
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        yield from BaseAction.iter_from(self, iter_)
+        commit_shared_tagging_actions()
+
+    def reset(self):
+        pass
+
+
+class CachedTaggingAction(TaggingAction):
+    def __init__(
+        self,
+        method: str = DEFAULT_TAGGING_METHOD,
+        force: bool = False,
+        cache: Optional[TagCache] = None,
+        **kwargs,
+    ):
+        if method == STUB_METHOD:
+            # Not one of waifuc's tagging methods
+            self.method = get_stub_tags
+            self.force = force
+            self.kwargs = kwargs
+        else:
+            TaggingAction.__init__(self, method, force, **kwargs)
+        self.method_name = method
+        self.cache = cache
+        self.fingerprint = tagger_fingerprint(method, kwargs)
+
+    def lookup(
+        self, item: ImageItem
+    ) -> tuple[Optional[str], Optional[dict[str, float]]]:
+        if self.cache is None:
+            return None, None
+        image_hash = hash_image(item.image)
+        return image_hash, self.cache.get(image_hash, self.fingerprint)
+
+    def store(self, image_hash: Optional[str], tags: Mapping[str, float]):
+        if self.cache is None or image_hash is None:
+            return
+        self.cache.put(image_hash, self.fingerprint, tags)
+
+    def commit(self):
+        # Other worker processes wait on the cache while a write transaction is open
+        if self.cache is not None:
+            self.cache.commit()
+
+    def tagged(self, item: ImageItem, tags: Mapping[str, float]) -> ImageItem:
+        # Record which model produced the tags so that tag filters can reuse them
+        return ImageItem(
+            item.image, {**item.meta, "tags": tags, "tagger": self.method_name}
+        )
+
+    def process(self, item: ImageItem) -> ImageItem:
+        if "tags" in item.meta and not self.force:
+            return item
+
+        image_hash, tags = self.lookup(item)
+        if tags is None:
+            tags = self.method(image=item.image, **self.kwargs)
+            self.store(image_hash, tags)
+        self.commit()
+        return self.tagged(item, tags)
+
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        yield from TaggingAction.iter_from(self, iter_)
+        if self.cache is not None:
+            self.cache.commit()
+            self.cache.log_stats()
+
+
+class BatchedTaggingAction(CachedTaggingAction):
+    """
+    Buffers up to batch_size items and tags them with a single model call,
+    yielding items in their original order. A partial batch is flushed once
+    its oldest item has waited for flush_timeout seconds. With a score_matrix,
+    the raw scores of every label are recorded as well, images missing from
+    the matrix are tagged again even when their tags are cached.
+    """
+
+    def __init__(
+        self,
+        method: str = DEFAULT_TAGGING_METHOD,
+        force: bool = False,
+        cache: Optional[TagCache] = None,
+        batch_size: int = 16,
+        flush_timeout: Optional[float] = None,
+        score_matrix: Optional[ScoreMatrixWriter] = None,
+        **kwargs,
+    ):
+        CachedTaggingAction.__init__(self, method, force, cache, **kwargs)
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+        self.score_matrix = score_matrix
+        if score_matrix is not None:
+            score_matrix.set_labels(method, *get_tagger_labels(method))
+
+    def tag_batch(self, items: List[ImageItem]) -> List[ImageItem]:
+        results: List[ImageItem] = list(items)
+        to_tag: List[tuple[int, Optional[str]]] = []
+        for index, item in enumerate(items):
+            if "tags" in item.meta and not self.force:
+                continue
+            image_hash, tags = self.lookup(item)
+            if self.score_matrix is not None:
+                image_hash = image_hash or hash_image(item.image)
+                if image_hash not in self.score_matrix.known:
+                    tags = None
+            if tags is None:
+                to_tag.append((index, image_hash))
+            else:
+                results[index] = self.tagged(item, tags)
+
+        if not to_tag:
+            self.commit()
+            return results
+
+        images = [items[index].image for index, _ in to_tag]
+        if self.score_matrix is not None:
+            scores = predict_scores_batch(images, self.method_name)
+            self.score_matrix.append(
+                [image_hash for _, image_hash in to_tag],
+                [
+                    items[index].meta.get("path") or items[index].meta.get("filename")
+                    for index, _ in to_tag
+                ],
+                scores,
+            )
+            tags_list = [
+                scores_to_tags(row, self.method_name, **self.kwargs) for row in scores
+            ]
+        elif is_wd14_method(self.method_name):
+            tags_list = get_wd14_tags_batch(images, self.method_name, **self.kwargs)
+        else:
+            # No batched implementation for this tagger, fall back to per-item inference
+            tags_list = [self.method(image=image, **self.kwargs) for image in images]
+
+        for (index, image_hash), tags in zip(to_tag, tags_list):
+            self.store(image_hash, tags)
+            results[index] = self.tagged(items[index], tags)
+        self.commit()
+        return results
+
+    def iter_batches(self, iter_: Iterable[ImageItem]) -> Iterator[List[ImageItem]]:
+        if self.flush_timeout is None:
+            batch = []
+            for item in iter_:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
+
+        # Read upstream items from a thread so a slow source cannot hold back a partial batch
+        items: queue.Queue = queue.Queue(maxsize=self.batch_size * 2)
+        done = object()
+
+        def produce():
+            try:
+                for item in iter_:
+                    items.put(item)
+                items.put(done)
+            except BaseException as e:
+                items.put(e)
+
+        threading.Thread(target=produce, daemon=True).start()
+
+        batch = []
+        deadline = None
+        while True:
+            try:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0)
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                yield batch
+                batch, deadline = [], None
+                continue
+
+            if item is done or isinstance(item, BaseException):
+                if batch:
+                    yield batch
+                if item is not done:
+                    raise item
+                return
+
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_timeout
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch, deadline = [], None
+
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        for batch in self.iter_batches(iter_):
+            yield from self.tag_batch(batch)
+        if self.score_matrix is not None:
+            self.score_matrix.close()
+        if self.cache is not None:
+            self.cache.commit()
+            self.cache.log_stats()
+
+
+class DedupAction(BaseAction):
+    """
+    Drops near-duplicates of any image seen so far using a perceptual hash index.
+    With scope "run" the index only covers the current run, with scope "global"
+    it is loaded from index_path and covers previous runs as well. Kept items
+    carry their hash in meta["phash"], a DedupExporter persists it once the
+    item is exported. With several worker processes, the "run" index only
+    covers the shard of each worker.
+    """
+
+    def __init__(
+        self,
+        scope: str = "run",
+        index_path: Optional[str] = None,
+        max_distance: int = 4,
+    ):
+        if scope not in ("run", "global"):
+            raise ValueError(f"Unknown dedup scope - {scope!r}.")
+        if scope == "global" and not index_path:
+            raise ValueError("An index path is required for the global dedup scope.")
+        self.scope = scope
+        self.index_path = index_path
+        self.max_distance = max_distance
+        self.index = self._create_index()
+        self.dropped = 0
+
+    def _create_index(self) -> DedupIndex:
+        return DedupIndex(
+            self.index_path if self.scope == "global" else None, self.max_distance
+        )
+
+    def iter(self, item: ImageItem) -> Iterator[ImageItem]:
+        value = phash(item.image)
+        if self.index.find(value) is not None:
+            self.dropped += 1
+            return
+        self.index.add(value)
+        if self.scope == "global":
+            item = ImageItem(item.image, {**item.meta, "phash": value})
+        yield item
+
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        yield from BaseAction.iter_from(self, iter_)
+        logging.info(
+            f"Dedup: dropped {self.dropped} near-duplicates, "
+            f"{len(self.index.index)} images indexed"
+        )
+
     def reset(self):
-        self.tagger.reset()
+        if self.scope == "run":
+            self.index = self._create_index()
+        self.dropped = 0
+
+
+_shared_tagging_actions: dict[str, CachedTaggingAction] = {}
+_shared_tagging_actions_lock = threading.Lock()
+
+
+def get_shared_tagging_action(
+    method: str = DEFAULT_TAGGING_METHOD, cache: Optional[TagCache] = None, **kwargs
+) -> CachedTaggingAction:
+    """
+    Returns a process-wide tagging action for the given model and thresholds,
+    so that actions needing the same tagger share a single model session.
+    """
+    key = tagger_fingerprint(method, kwargs)
+    with _shared_tagging_actions_lock:
+        if key not in _shared_tagging_actions:
+            _shared_tagging_actions[key] = CachedTaggingAction(
+                method, force=True, **kwargs
+            )
+        action = _shared_tagging_actions[key]
+        if action.cache is None:
+            action.cache = cache
+        return action
+
+
+def commit_shared_tagging_actions():
+    # Shared actions are never iterated, commits the last use of their cache hits
+    with _shared_tagging_actions_lock:
+        for action in _shared_tagging_actions.values():
+            if action.cache is not None:
+                action.cache.commit()
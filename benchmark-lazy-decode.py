@@ -0,0 +1,69 @@
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from PIL import Image
+from waifuc.action import MinSizeFilterAction
+
+from sources import LocalFilesSource, list_image_files
+
+# Example:
+# python .\benchmark-lazy-decode.py --count 500 --small-ratio 0.8
+
+parser = argparse.ArgumentParser(
+    prog="benchmark-lazy-decode",
+    description="Compares eager and header-only image loading in front of MinSizeFilterAction",
+)
+parser.add_argument(
+    "--count", dest="count", help="Number of images to generate", type=int, default=200
+)
+parser.add_argument(
+    "--small-ratio",
+    dest="small_ratio",
+    help="Ratio of generated images smaller than --min-size",
+    type=float,
+    default=0.7,
+)
+parser.add_argument(
+    "--min-size", dest="min_size", help="Minimum image size", type=int, default=480
+)
+args = parser.parse_args()
+
+count: int = args.count
+small_ratio: float = args.small_ratio
+min_size: int = args.min_size
+
+
+def generate_images(directory: str):
+    random.seed(0)
+    for i in range(count):
+        size = 256 if random.random() < small_ratio else 1024
+        color = tuple(random.randrange(256) for _ in range(3))
+        Image.new("RGB", (size, size), color).save(
+            os.path.join(directory, f"image_{i}.png")
+        )
+
+
+def run(directory: str, lazy: bool):
+    source = LocalFilesSource(directory, list_image_files(directory), lazy=lazy)
+    start = time.perf_counter()
+    kept = 0
+    for item in source.attach(MinSizeFilterAction(min_size)):
+        item.image.load()  # Downstream stages would access the pixels of kept images
+        kept += 1
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"{'lazy' if lazy else 'eager'}: {source.decoded} decoded, {kept} kept, "
+        f"{elapsed:.2f}s ({count / elapsed:.1f} images/s)"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        generate_images(directory)
+        run(directory, lazy=False)
+        run(directory, lazy=True)
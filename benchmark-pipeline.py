@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from fractions import Fraction
+from typing import Optional
+import av
+import numpy as np
+from PIL import Image, ImageDraw
+
+from tagger import STUB_METHOD
+
+# Examples:
+# python .\benchmark-pipeline.py --output benchmark.json
+# python .\benchmark-pipeline.py --taggers stub wd14_v3_swinv2 --baseline benchmark.json
+
+CONFIGS = {
+    "tag-only": ["--input-type", "image", "--tag-only", "--output-meta", "txt"],
+    "video": ["--input-type", "video", "--output-meta", "txt"],
+    "organize-by-tags": [
+        "--input-type",
+        "image",
+        "--output-meta",
+        "txt",
+        "--organize-by-tags",
+        "red background",
+        "green background",
+    ],
+    "output-meta-all": ["--input-type", "image", "--output-meta", "all"],
+}
+
+parser = argparse.ArgumentParser(
+    prog="benchmark-pipeline",
+    description="Times process.py on synthetic images and videos and writes comparable JSON results",
+)
+parser.add_argument(
+    "--configs",
+    dest="configs",
+    help="Configurations to run",
+    nargs="+",
+    choices=list(CONFIGS),
+    default=list(CONFIGS),
+)
+parser.add_argument(
+    "--taggers",
+    dest="taggers",
+    help=(
+        "Taggers to run every configuration with. The stub tagger also skips the similarity filter and the tag "
+        "blacklist so that it runs offline, the ONNX taggers are skipped when onnxruntime is not installed"
+    ),
+    nargs="+",
+    default=[STUB_METHOD],
+)
+parser.add_argument(
+    "--images", dest="images", help="Number of images to generate", type=int, default=200
+)
+parser.add_argument(
+    "--videos", dest="videos", help="Number of videos to generate", type=int, default=2
+)
+parser.add_argument(
+    "--video-seconds",
+    dest="video_seconds",
+    help="Duration of each generated video",
+    type=int,
+    default=10,
+)
+parser.add_argument(
+    "--repeat",
+    dest="repeat",
+    help="Runs per configuration, the fastest one is kept",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--extra-args",
+    dest="extra_args",
+    help="Extra arguments passed to every process.py run, e.g. \"--async-export --tag-batch-size 32\"",
+    default="",
+)
+parser.add_argument(
+    "--output", dest="output", help="Path of the JSON results", default="benchmark.json"
+)
+parser.add_argument(
+    "--baseline",
+    dest="baseline",
+    help="JSON results of a previous run to compare against",
+)
+args = parser.parse_args()
+
+configs: list[str] = args.configs
+taggers: list[str] = args.taggers
+image_count: int = args.images
+video_count: int = args.videos
+video_seconds: int = args.video_seconds
+repeat: int = args.repeat
+extra_args: list[str] = args.extra_args.split()
+output: str = args.output
+baseline: Optional[str] = args.baseline
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def random_image(rng: random.Random, size: tuple[int, int]) -> Image.Image:
+    # Flat background with a few shapes, so that images compress like drawings rather than noise
+    background = tuple(rng.randrange(256) for _ in range(3))
+    image = Image.new("RGB", size, background)
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randrange(3, 8)):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(20, size[0] // 2), y0 + rng.randrange(20, size[1] // 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+    return image
+
+
+def generate_images(directory: str):
+    rng = random.Random(0)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(image_count):
+        size = rng.choice([(512, 512), (512, 768), (768, 512), (1024, 1024)])
+        random_image(rng, size).save(os.path.join(directory, f"image_{i:05}.png"))
+
+
+def generate_videos(directory: str, fps: int = 24, scene_seconds: float = 1.5):
+    # Scenes of slowly moving shapes separated by hard cuts, like an edited episode
+    rng = random.Random(1)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(video_count):
+        with av.open(os.path.join(directory, f"video_{i:03}.mp4"), "w") as container:
+            stream = container.add_stream("mpeg4", rate=fps)
+            # Frames must pass the default --min-size of 480
+            stream.width, stream.height = 854, 480
+            stream.pix_fmt = "yuv420p"
+            stream.time_base = Fraction(1, fps)
+            scene = None
+            for frame_index in range(video_seconds * fps):
+                if frame_index % int(scene_seconds * fps) == 0:
+                    scene = random_image(rng, (854, 480))
+                shift = frame_index % int(scene_seconds * fps)
+                image = Image.fromarray(np.roll(np.asarray(scene), shift * 2, axis=1))
+                frame = av.VideoFrame.from_image(image)
+                frame.pts = frame_index
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+            for packet in stream.encode():
+                container.mux(packet)
+
+
+def is_tagger_available(tagger: str) -> bool:
+    # Runs with the ONNX taggers also need onnxruntime for the similarity filter and network access for the models
+    if tagger == STUB_METHOD:
+        return True
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def directory_size(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(directory)
+        for file in files
+    )
+
+
+def run_config(config: str, tagger: str, fixtures: str, work_dir: str) -> dict:
+    input_dir = os.path.join(fixtures, "videos" if config == "video" else "images")
+    best = None
+    for attempt in range(repeat):
+        # Outputs of tag-only runs are written next to the images, use a fresh copy every time
+        run_dir = os.path.join(work_dir, f"{config}-{tagger}-{attempt}")
+        output_dir = os.path.join(run_dir, "output")
+        stats_path = os.path.join(run_dir, "stats.json")
+        run_input = input_dir
+        input_bytes = 0
+        if config == "tag-only":
+            run_input = output_dir = os.path.join(run_dir, "images")
+            os.makedirs(output_dir)
+            for file in os.listdir(input_dir):
+                os.link(os.path.join(input_dir, file), os.path.join(output_dir, file))
+            input_bytes = directory_size(output_dir)
+
+        command = [
+            sys.executable,
+            os.path.join(SCRIPT_DIR, "process.py"),
+            "--input",
+            run_input,
+            "--output",
+            output_dir,
+            *(["--benchmark-stubs"] if tagger == STUB_METHOD else ["--tagger", tagger]),
+            "--no-tag-cache",
+            "--stats",
+            stats_path,
+            *CONFIGS[config],
+            *extra_args,
+        ]
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+
+        with open(stats_path) as f:
+            stats = json.load(f)
+        source = next(stage for stage in stats["stages"] if stage["kind"] == "source")
+        exported = sum(
+            stage["items_out"] for stage in stats["stages"] if stage["kind"] == "exporter"
+        )
+        result = {
+            "config": config,
+            "tagger": tagger,
+            "elapsed": elapsed,
+            "images_in": source["items_out"],
+            "images_per_sec": source["items_out"] / elapsed if elapsed else 0,
+            "exported": exported,
+            "bytes_written": directory_size(output_dir) - input_bytes,
+            "stages": [
+                {
+                    "name": stage["name"],
+                    "kind": stage["kind"],
+                    "wall_time": stage["wall_time"],
+                    "items_in": stage["items_in"],
+                    "items_out": stage["items_out"],
+                    "bytes_written": stage["bytes_written"],
+                }
+                for stage in stats["stages"]
+            ],
+        }
+        logging.info(
+            f"{config} ({tagger}) run {attempt + 1}/{repeat}: {elapsed:.1f}s, "
+            f"{result['images_per_sec']:.1f} images/s, "
+            f"{result['bytes_written'] / 1024 / 1024:.1f}MB written"
+        )
+        if best is None or elapsed < best["elapsed"]:
+            best = result
+    return best
+
+
+def compare(results: list[dict], baseline_path: str):
+    with open(baseline_path) as f:
+        previous = {
+            (run["config"], run["tagger"]): run for run in json.load(f)["runs"]
+        }
+    for run in results:
+        before = previous.get((run["config"], run["tagger"]))
+        if before is None or not before["images_per_sec"]:
+            continue
+        change = run["images_per_sec"] / before["images_per_sec"] - 1
+        logging.info(
+            f"{run['config']} ({run['tagger']}): {before['images_per_sec']:.1f} -> "
+            f"{run['images_per_sec']:.1f} images/s ({change:+.1%})"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures = os.path.join(work_dir, "fixtures")
+        logging.info(
+            f"Generating {image_count} images and {video_count} videos of {video_seconds}s"
+        )
+        generate_images(os.path.join(fixtures, "images"))
+        if "video" in configs:
+            generate_videos(os.path.join(fixtures, "videos"))
+
+        runs = []
+        for tagger in taggers:
+            if not is_tagger_available(tagger):
+                logging.info(f"Skipping {tagger}, onnxruntime is not installed")
+                continue
+            for config in configs:
+                runs.append(run_config(config, tagger, fixtures, work_dir))
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "fixtures": {
+            "images": image_count,
+            "videos": video_count,
+            "video_seconds": video_seconds,
+        },
+        "extra_args": extra_args,
+        "runs": runs,
+    }
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Wrote results to {output}")
+
+    if baseline:
+        compare(runs, baseline)
@@ -0,0 +1,196 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Optional
+from PIL import Image, ImageDraw
+
+from dataset_shards import COMPRESSIONS, DEFAULT_SHARD_SIZE_MB, pack_dataset
+
+# Compares transferring a dataset of small image/caption pairs file by file
+# with rsync against packing it into tar shards (start-runpod.py --ship-shards).
+# Runs against a local folder by default, or over SSH to e.g. localhost.
+# Requires rsync, tar and bash, run it from WSL on Windows.
+# Examples:
+# python ./benchmark-transfer.py --images 20000
+# python ./benchmark-transfer.py --images 20000 --ssh-target "$USER@localhost" --compressions none zstd
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+UNPACK_SHARDS_SCRIPT = os.path.join(SCRIPT_DIR, "runpod", "unpack-shards.sh")
+
+parser = argparse.ArgumentParser(
+    prog="benchmark-transfer",
+    description="Times rsync of individual files against tar shards on a generated dataset",
+)
+parser.add_argument(
+    "--images", dest="images", help="Number of image/caption pairs", type=int, default=5000
+)
+parser.add_argument(
+    "--image-size", dest="image_size", help="Width and height of images", type=int, default=512
+)
+parser.add_argument(
+    "--compressions",
+    dest="compressions",
+    help="Shard compressions to benchmark",
+    nargs="+",
+    choices=list(COMPRESSIONS),
+    default=["none"],
+)
+parser.add_argument(
+    "--shard-size-mb",
+    dest="shard_size_mb",
+    help="Size of each shard",
+    type=float,
+    default=DEFAULT_SHARD_SIZE_MB,
+)
+parser.add_argument(
+    "--ssh-target",
+    dest="ssh_target",
+    help="Transfer over SSH to this user@host instead of a local folder",
+)
+parser.add_argument("--ssh-port", dest="ssh_port", help="SSH port", type=int, default=22)
+parser.add_argument("--ssh-key", dest="ssh_key", help="Path to the SSH private key")
+parser.add_argument(
+    "--output", dest="output", help="Path of the JSON results", default="benchmark-transfer.json"
+)
+args = parser.parse_args()
+
+image_count: int = args.images
+image_size: int = args.image_size
+compressions: list[str] = args.compressions
+shard_size_mb: float = args.shard_size_mb
+ssh_target: Optional[str] = args.ssh_target
+ssh_port: int = args.ssh_port
+ssh_key: Optional[str] = args.ssh_key
+output: str = args.output
+
+
+def generate_dataset(directory: str):
+    rng = random.Random(0)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(image_count):
+        background = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.new("RGB", (image_size, image_size), background)
+        draw = ImageDraw.Draw(image)
+        for _ in range(4):
+            x, y = rng.randrange(image_size), rng.randrange(image_size)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.ellipse((x, y, x + 64, y + 64), fill=color)
+        image.save(os.path.join(directory, f"{i:06}.png"))
+        with open(os.path.join(directory, f"{i:06}.txt"), "w") as f:
+            tags = [f"tag {rng.randrange(500)}" for _ in range(20)]
+            f.write(", ".join(["1girl", "solo", "simple background", *tags]))
+
+
+def ssh_command() -> list[str]:
+    command = ["ssh", "-p", str(ssh_port), "-o", "StrictHostKeyChecking=no"]
+    if ssh_key:
+        command.extend(["-i", ssh_key])
+    return command
+
+
+def remote(path: str) -> str:
+    return f"{ssh_target}:{path}" if ssh_target else path
+
+
+def run_shell(command: list[str], stdin_path: Optional[str] = None):
+    if stdin_path:
+        with open(stdin_path, "rb") as f:
+            subprocess.run(command, check=True, stdin=f, stdout=subprocess.DEVNULL)
+    else:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+def rsync(source: str, destination: str, options: str = "-a"):
+    command = ["rsync", options]
+    if ssh_target:
+        command.extend(["-e", " ".join(ssh_command())])
+    run_shell([*command, source, remote(destination)])
+
+
+def clean(destination: str):
+    if ssh_target:
+        run_shell([*ssh_command(), ssh_target, f"rm -rf {destination}"])
+    else:
+        shutil.rmtree(destination, ignore_errors=True)
+
+
+def transfer_files(dataset: str, destination: str) -> dict:
+    start = time.perf_counter()
+    rsync(dataset, destination + "/")
+    return {"method": "files", "elapsed": time.perf_counter() - start}
+
+
+def transfer_shards(dataset: str, work_dir: str, destination: str, compression: str) -> dict:
+    start = time.perf_counter()
+    shard_dir = os.path.join(work_dir, f"shards-{compression}")
+    index = pack_dataset(dataset, shard_dir, shard_size_mb, compression)
+    packed = time.perf_counter()
+
+    remote_shard_dir = destination + "/.shards"
+    rsync(shard_dir + "/", remote_shard_dir + "/")
+    transferred = time.perf_counter()
+
+    unpack = ["bash", "-s", "--", remote_shard_dir, destination]
+    if ssh_target:
+        unpack = [*ssh_command(), ssh_target, " ".join(unpack)]
+    run_shell(unpack, UNPACK_SHARDS_SCRIPT)
+    end = time.perf_counter()
+    return {
+        "method": f"shards-{compression}",
+        "elapsed": end - start,
+        "pack": packed - start,
+        "transfer": transferred - packed,
+        "unpack": end - transferred,
+        "shards": len(index["shards"]),
+        "bytes": sum(shard["size"] for shard in index["shards"]),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        dataset = os.path.join(work_dir, "dataset")
+        logging.info(f"Generating {image_count} images and captions")
+        generate_dataset(dataset)
+        dataset_bytes = sum(
+            os.path.getsize(os.path.join(dataset, file)) for file in os.listdir(dataset)
+        )
+
+        destination = (
+            f"/tmp/benchmark-transfer-{os.getpid()}"
+            if ssh_target
+            else os.path.join(work_dir, "destination")
+        )
+        runs = []
+        for run in [None, *compressions]:
+            clean(destination)
+            if not ssh_target:
+                os.makedirs(destination)
+            else:
+                run_shell([*ssh_command(), ssh_target, f"mkdir -p {destination}"])
+
+            if run is None:
+                result = transfer_files(dataset, destination)
+            else:
+                result = transfer_shards(dataset, work_dir, destination, run)
+            logging.info(f"{result['method']}: {result['elapsed']:.1f}s")
+            runs.append(result)
+        clean(destination)
+
+    results = {
+        "images": image_count,
+        "files": image_count * 2,
+        "dataset_bytes": dataset_bytes,
+        "ssh_target": ssh_target,
+        "runs": runs,
+    }
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Wrote results to {output}")
@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Mapping, Optional
+from waifuc.export import LocalDirectoryExporter
+from waifuc.model import ImageItem
+from imgutils.tagging import tags_to_text
+
+from exporters import (
+    ExportPool,
+    encode_image,
+    exported_meta,
+    get_image_format,
+    write_file_atomic,
+)
+
+logger = logging.getLogger(__name__)
+
+CAPTION_STORE_FILENAME = "captions.sqlite3"
+
+
+class CaptionStore:
+    """
+    Captions of an output directory in a single sqlite file: one row per image
+    with its tags and scores, the file it was extracted from and its size,
+    instead of a .txt and a .json file next to every image.
+    Images are keyed by their path relative to the output directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "filename TEXT PRIMARY KEY, "
+                "tags TEXT NOT NULL, "
+                "source TEXT, "
+                "width INTEGER, "
+                "height INTEGER, "
+                "meta TEXT NOT NULL, "
+                "updated REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def put(
+        self,
+        filename: str,
+        tags: Mapping[str, float],
+        source: Optional[str] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        meta: Optional[Mapping[str, Any]] = None,
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO captions "
+            "(filename, tags, source, width, height, meta, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                filename.replace(os.sep, "/"),
+                json.dumps(
+                    {tag: float(score) for tag, score in tags.items()},
+                    ensure_ascii=False,
+                ),
+                source,
+                width,
+                height,
+                json.dumps(meta or {}, ensure_ascii=False, default=str),
+                time.time(),
+            ),
+        )
+
+    def get(self, filename: str) -> Optional[dict[str, float]]:
+        row = self.conn.execute(
+            "SELECT tags FROM captions WHERE filename = ?",
+            (filename.replace(os.sep, "/"),),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def __iter__(self) -> Iterator[tuple[str, dict[str, float]]]:
+        for filename, tags in self.conn.execute(
+            "SELECT filename, tags FROM captions ORDER BY filename"
+        ):
+            yield filename, json.loads(tags)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def tag_counts(self) -> dict[str, int]:
+        """
+        Number of images per tag, most frequent first, counted by sqlite without loading the captions.
+        """
+        return dict(
+            self.conn.execute(
+                "SELECT tag.key, COUNT(*) AS count FROM captions, json_each(captions.tags) AS tag "
+                "GROUP BY tag.key ORDER BY count DESC, tag.key"
+            )
+        )
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+
+def materialize_captions(
+    store: CaptionStore,
+    output_dir: str,
+    use_spaces: bool = True,
+    use_escape: bool = True,
+    include_score: bool = False,
+    threads: int = 8,
+) -> tuple[int, int]:
+    """
+    Writes the .txt caption of every stored image that exists in output_dir,
+    captions whose file already has the same content are left untouched.
+    Returns the number of written and unchanged captions.
+    """
+
+    def write(filename: str, tags: dict[str, float]) -> Optional[bool]:
+        image_path = os.path.join(output_dir, *filename.split("/"))
+        if not os.path.exists(image_path):
+            return None
+        caption_path = os.path.splitext(image_path)[0] + ".txt"
+        text = tags_to_text(tags, use_spaces, use_escape, include_score, True)
+        try:
+            with open(caption_path, encoding="utf-8") as f:
+                if f.read() == text:
+                    return False
+        except FileNotFoundError:
+            pass
+        write_file_atomic(caption_path, text.encode("utf-8"))
+        return True
+
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(lambda row: write(*row), store))
+    written = sum(1 for result in results if result)
+    unchanged = sum(1 for result in results if result is False)
+    missing = sum(1 for result in results if result is None)
+    if missing:
+        logger.info(f"Skipped {missing} captions of images missing from {output_dir}")
+    return written, unchanged
+
+
+class CaptionStoreExporter(LocalDirectoryExporter):
+    """
+    Same as TextualInversionExporter but the captions are added to a
+    CaptionStore instead of being written to a .txt file per image.
+    Each row is committed as soon as it is added: worker processes share the
+    store and a long write transaction would lock the others out, and the
+    journal never checkpoints items whose caption is not committed yet.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        store: CaptionStore,
+        skip_image_export: bool = False,
+        skip_when_image_exist: bool = False,
+        save_params: Optional[Mapping[str, Any]] = None,
+        organize_by_tags: list[str] = None,
+        pool: Optional[ExportPool] = None,
+        ignore_error_when_export: bool = False,
+    ):
+        LocalDirectoryExporter.__init__(
+            self, output_dir, False, ignore_error_when_export
+        )
+        self.store = store
+        self.skip_image_export = skip_image_export
+        self.skip_when_image_exist = skip_when_image_exist
+        self.save_params = save_params or {}
+        self.organize_by_tags = organize_by_tags or []
+        self.pool = pool
+        self.untitles = 0
+        # Files written for the last exported item
+        self.last_written: list[str] = []
+
+    def export_item(self, item: ImageItem):
+        if "filename" in item.meta:
+            filename = item.meta["filename"]
+        else:
+            self.untitles += 1
+            filename = f"untitled_{self.untitles}.png"
+
+        tags = item.meta.get("tags", None) or {}
+        for tag in self.organize_by_tags:
+            if tag in tags:
+                filename = os.path.join(tag, filename)
+                break
+
+        image = item.image
+        meta = {
+            key: value
+            for key, value in exported_meta(item.meta).items()
+            if key not in ("tags", "filename")
+        }
+        self.store.put(
+            filename,
+            tags,
+            item.meta.get("path"),
+            image.width if image is not None else item.meta.get("width"),
+            image.height if image is not None else item.meta.get("height"),
+            meta,
+        )
+        self.store.commit()
+
+        full_filename = os.path.join(self.output_dir, filename)
+        write_image = not self.skip_image_export and (
+            not self.skip_when_image_exist or not os.path.exists(full_filename)
+        )
+        self.last_written = [full_filename] if write_image else []
+        if not write_image:
+            return
+
+        if self.pool is not None:
+            self.pool.write_image(full_filename, image, self.save_params)
+            return
+
+        full_directory = os.path.dirname(full_filename)
+        if full_directory:
+            os.makedirs(full_directory, exist_ok=True)
+        write_file_atomic(
+            full_filename,
+            encode_image(image, get_image_format(full_filename), self.save_params),
+        )
+
+    def post_export(self):
+        self.flush()
+
+    def flush(self):
+        if self.pool is not None:
+            self.pool.flush()
+        self.store.commit()
+
+    def reset(self):
+        self.untitles = 0
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same store
+        return CaptionStoreExporter(
+            self.output_dir,
+            self.store,
+            self.skip_image_export,
+            self.skip_when_image_exist,
+            self.save_params,
+            self.organize_by_tags,
+            self.pool,
+            self.ignore_error_when_export,
+        )
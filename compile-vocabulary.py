@@ -0,0 +1,67 @@
+import argparse
+import logging
+import os
+
+from vocabulary import (
+    DEFAULT_BOORU_TAGS_PATH,
+    DEFAULT_VOCABULARY_PATH,
+    CompiledVocabulary,
+    compile_vocabulary,
+    read_booru_tags,
+)
+
+# Example:
+# python .\compile-vocabulary.py --labels wd14_v3_swinv2
+
+parser = argparse.ArgumentParser(
+    prog="compile-vocabulary",
+    description="Compiles the danbooru tag list and tagger labels to a memory-mapped tag vocabulary",
+)
+parser.add_argument(
+    "--booru-tags",
+    dest="booru_tags",
+    help="Path of the danbooru tag list, downloaded if missing",
+    default=DEFAULT_BOORU_TAGS_PATH,
+)
+parser.add_argument(
+    "--labels",
+    dest="labels",
+    help="Tagging methods whose labels are added to the vocabulary, e.g. wd14_v3_swinv2",
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--output",
+    dest="output",
+    help="Path of the compiled vocabulary",
+    default=DEFAULT_VOCABULARY_PATH,
+)
+args = parser.parse_args()
+
+booru_tags_path: str = args.booru_tags
+label_methods: list[str] = args.labels
+output: str = args.output
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    labels = []
+    if label_methods:
+        # Only needed to read tagger labels, imports the ONNX runtime
+        from imgutils.tagging.wd14 import _get_wd14_labels
+        from tagger import WD14_MODEL_NAMES
+
+        for method in label_methods:
+            tag_names, _, _, _ = _get_wd14_labels(WD14_MODEL_NAMES[method])
+            labels.extend(tag_names)
+
+    booru_tags = read_booru_tags(booru_tags_path)
+    compile_vocabulary(
+        output, booru_tags, labels, booru_tags_mtime=os.path.getmtime(booru_tags_path)
+    )
+    vocabulary = CompiledVocabulary(output)
+    logging.info(
+        f"{len(vocabulary)} tags, most frequent: "
+        + ", ".join(vocabulary.tag(i) for i in vocabulary.ranks.argsort()[:10])
+    )
+    vocabulary.close()
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import tarfile
+from contextlib import contextmanager
+from typing import Iterator, List
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+CHECKSUMS_FILENAME = "SHA256SUMS"
+COMPRESSIONS = {"none": ".tar", "gz": ".tar.gz", "zstd": ".tar.zst"}
+DEFAULT_SHARD_SIZE_MB = 256
+
+
+def list_dataset_files(source: str) -> tuple[str, List[str]]:
+    """
+    Files to pack and the directory their archive names are relative to. Like
+    rsync, "dataset" packs the folder itself and "dataset/" only its content.
+    """
+    source_dir = os.path.abspath(source)
+    base = source_dir if source.endswith(("/", os.sep)) else os.path.dirname(source_dir)
+    files = []
+    for root, dirs, filenames in os.walk(source_dir):
+        dirs.sort()
+        for filename in sorted(filenames):
+            files.append(os.path.join(root, filename))
+    return base, files
+
+
+@contextmanager
+def _open_shard(path: str, compression: str) -> Iterator[tarfile.TarFile]:
+    if compression == "none":
+        with tarfile.open(path, "w") as tar:
+            yield tar
+    elif compression == "gz":
+        # Images are already compressed, favor speed over ratio
+        with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+            yield tar
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression requires zstandard, run pip install zstandard")
+        with open(path, "wb") as f:
+            with zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(f) as stream:
+                with tarfile.open(fileobj=stream, mode="w|") as tar:
+                    yield tar
+    else:
+        raise Exception(f"Unknown compression: {compression}")
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pack_dataset(
+    source: str,
+    output_dir: str,
+    shard_size_mb: float = DEFAULT_SHARD_SIZE_MB,
+    compression: str = "none",
+) -> dict:
+    """
+    Packs a dataset folder into tar shards of about shard_size_mb each, so that
+    it can be transferred as a few large files instead of thousands of small
+    ones. Files are never split across shards.
+    Writes an index.json listing the files of every shard and a SHA256SUMS
+    file that sha256sum -c can check on the pod. Previous shards are replaced.
+    """
+    base, files = list_dataset_files(source)
+    # Shards may be written inside the dataset folder, never pack previous shards
+    output_prefix = os.path.join(os.path.abspath(output_dir), "")
+    files = [file for file in files if not file.startswith(output_prefix)]
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in os.listdir(output_dir):
+        if filename.startswith("shard-") or filename in (INDEX_FILENAME, CHECKSUMS_FILENAME):
+            os.remove(os.path.join(output_dir, filename))
+
+    shard_size = int(shard_size_mb * 1024 * 1024)
+    shards: List[List[str]] = []
+    current: List[str] = []
+    current_size = 0
+    for file in files:
+        size = os.path.getsize(file)
+        if current and current_size + size > shard_size:
+            shards.append(current)
+            current, current_size = [], 0
+        current.append(file)
+        current_size += size
+    if current:
+        shards.append(current)
+
+    index = {"compression": compression, "shards": []}
+    for shard_index, shard_files in enumerate(shards):
+        name = f"shard-{shard_index:05}{COMPRESSIONS[compression]}"
+        path = os.path.join(output_dir, name)
+        with _open_shard(path, compression) as tar:
+            for file in shard_files:
+                tar.add(file, arcname=os.path.relpath(file, base).replace(os.sep, "/"))
+        index["shards"].append(
+            {
+                "name": name,
+                "size": os.path.getsize(path),
+                "sha256": _sha256(path),
+                "files": [
+                    os.path.relpath(file, base).replace(os.sep, "/")
+                    for file in shard_files
+                ],
+            }
+        )
+
+    with open(os.path.join(output_dir, INDEX_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    # Checksums are written with LF line endings so that sha256sum -c accepts them on Linux
+    with open(os.path.join(output_dir, CHECKSUMS_FILENAME), "w", newline="\n") as f:
+        for shard in index["shards"]:
+            f.write(f"{shard['sha256']}  {shard['name']}\n")
+
+    total_size = sum(shard["size"] for shard in index["shards"])
+    logger.info(
+        f"Packed {len(files)} files into {len(shards)} shards "
+        f"({total_size / 1024 / 1024:.1f}MB) in {output_dir}"
+    )
+    return index
+
+
+@contextmanager
+def _read_shard(path: str, compression: str) -> Iterator[tarfile.TarFile]:
+    if compression == "zstd":
+        import zstandard
+
+        with open(path, "rb") as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as stream:
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    yield tar
+    else:
+        with tarfile.open(path, "r|gz" if compression == "gz" else "r|") as tar:
+            yield tar
+
+
+def unpack_shards(shard_dir: str, destination: str, verify: bool = True) -> int:
+    """
+    Local counterpart of runpod/unpack-shards.sh, extracts every shard of the index into destination.
+    """
+    with open(os.path.join(shard_dir, INDEX_FILENAME), encoding="utf-8") as f:
+        index = json.load(f)
+
+    count = 0
+    for shard in index["shards"]:
+        path = os.path.join(shard_dir, shard["name"])
+        if verify and _sha256(path) != shard["sha256"]:
+            raise Exception(f"Checksum mismatch for {path}")
+        with _read_shard(path, index["compression"]) as tar:
+            if hasattr(tarfile, "data_filter"):
+                # Refuse absolute paths and links pointing outside of destination
+                tar.extractall(destination, filter="data")
+            else:
+                tar.extractall(destination)
+        count += len(shard["files"])
+    logger.info(f"Unpacked {count} files from {len(index['shards'])} shards to {destination}")
+    return count
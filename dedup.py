@@ -0,0 +1,211 @@
+import logging
+import os
+import sqlite3
+from typing import Optional
+import numpy as np
+from PIL import Image
+from waifuc.export import BaseExporter
+from waifuc.model import ImageItem
+
+logger = logging.getLogger(__name__)
+
+PHASH_SIZE = 8
+PHASH_IMAGE_SIZE = 32
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    # DCT-II basis, avoids pulling scipy in for a 32x32 transform
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+_DCT = _dct_matrix(PHASH_IMAGE_SIZE)
+
+
+def phash(image: Image.Image) -> int:
+    """
+    64-bit perceptual hash: low frequency DCT coefficients compared to their median.
+    """
+    pixels = np.asarray(
+        image.convert("L").resize(
+            (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.Resampling.LANCZOS
+        ),
+        dtype=np.float64,
+    )
+    dct = (_DCT @ pixels @ _DCT.T)[:PHASH_SIZE, :PHASH_SIZE]
+    bits = (dct > np.median(dct)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit hashes: each hash is split into
+    max_distance + 1 bands, so any hash within max_distance bits of a query
+    shares at least one band with it exactly. Lookups only compare against the
+    hashes in the matching buckets instead of the whole index.
+    """
+
+    def __init__(self, max_distance: int, bits: int = 64):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        widths = [
+            bits // band_count + (1 if i < bits % band_count else 0)
+            for i in range(band_count)
+        ]
+        self.bands: list[tuple[int, int]] = []
+        shift = 0
+        for width in widths:
+            self.bands.append((shift, (1 << width) - 1))
+            shift += width
+        self.buckets: list[dict[int, list[int]]] = [{} for _ in self.bands]
+        self.count = 0
+
+    def add(self, value: int):
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            buckets.setdefault((value >> shift) & mask, []).append(value)
+        self.count += 1
+
+    def find(self, value: int) -> Optional[int]:
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            for candidate in buckets.get((value >> shift) & mask, ()):
+                if (candidate ^ value).bit_count() <= self.max_distance:
+                    return candidate
+        return None
+
+    def __len__(self):
+        return self.count
+
+
+def _to_signed(value: int) -> int:
+    # sqlite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class DedupIndex:
+    """
+    Near-duplicate index over perceptual hashes, optionally persisted to a sqlite
+    file so that duplicates of frames kept by previous runs are dropped as well.
+    add() only covers the current run, hashes are persisted with record()
+    and written in batches by commit(), in one short transaction so that
+    worker processes sharing the index never wait on each other's writes.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_distance: int = 4):
+        self.path = path
+        self.max_distance = max_distance
+        self.index = HammingIndex(max_distance)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._loaded = False
+        # Recorded since the last commit
+        self._pending: list[tuple[int, Optional[str]]] = []
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes (hash INTEGER NOT NULL, path TEXT)"
+            )
+        return self._conn
+
+    def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path:
+            return
+
+        for (value,) in self.conn.execute("SELECT hash FROM hashes"):
+            self.index.add(_to_unsigned(value))
+        logger.info(f"Loaded {len(self.index)} hashes from dedup index {self.path}")
+
+    def find(self, value: int) -> Optional[int]:
+        self.load()
+        return self.index.find(value)
+
+    def add(self, value: int):
+        self.load()
+        self.index.add(value)
+
+    def record(self, value: int, path: Optional[str] = None):
+        if not self.path:
+            return
+        self._pending.append((_to_signed(value), path))
+        if len(self._pending) >= 100:
+            self.commit()
+
+    def commit(self):
+        if not self._pending:
+            return
+        self.conn.executemany("INSERT INTO hashes (hash, path) VALUES (?, ?)", self._pending)
+        self.conn.commit()
+        self._pending = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_loaded"] = False
+        state["_pending"] = []
+        state["index"] = HammingIndex(self.max_distance)
+        return state
+
+
+class DedupExporter(BaseExporter):
+    """
+    Wraps an exporter and records the perceptual hash that DedupAction added
+    to each item in the persistent index once the item is exported, so that
+    items dropped by later actions or lost to a crash are not considered
+    duplicates by the next runs.
+    """
+
+    def __init__(
+        self,
+        exporter: BaseExporter,
+        index_path: str,
+        ignore_error_when_export: bool = False,
+    ):
+        BaseExporter.__init__(self, ignore_error_when_export)
+        self.exporter = exporter
+        self.index_path = index_path
+        self.index = DedupIndex(index_path)
+
+    @property
+    def last_written(self) -> list[str]:
+        return getattr(self.exporter, "last_written", [])
+
+    def pre_export(self):
+        self.exporter.pre_export()
+
+    def post_export(self):
+        self.exporter.post_export()
+        self.index.commit()
+
+    def export_item(self, item: ImageItem):
+        self.exporter.export_item(item)
+        value = item.meta.get("phash")
+        if value is not None:
+            self.index.record(value, item.meta.get("path") or item.meta.get("filename"))
+
+    def flush(self):
+        flush = getattr(self.exporter, "flush", None)
+        if flush is not None:
+            flush()
+
+    def reset(self):
+        self.exporter.reset()
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same index
+        exporter = DedupExporter(self.exporter, self.index_path, self.ignore_error_when_export)
+        exporter.index = self.index
+        return exporter
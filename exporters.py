@@ -1,39 +1,276 @@
+import io
+import json
 import logging
 import os
 import sys
-from typing import Any, Mapping, Optional
-from waifuc.export import BaseExporter, LocalDirectoryExporter
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Mapping, Optional, TextIO
+from PIL import Image
+from waifuc.export import BaseExporter, LocalDirectoryExporter, SaveExporter
 from waifuc.model import ImageItem
 from imgutils.tagging import tags_to_text
 
 
+# Meta added by the pipeline for itself, e.g. for the journal, the manifest, dedup and the lazy header filters,
+# never exported
+INTERNAL_META_KEYS = ("path", "phash", "width", "height", "format")
+
+
+def exported_meta(meta: Mapping[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in meta.items() if key not in INTERNAL_META_KEYS}
+
+
+def get_image_format(path: str) -> str:
+    return Image.registered_extensions().get(os.path.splitext(path)[1].lower(), "PNG")
+
+
+def encode_image(
+    image: Image.Image, image_format: str, save_params: Optional[Mapping] = None
+) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **(save_params or {}))
+    return buffer.getvalue()
+
+
+def write_file_atomic(path: str, data: bytes):
+    # Write to a temporary file first so that a crash never leaves a truncated file behind
+    temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ExportPool:
+    """
+    Bounded thread pool that encodes and writes exported files in the background.
+    Images are encoded once and the bytes are shared between exporters writing
+    the same image, created directories are cached, and files are written
+    atomically via a temporary file and a rename.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures: set[Future] = set()
+        self._errors: list[BaseException] = []
+        self._created_dirs: set[str] = set()
+        # Recently encoded images, keyed by image identity and encoding parameters
+        self._encoded: OrderedDict[tuple, tuple[Image.Image, Future, set[str]]] = (
+            OrderedDict()
+        )
+
+    def submit(self, fn: Callable, *args) -> Future:
+        # Blocks the pipeline when too many writes are pending so that memory stays bounded
+        self._pending.acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="export"
+                )
+            future = self._executor.submit(fn, *args)
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._pending.release()
+
+    def makedirs(self, directory: str):
+        if not directory or directory in self._created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._created_dirs.add(directory)
+
+    def write_bytes(self, path: str, data: bytes):
+        self.makedirs(os.path.dirname(path))
+        write_file_atomic(path, data)
+
+    def write_text(self, path: str, text: str) -> Future:
+        return self.submit(self.write_bytes, path, text.encode("utf-8"))
+
+    def write_image(
+        self,
+        path: str,
+        image: Image.Image,
+        save_params: Optional[Mapping] = None,
+        after: Optional[Future] = None,
+    ):
+        # When given, the image is only written once the after future completed, e.g. its caption file
+        image_format = get_image_format(path)
+        key = (id(image), image_format, json.dumps(save_params or {}, sort_keys=True))
+        with self._lock:
+            encoded = self._encoded.get(key)
+            if encoded is None or encoded[0] is not image:
+                future: Future = Future()
+                encoded = (image, future, set())
+                self._encoded[key] = encoded
+                while len(self._encoded) > self.max_pending:
+                    self._encoded.popitem(last=False)
+                encode = True
+            else:
+                encode = False
+            _, future, paths = encoded
+            if path in paths:
+                # Another exporter already wrote the same image to the same file
+                return
+            paths.add(path)
+
+        if encode:
+            self.submit(self._encode, future, image, image_format, save_params or {})
+        self.submit(self._write_encoded, path, future, after)
+
+    def _encode(
+        self, future: Future, image: Image.Image, image_format: str, save_params
+    ):
+        try:
+            future.set_result(encode_image(image, image_format, save_params))
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+
+    def _write_encoded(self, path: str, future: Future, after: Optional[Future]):
+        if after is not None:
+            after.result()
+        self.write_bytes(path, future.result())
+
+    def flush(self):
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                break
+            for future in futures:
+                try:
+                    future.result()
+                except BaseException:
+                    pass
+
+        with self._lock:
+            self._encoded.clear()
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __deepcopy__(self, memo):
+        # Exporters are deep-copied by source.export, the pool and its threads must be shared
+        return self
+
+
 class FileNameExporter(BaseExporter):
-    filenames: list[str] = []
+    """
+    Streams the path of every exported item to stdout, one per line, or as
+    NDJSON records with the tag scores when output_format is "ndjson".
+    Output is flushed every flush_every items, and from a timer at most
+    flush_interval seconds after an item was written, so that matches are
+    available to downstream consumers right away even when no other item
+    follows for a while. Nothing is kept in memory.
+    """
 
     def __init__(
-        self, filenames: list[str] = None, ignore_error_when_export: bool = False
+        self,
+        output_format: str = "path",
+        tags: Optional[list[str]] = None,
+        flush_every: int = 16,
+        flush_interval: float = 1.0,
+        stream: TextIO = sys.stdout,
+        ignore_error_when_export: bool = False,
     ):
         BaseExporter.__init__(self, ignore_error_when_export)
-        if filenames is not None:
-            self.filenames = filenames
+        self.output_format = output_format
+        # Tags whose scores are included in NDJSON records, all tags when None
+        self.tags = tags
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.stream = stream
+        self._unflushed = 0
+        self._last_flush = 0.0
+        # The timer thread flushes while items are written
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
 
     def pre_export(self):
         pass
 
     def post_export(self):
-        pass
+        self.flush()
+
+    def format_item(self, item: ImageItem) -> str:
+        path = item.meta["path"]
+        if self.output_format == "path":
+            return path
+
+        tags: Mapping[str, float] = item.meta.get("tags") or {}
+        if self.tags is not None:
+            tags = {tag: tags[tag] for tag in self.tags if tag in tags}
+        scores = {tag: float(score) for tag, score in tags.items()}
+        return json.dumps({"path": path, "tags": scores})
 
     def export_item(self, item: ImageItem):
-        if "path" in item.meta:
-            self.filenames.append(item.meta["path"])
-            print(item.meta["path"], file=sys.stdout, flush=True)
+        if "path" not in item.meta:
+            return
+
+        line = self.format_item(item) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self._unflushed += 1
+            if (
+                self._unflushed >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.stream.flush()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
 
     def reset(self):
         pass
 
     def __deepcopy__(self, memo):
-        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same dicts
-        return FileNameExporter(self.filenames, self.ignore_error_when_export)
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__
+        # to keep writing to the same stream
+        return FileNameExporter(
+            self.output_format,
+            self.tags,
+            self.flush_every,
+            self.flush_interval,
+            self.stream,
+            self.ignore_error_when_export,
+        )
 
 
 class TagValidatorExporter(BaseExporter):
@@ -67,6 +304,14 @@ class ChainedExporter(BaseExporter):
     def __init__(self, exporters: list[BaseExporter]):
         self.exporters = exporters
 
+    @property
+    def last_written(self) -> list[str]:
+        return [
+            path
+            for exporter in self.exporters
+            for path in getattr(exporter, "last_written", [])
+        ]
+
     def pre_export(self):
         for exporter in self.exporters:
             exporter.pre_export()
@@ -79,6 +324,12 @@ class ChainedExporter(BaseExporter):
         for exporter in self.exporters:
             exporter.export_item(item)
 
+    def flush(self):
+        for exporter in self.exporters:
+            flush = getattr(exporter, "flush", None)
+            if flush is not None:
+                flush()
+
     def reset(self):
         for exporter in self.exporters:
             exporter.reset()
@@ -97,7 +348,8 @@ class TextualInversionExporter(LocalDirectoryExporter):
         skip_when_image_exist: bool = False,
         ignore_error_when_export: bool = False,
         save_params: Optional[Mapping[str, Any]] = None,
-        organize_by_tags: list[str] = None
+        organize_by_tags: list[str] = None,
+        pool: Optional[ExportPool] = None,
     ):
         LocalDirectoryExporter.__init__(
             self, output_dir, clear, ignore_error_when_export
@@ -111,6 +363,9 @@ class TextualInversionExporter(LocalDirectoryExporter):
         self.skip_when_image_exist = skip_when_image_exist
         self.save_params = save_params or {}
         self.organize_by_tags = organize_by_tags or []
+        self.pool = pool
+        # Files written for the last exported item
+        self.last_written: list[str] = []
 
     def export_item(self, item: ImageItem):
         if "filename" in item.meta:
@@ -133,24 +388,154 @@ class TextualInversionExporter(LocalDirectoryExporter):
         full_tagname = os.path.join(
             output_dir, os.path.splitext(filename)[0] + ".txt"
         )
+        tags_text = tags_to_text(
+            tags,
+            self.use_spaces,
+            self.use_escape,
+            self.include_score,
+            self.score_descend,
+        )
+
+        # The caption is written before the image so that a crash never leaves an image without its caption
+        write_image = not self.skip_image_export and (
+            not self.skip_when_image_exist or not os.path.exists(full_filename)
+        )
+        self.last_written = [full_tagname] + ([full_filename] if write_image else [])
+
+        if self.pool is not None:
+            caption_written = self.pool.write_text(full_tagname, tags_text)
+            if write_image:
+                self.pool.write_image(
+                    full_filename, item.image, self.save_params, after=caption_written
+                )
+            return
+
         full_directory = os.path.dirname(full_filename)
         if full_directory:
             os.makedirs(full_directory, exist_ok=True)
 
-        if not self.skip_image_export:
-            if not self.skip_when_image_exist or not os.path.exists(full_filename):
-                item.image.save(full_filename, **(self.save_params or {}))
-
-        with open(full_tagname, "w", encoding="utf-8") as f:
-            f.write(
-                tags_to_text(
-                    tags,
-                    self.use_spaces,
-                    self.use_escape,
-                    self.include_score,
-                    self.score_descend,
-                )
+        write_file_atomic(full_tagname, tags_text.encode("utf-8"))
+        if write_image:
+            write_file_atomic(
+                full_filename,
+                encode_image(
+                    item.image, get_image_format(full_filename), self.save_params
+                ),
             )
 
+    def post_export(self):
+        self.flush()
+
+    def flush(self):
+        if self.pool is not None:
+            self.pool.flush()
+
     def reset(self):
         self.untitles = 0
+
+
+class AsyncSaveExporter(SaveExporter):
+    """
+    SaveExporter writing through an ExportPool, so that the image is encoded
+    once when chained with a TextualInversionExporter writing the same file.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        pool: ExportPool,
+        clear: bool = False,
+        no_meta: bool = False,
+        skip_when_image_exist: bool = False,
+        save_params: Optional[Mapping[str, Any]] = None,
+        ignore_error_when_export: bool = False,
+    ):
+        SaveExporter.__init__(
+            self,
+            output_dir,
+            clear=clear,
+            no_meta=no_meta,
+            skip_when_image_exist=skip_when_image_exist,
+            save_params=save_params,
+            ignore_error_when_export=ignore_error_when_export,
+        )
+        self.pool = pool
+        # Files written for the last exported item
+        self.last_written: list[str] = []
+
+    def export_item(self, item: ImageItem):
+        if "filename" in item.meta:
+            filename = item.meta["filename"]
+        else:
+            self.untitles += 1
+            filename = f"untitled_{self.untitles}.png"
+
+        self.last_written = []
+        full_filename = os.path.join(self.output_dir, filename)
+        if not self.skip_when_image_exist or not os.path.exists(full_filename):
+            self.pool.write_image(full_filename, item.image, self.save_params)
+            self.last_written.append(full_filename)
+
+        meta = exported_meta(item.meta)
+        if not self.no_meta and meta:
+            # Same naming as ImageItem.save
+            directory, image_filename = os.path.split(full_filename)
+            meta_filename = os.path.join(
+                directory, f".{os.path.splitext(image_filename)[0]}_meta.json"
+            )
+            self.pool.write_text(
+                meta_filename, json.dumps(meta, ensure_ascii=False, indent=4)
+            )
+            self.last_written.append(meta_filename)
+
+    def post_export(self):
+        self.flush()
+
+    def flush(self):
+        self.pool.flush()
+
+
+class LocalSaveExporter(SaveExporter):
+    """
+    SaveExporter leaving the pipeline's own meta out of the .json sidecars,
+    and recording the files written for each item for the manifest and the journal.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        clear: bool = False,
+        no_meta: bool = False,
+        skip_when_image_exist: bool = False,
+        save_params: Optional[Mapping[str, Any]] = None,
+        ignore_error_when_export: bool = False,
+    ):
+        SaveExporter.__init__(
+            self,
+            output_dir,
+            clear=clear,
+            no_meta=no_meta,
+            skip_when_image_exist=skip_when_image_exist,
+            save_params=save_params,
+            ignore_error_when_export=ignore_error_when_export,
+        )
+        # Files written for the last exported item
+        self.last_written: list[str] = []
+
+    def export_item(self, item: ImageItem):
+        meta = exported_meta(item.meta)
+        if "filename" not in meta:
+            self.untitles += 1
+            meta["filename"] = f"untitled_{self.untitles}.png"
+
+        full_filename = os.path.join(self.output_dir, meta["filename"])
+        image_exists = self.skip_when_image_exist and os.path.exists(full_filename)
+        SaveExporter.export_item(self, ImageItem(item.image, meta))
+
+        self.last_written = [] if image_exists else [full_filename]
+        if not self.no_meta:
+            # Same naming as ImageItem.save
+            directory, image_filename = os.path.split(full_filename)
+            self.last_written.append(
+                os.path.join(directory, f".{os.path.splitext(image_filename)[0]}_meta.json")
+            )
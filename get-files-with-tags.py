@@ -1,28 +1,43 @@
 import argparse
+import json
+import logging
 import os
+import sys
 from waifuc.source import LocalSource
 from waifuc.action import (
     TagFilterAction,
     TagRemoveUnderlineAction,
-    TaggingAction,
 )
 
-from actions import TagFilterAnyOfAction
+from actions import BatchedTaggingAction, TagFilterAnyOfAction
 from exporters import FileNameExporter
+from score_matrix import ScoreMatrixWriter
+from sources import LocalFilesSource, list_image_files
+from tag_cache import DEFAULT_TAG_CACHE_MAX_SIZE_MB, DEFAULT_TAG_CACHE_PATH, TagCache
+from tag_index import TagIndex, TagIndexExporter, build_query, parse_query
 from tqdm import tqdm
 from functools import partialmethod
 
 tqdm.__init__ = partialmethod(tqdm.__init__, disable=True)
 
-# Example:
+# Examples:
 # python .\get-files-with-tags.py --input "T:\..." --recursive --tag-all-of "green hair" "1girl" | % { Copy-Item -LiteralPath $_ -Destination "T:\..." }
+# python .\get-files-with-tags.py --input "T:\..." --tag-any-of "green hair" --format ndjson `
+#   | ConvertFrom-Json | ? { $_.tags."green hair" -gt 0.8 }
+# python .\get-files-with-tags.py --input "T:\..." --recursive --index "T:\...\tags.sqlite3" --build-index
+# python .\get-files-with-tags.py --index "T:\...\tags.sqlite3" `
+#   --query "(green hair>0.8 | blue hair) & 1girl & !monochrome"
 
 parser = argparse.ArgumentParser(
     prog="Lora training script",
     description="Takes care of extracting, tagging, and deduplicating character images from video files",
 )
 
-parser.add_argument("--input", dest="input", required=True)
+parser.add_argument(
+    "--input",
+    dest="input",
+    help="Directory of the images, required unless --query is answered from --index",
+)
 parser.add_argument(
     "--recursive",
     dest="recursive",
@@ -52,14 +67,87 @@ parser.add_argument(
     "--tag-confidence",
     dest="tag_confidence",
     help="Confidence threshold for tag filtering in the range [0-1]",
+    type=float,
     default=0.6,
 )
+parser.add_argument(
+    "--index",
+    dest="index",
+    help="Path of a tag index, queries are answered from the index without running the tagger",
+)
+parser.add_argument(
+    "--build-index",
+    dest="build_index",
+    action="store_true",
+    help="Tag the new and modified images of --input and store their tags in --index, "
+    "only tags scored above 0.35 are indexed",
+    default=False,
+)
+parser.add_argument(
+    "--query",
+    dest="query",
+    help="Boolean tag expression evaluated against --index, e.g. "
+    '"(green hair>0.8 | blue hair) & 1girl & !monochrome", '
+    "tags without threshold use --tag-confidence",
+)
 parser.add_argument(
     "--min-size",
     dest="min_size",
     help="Minimum image size (for both width and height)",
     default=480,
 )
+parser.add_argument(
+    "--tag-cache",
+    dest="tag_cache",
+    help="Path of the persistent tag cache (keyed by image content, tagger model and thresholds)",
+    default=DEFAULT_TAG_CACHE_PATH,
+)
+parser.add_argument(
+    "--tag-cache-size",
+    dest="tag_cache_size",
+    help="Maximum size of the tag cache in MB, least recently used entries are evicted first",
+    type=float,
+    default=DEFAULT_TAG_CACHE_MAX_SIZE_MB,
+)
+parser.add_argument(
+    "--tag-batch-size",
+    dest="tag_batch_size",
+    help="Number of images to tag per model call",
+    type=int,
+    default=16,
+)
+parser.add_argument(
+    "--tag-flush-timeout",
+    dest="tag_flush_timeout",
+    help="Tag a partial batch once its oldest image has waited for this many seconds",
+    type=float,
+)
+parser.add_argument(
+    "--score-matrix",
+    dest="score_matrix",
+    help="Directory where the raw tagger scores of every image are recorded, see query-scores.py",
+)
+parser.add_argument(
+    "--no-tag-cache",
+    dest="no_tag_cache",
+    action="store_true",
+    help="Always run the tagger instead of reading from/writing to the tag cache",
+    default=False,
+)
+parser.add_argument(
+    "--format",
+    dest="format",
+    help="Print matching paths, or NDJSON records with the path and the scores of the matched tags",
+    choices=["path", "ndjson"],
+    default="path",
+)
+parser.add_argument(
+    "--flush-every",
+    dest="flush_every",
+    help="Flush the output every this many matches, and at most one second after a match",
+    type=int,
+    default=16,
+)
 args = parser.parse_args()
 
 min_size: int = args.min_size
@@ -69,30 +157,99 @@ tag_any_of: list[str] = args.tag_any_of
 tag_all_of: list[str] = args.tag_all_of
 tag_none_of: list[str] = args.tag_none_of
 tag_confidence: float = args.tag_confidence
+tag_cache_path: str = args.tag_cache
+tag_cache_size: float = args.tag_cache_size
+no_tag_cache: bool = args.no_tag_cache
+score_matrix_path: str = args.score_matrix
+tag_batch_size: int = args.tag_batch_size
+tag_flush_timeout: float = args.tag_flush_timeout
+output_format: str = args.format
+flush_every: int = args.flush_every
+index_path: str = args.index
+build_index: bool = args.build_index
+query: str = args.query
+
+if (build_index or query) and not index_path:
+    parser.error("--build-index and --query require --index")
+if not input and not (index_path and not build_index):
+    parser.error("--input is required unless --query is answered from --index")
+
+
+def query_index(index: TagIndex):
+    expression = (
+        parse_query(query)
+        if query
+        else build_query(tag_all_of or [], tag_any_of or [], tag_none_of or [])
+    )
+    if expression is None:
+        parser.error("--query or a --tag-*-of option is required with --index")
+
+    paths = index.query(expression, tag_confidence)
+    if input:
+        # Only report images under --input
+        directory = os.path.join(os.path.abspath(input), "")
+        paths = [path for path in paths if path.startswith(directory)]
+    tags = list(dict.fromkeys(tag.replace("_", " ") for tag in expression.tags()))
+    for path in paths:
+        if output_format == "path":
+            print(path)
+        else:
+            print(json.dumps({"path": path, "tags": index.scores(path, tags)}))
+    sys.stdout.flush()
+
 
 if __name__ == "__main__":
-    if os.path.isdir(input):
-        source = LocalSource(input)
-    else:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    tag_cache = (
+        None if no_tag_cache else TagCache(tag_cache_path, max_size_mb=tag_cache_size)
+    )
+
+    index = TagIndex(index_path) if index_path else None
+    if index is not None and not build_index:
+        query_index(index)
+        sys.exit(0)
+
+    if not os.path.isdir(input):
         raise Exception("Input is not a directory")
+    if index is not None:
+        files = list_image_files(input, recursive)
+        index.prune(input)
+        files = index.changed_files(files)
+        logging.info(f"Indexing {len(files)} new or modified images")
+        source = LocalFilesSource(input, files)
+    else:
+        source = LocalSource(input)
 
     source = source.attach(
         # Tag images
-        TaggingAction(
+        BatchedTaggingAction(
             method="wd14_v3_swinv2",
             force=True,
             general_threshold=0.35,
             character_threshold=2,  # don't add character tags, e.g. "shimakaze \(kancolle\)"
             drop_overlap=True,  # drop overlapping tags
+            cache=tag_cache,
+            batch_size=tag_batch_size,
+            flush_timeout=tag_flush_timeout,
+            score_matrix=(
+                ScoreMatrixWriter(score_matrix_path) if score_matrix_path else None
+            ),
         ),
         # Remove underlines from tags
         TagRemoveUnderlineAction(),
     )
 
+    if index is not None:
+        source.export(TagIndexExporter(index))
+        index.close()
+        sys.exit(0)
+
     if tag_any_of:
         source = source.attach(
             TagFilterAnyOfAction(
-                {tag.replace("_", " "): tag_confidence for tag in tag_any_of}
+                {tag.replace("_", " "): tag_confidence for tag in tag_any_of},
+                cache=tag_cache,
             )
         )
 
@@ -111,5 +268,11 @@ if __name__ == "__main__":
             )
         )
 
-    exporter = FileNameExporter()
+    # Report the scores of the queried tags, or of every tag if none was given
+    query_tags = [
+        tag.replace("_", " ") for tag in (tag_any_of or []) + (tag_all_of or [])
+    ]
+    exporter = FileNameExporter(
+        output_format, query_tags or None, flush_every=flush_every
+    )
     source.export(exporter)
\ No newline at end of file
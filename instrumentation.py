@@ -0,0 +1,336 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Iterable, Iterator, Optional
+from waifuc.action import BaseAction
+from waifuc.export import BaseExporter
+from waifuc.model import ImageItem
+from waifuc.source import BaseDataSource
+
+from exporters import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def current_rss() -> int:
+    """
+    Resident set size of the current process in bytes, 0 when it can't be read.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current RSS, reported in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class StageStats:
+    name: str
+    kind: str
+    wall_time: float = 0
+    items_in: int = 0
+    items_out: int = 0
+    peak_rss: int = 0
+    bytes_written: int = 0
+
+    @property
+    def drop_rate(self) -> float:
+        return 1 - self.items_out / self.items_in if self.items_in else 0
+
+    def sample_rss(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    def merge(self, other: "StageStats"):
+        self.wall_time += other.wall_time
+        self.items_in += other.items_in
+        self.items_out += other.items_out
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+        self.bytes_written += other.bytes_written
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "drop_rate": self.drop_rate}
+
+
+class PipelineStats:
+    """
+    Per-stage statistics of a pipeline run: wall time spent in each action
+    (excluding the stages before it), items in and out, drop rate and the peak
+    RSS observed while the stage was running.
+
+    Reports are written as JSON and in the Prometheus text format, at the end
+    of the run and every snapshot_interval seconds while it runs. Without a
+    path, e.g. in worker processes, statistics are only collected.
+    """
+
+    def __init__(self, path: Optional[str], snapshot_interval: float = 60):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.stages: dict[str, StageStats] = {}
+        self.source_stats: Optional[StageStats] = None
+        self.start = time.perf_counter()
+        self._last_snapshot = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def prometheus_path(self) -> str:
+        return os.path.splitext(self.path)[0] + ".prom"
+
+    def stage(self, name: str, kind: str) -> StageStats:
+        # The same action class can be attached several times, e.g. TagFilterAction
+        unique_name = name
+        index = 2
+        while unique_name in self.stages:
+            unique_name = f"{name}#{index}"
+            index += 1
+        stats = StageStats(unique_name, kind)
+        self.stages[unique_name] = stats
+        return stats
+
+    def attach(self, source: BaseDataSource, *actions: BaseAction) -> BaseDataSource:
+        # Time spent pulling items into the first action is the time spent in the source
+        source_stats = None
+        if self.source_stats is None:
+            source_stats = self.stage(type(source).__name__, "source")
+            self.source_stats = source_stats
+        return source.attach(
+            *(
+                InstrumentedAction(
+                    action,
+                    self.stage(type(action).__name__, "action"),
+                    source_stats if i == 0 else None,
+                )
+                for i, action in enumerate(actions)
+            )
+        )
+
+    def instrument_exporter(self, exporter: BaseExporter) -> BaseExporter:
+        return InstrumentedExporter(
+            exporter, self.stage(type(exporter).__name__, "exporter"), self
+        )
+
+    def merge(self, report: dict):
+        # Merges the report of a worker process, stages are matched by name
+        with self._lock:
+            for stage in report["stages"]:
+                stats = self.stages.get(stage["name"])
+                if stats is None:
+                    stats = self.stages[stage["name"]] = StageStats(
+                        stage["name"], stage["kind"]
+                    )
+                stats.merge(
+                    StageStats(
+                        stage["name"],
+                        stage["kind"],
+                        stage["wall_time"],
+                        stage["items_in"],
+                        stage["items_out"],
+                        stage["peak_rss"],
+                        stage.get("bytes_written", 0),
+                    )
+                )
+
+    def to_dict(self) -> dict:
+        return {
+            "elapsed": time.perf_counter() - self.start,
+            "stages": [stats.to_dict() for stats in self.stages.values()],
+        }
+
+    def to_prometheus(self) -> str:
+        # (metric, type, help, StageStats field)
+        metrics = [
+            ("stage_seconds_total", "counter", "Wall time spent in the stage", "wall_time"),
+            ("stage_items_in_total", "counter", "Items received by the stage", "items_in"),
+            ("stage_items_out_total", "counter", "Items emitted by the stage", "items_out"),
+            ("stage_drop_ratio", "gauge", "Ratio of items dropped", "drop_rate"),
+            ("stage_peak_rss_bytes", "gauge", "Peak RSS while running", "peak_rss"),
+            ("stage_written_bytes_total", "counter", "Bytes of files written", "bytes_written"),
+        ]
+        lines = []
+        for metric, metric_type, description, field in metrics:
+            lines.append(f"# HELP sd_pipeline_{metric} {description}")
+            lines.append(f"# TYPE sd_pipeline_{metric} {metric_type}")
+            for stats in self.stages.values():
+                name = stats.name.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(
+                    f'sd_pipeline_{metric}{{stage="{name}",kind="{stats.kind}"}} '
+                    f"{getattr(stats, field)}"
+                )
+        lines.append("# HELP sd_pipeline_elapsed_seconds Wall time of the whole run")
+        lines.append("# TYPE sd_pipeline_elapsed_seconds gauge")
+        lines.append(f"sd_pipeline_elapsed_seconds {time.perf_counter() - self.start}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with self._lock:
+            report = self.to_dict()
+            prometheus = self.to_prometheus()
+            self._last_snapshot = time.monotonic()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_file_atomic(self.path, json.dumps(report, indent=2).encode("utf-8"))
+        write_file_atomic(self.prometheus_path, prometheus.encode("utf-8"))
+
+    def maybe_snapshot(self):
+        if self.path is not None and time.monotonic() - self._last_snapshot >= self.snapshot_interval:
+            self.write()
+
+    def log_summary(self):
+        elapsed = time.perf_counter() - self.start
+        for stats in self.stages.values():
+            logger.info(
+                f"{stats.kind} {stats.name}: {stats.wall_time:.1f}s "
+                f"({stats.wall_time / elapsed if elapsed else 0:.0%}), "
+                f"{stats.items_in} in, {stats.items_out} out ({stats.drop_rate:.0%} dropped), "
+                f"peak RSS {stats.peak_rss / 1024 / 1024:.0f}MB"
+                + (
+                    f", {stats.bytes_written / 1024 / 1024:.1f}MB written"
+                    if stats.kind == "exporter"
+                    else ""
+                )
+            )
+        logger.info(f"Wrote pipeline stats to {self.path} and {self.prometheus_path}")
+
+
+class InstrumentedAction(BaseAction):
+    """
+    Wraps an action and measures the time spent in it. The time spent waiting
+    for upstream items is subtracted, and attributed to source_stats if given.
+    """
+
+    def __init__(
+        self,
+        action: BaseAction,
+        stats: StageStats,
+        source_stats: Optional[StageStats] = None,
+    ):
+        self.action = action
+        self.stats = stats
+        self.source_stats = source_stats
+        self._upstream_time = 0.0
+
+    def _pull(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        iterator = iter(iter_)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                self._upstream_time += elapsed
+                if self.source_stats is not None:
+                    self.source_stats.wall_time += elapsed
+            self.stats.items_in += 1
+            if self.source_stats is not None:
+                self.source_stats.items_in += 1
+                self.source_stats.items_out += 1
+                self.source_stats.sample_rss()
+            yield item
+
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        iterator = iter(self.action.iter_from(self._pull(iter_)))
+        while True:
+            upstream_before = self._upstream_time
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                # Actions reading upstream from another thread can overlap with it
+                self.stats.wall_time += max(
+                    0.0,
+                    time.perf_counter() - start - (self._upstream_time - upstream_before),
+                )
+                self.stats.sample_rss()
+            self.stats.items_out += 1
+            yield item
+
+    def iter(self, item: ImageItem) -> Iterator[ImageItem]:
+        yield from self.action.iter(item)
+
+    def reset(self):
+        self.action.reset()
+
+
+class InstrumentedExporter(BaseExporter):
+    """
+    Wraps an exporter and measures the time spent exporting, including
+    pending writes flushed at the end of the export, and the size of the files
+    it wrote.
+    """
+
+    def __init__(
+        self,
+        exporter: BaseExporter,
+        stats: StageStats,
+        pipeline: PipelineStats,
+        ignore_error_when_export: bool = False,
+    ):
+        BaseExporter.__init__(self, ignore_error_when_export)
+        self.exporter = exporter
+        self.stats = stats
+        self.pipeline = pipeline
+        self._written: list[str] = []
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.stats.wall_time += time.perf_counter() - start
+            self.stats.sample_rss()
+
+    def pre_export(self):
+        self._timed(self.exporter.pre_export)
+
+    def post_export(self):
+        self._timed(self.exporter.post_export)
+        # Sizes are only read once asynchronous writes are done
+        self.stats.bytes_written += sum(
+            os.path.getsize(path) for path in set(self._written) if os.path.exists(path)
+        )
+        self._written = []
+
+    def export_item(self, item: ImageItem):
+        self.stats.items_in += 1
+        self._timed(self.exporter.export_item, item)
+        self.stats.items_out += 1
+        self._written.extend(self.last_written)
+        self.pipeline.maybe_snapshot()
+
+    def flush(self):
+        flush = getattr(self.exporter, "flush", None)
+        if flush is not None:
+            self._timed(flush)
+
+    @property
+    def last_written(self) -> list[str]:
+        return getattr(self.exporter, "last_written", [])
+
+    def reset(self):
+        self.exporter.reset()
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same stats
+        return InstrumentedExporter(
+            self.exporter, self.stats, self.pipeline, self.ignore_error_when_export
+        )
@@ -0,0 +1,226 @@
+import logging
+import os
+import sqlite3
+from collections import deque
+from typing import Iterable, Iterator, Optional
+from waifuc.action import BaseAction
+from waifuc.export import BaseExporter
+from waifuc.model import ImageItem
+
+logger = logging.getLogger(__name__)
+
+VIDEO_DONE = -1.0
+
+
+class ProcessingJournal:
+    """
+    Record of the source images and video frames that went through the whole
+    pipeline (exported or dropped by a filter), so that an interrupted run can
+    skip them when resumed.
+
+    Sources register items in order through JournalStartAction. Since every
+    action preserves order, an exported item proves that all the source items
+    registered before it are done. Completed items are kept in memory and only
+    written by checkpoint(), in one short transaction, so that worker
+    processes sharing the journal never wait on each other's writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: deque[tuple[str, Optional[float]]] = deque()
+        self._completed_files: Optional[set[str]] = None
+        self._video_times: Optional[dict[str, float]] = None
+        # Completed since the last checkpoint
+        self._files_to_write: list[str] = []
+        self._videos_to_write: dict[str, float] = {}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS videos "
+                "(path TEXT PRIMARY KEY, time REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _load(self):
+        if self._completed_files is None:
+            self._completed_files = {
+                path for (path,) in self.conn.execute("SELECT path FROM files")
+            }
+            self._video_times = dict(
+                self.conn.execute("SELECT path, time FROM videos").fetchall()
+            )
+
+    def is_file_completed(self, path: str) -> bool:
+        self._load()
+        return os.path.abspath(path) in self._completed_files
+
+    def is_video_completed(self, path: str) -> bool:
+        self._load()
+        return self._video_times.get(os.path.abspath(path)) == VIDEO_DONE
+
+    def video_resume_time(self, path: str) -> Optional[float]:
+        # Time of the last frame known to be done, frames up to it can be skipped
+        self._load()
+        time = self._video_times.get(os.path.abspath(path))
+        return None if time is None or time == VIDEO_DONE else time
+
+    def started(self, path: str, time: Optional[float] = None):
+        entry = (os.path.abspath(path), time)
+        if not self._pending or self._pending[-1] != entry:
+            self._pending.append(entry)
+
+    def reached(self, path: str, time: Optional[float] = None):
+        # Everything registered before this item is done, the item itself may still have more outputs
+        entry = (os.path.abspath(path), time)
+        if entry not in self._pending:
+            return
+        while self._pending and self._pending[0] != entry:
+            self._complete(*self._pending.popleft())
+
+    def finish(self):
+        while self._pending:
+            self._complete(*self._pending.popleft())
+        self.checkpoint()
+
+    def _complete(self, path: str, time: Optional[float]):
+        self._load()
+        if time is None:
+            self._completed_files.add(path)
+            self._files_to_write.append(path)
+        else:
+            if self._video_times.get(path) == VIDEO_DONE:
+                return
+            self._video_times[path] = time
+            self._videos_to_write[path] = time
+
+    def checkpoint(self):
+        if not self._files_to_write and not self._videos_to_write:
+            return
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO files (path) VALUES (?)",
+            [(path,) for path in self._files_to_write],
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO videos (path, time) VALUES (?, ?)",
+            self._videos_to_write.items(),
+        )
+        self.conn.commit()
+        self._files_to_write = []
+        self._videos_to_write = {}
+
+    def close(self):
+        if self._conn is not None:
+            self.checkpoint()
+            self._conn.close()
+            self._conn = None
+
+
+def _item_position(item: ImageItem) -> Optional[tuple[str, Optional[float]]]:
+    # Images extracted from a video keep its video and time in their sidecar, the file itself is what was read
+    if "path" in item.meta:
+        return item.meta["path"], None
+    if "video" in item.meta:
+        return item.meta["video"], float(item.meta.get("time") or 0)
+    return None
+
+
+class JournalStartAction(BaseAction):
+    """
+    Registers source items in the journal, must be attached right after the source.
+    """
+
+    def __init__(self, journal: ProcessingJournal):
+        self.journal = journal
+
+    def iter_from(self, iter_: Iterable[ImageItem]) -> Iterator[ImageItem]:
+        current_video = None
+        for item in iter_:
+            position = _item_position(item)
+            if position is not None:
+                path, time = position
+                if current_video is not None and current_video != path:
+                    self.journal.started(current_video, VIDEO_DONE)
+                current_video = path if time is not None else None
+                self.journal.started(path, time)
+            yield item
+        if current_video is not None:
+            self.journal.started(current_video, VIDEO_DONE)
+
+    def iter(self, item: ImageItem) -> Iterator[ImageItem]:
+        yield item
+
+    def reset(self):
+        pass
+
+
+class JournalExporter(BaseExporter):
+    """
+    Wraps an exporter and records progress in the journal. Progress is only
+    committed after the wrapped exporter has flushed its pending writes, so the
+    journal never gets ahead of the files on disk.
+    """
+
+    def __init__(
+        self,
+        exporter: BaseExporter,
+        journal: ProcessingJournal,
+        checkpoint_every: int = 50,
+        ignore_error_when_export: bool = False,
+    ):
+        BaseExporter.__init__(self, ignore_error_when_export)
+        self.exporter = exporter
+        self.journal = journal
+        self.checkpoint_every = checkpoint_every
+        self._exported = 0
+
+    def pre_export(self):
+        self.exporter.pre_export()
+
+    def post_export(self):
+        self.exporter.post_export()
+        self.journal.finish()
+
+    def export_item(self, item: ImageItem):
+        self.exporter.export_item(item)
+        position = _item_position(item)
+        if position is not None:
+            self.journal.reached(*position)
+
+        self._exported += 1
+        if self._exported % self.checkpoint_every == 0:
+            self.flush()
+            self.journal.checkpoint()
+
+    def flush(self):
+        flush = getattr(self.exporter, "flush", None)
+        if flush is not None:
+            flush()
+
+    @property
+    def last_written(self) -> list[str]:
+        return getattr(self.exporter, "last_written", [])
+
+    def reset(self):
+        self.exporter.reset()
+        self._exported = 0
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same journal
+        return JournalExporter(
+            self.exporter,
+            self.journal,
+            self.checkpoint_every,
+            self.ignore_error_when_export,
+        )
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Iterable, List, Optional
+from waifuc.export import BaseExporter
+from waifuc.model import ImageItem
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileManifest:
+    """
+    Manifest of the source files processed by previous runs, with their size,
+    mtime, content hash, the fingerprint of the pipeline configuration and the
+    output files written for them.
+
+    Files are compared by size and mtime first and only hashed when those
+    changed, so checking an unchanged dataset costs one stat per file.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "hash TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "outputs TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def changed_files(self, files: Iterable[str]) -> List[str]:
+        rows = {
+            row[0]: row[1:]
+            for row in self.conn.execute(
+                "SELECT path, size, mtime_ns, hash, fingerprint FROM files"
+            )
+        }
+        changed = []
+        touched = []
+        for file in files:
+            path = os.path.abspath(file)
+            row = rows.get(path)
+            if row is None:
+                changed.append(file)
+                continue
+
+            size, mtime_ns, content_hash, fingerprint = row
+            stat = os.stat(path)
+            if fingerprint != self.fingerprint:
+                changed.append(file)
+            elif stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                continue
+            elif stat.st_size == size and hash_file(path) == content_hash:
+                # Only the mtime changed, e.g. the file was copied or touched
+                touched.append((stat.st_mtime_ns, path))
+            else:
+                changed.append(file)
+
+        if touched:
+            self.conn.executemany(
+                "UPDATE files SET mtime_ns = ? WHERE path = ?", touched
+            )
+            self.conn.commit()
+        return changed
+
+    def prune_deleted(self, files: Iterable[str]) -> int:
+        """
+        Deletes the outputs recorded for source files that no longer exist.
+        Current source files are never deleted, even if recorded as outputs.
+        """
+        current = {os.path.abspath(file) for file in files}
+        deleted = [
+            (path, json.loads(outputs))
+            for path, outputs in self.conn.execute("SELECT path, outputs FROM files")
+            if path not in current and not os.path.exists(path)
+        ]
+        removed = 0
+        for path, outputs in deleted:
+            for output in outputs:
+                if output not in current and os.path.exists(output):
+                    os.remove(output)
+                    removed += 1
+        self.conn.executemany(
+            "DELETE FROM files WHERE path = ?", [(path,) for path, _ in deleted]
+        )
+        self.conn.commit()
+        if deleted:
+            logger.info(
+                f"Pruned {removed} output files of {len(deleted)} deleted source files"
+            )
+        return removed
+
+    def record(self, files: Iterable[str], outputs: dict[str, set[str]]):
+        previous = dict(self.conn.execute("SELECT path, outputs FROM files"))
+        rows = []
+        for file in files:
+            path = os.path.abspath(file)
+            if not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            # Keep outputs of previous runs, e.g. images skipped because they already existed
+            file_outputs = set(json.loads(previous.get(path, "[]")))
+            file_outputs.update(outputs.get(path, ()))
+            rows.append(
+                (
+                    path,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    hash_file(path),
+                    self.fingerprint,
+                    json.dumps(sorted(file_outputs)),
+                )
+            )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO files "
+            "(path, size, mtime_ns, hash, fingerprint, outputs) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ManifestExporter(BaseExporter):
+    """
+    Wraps an exporter, collects the files it writes for each source file and
+    records the processed source files in the manifest once the export completed.
+    """
+
+    def __init__(
+        self,
+        exporter: BaseExporter,
+        manifest: FileManifest,
+        files: List[str],
+        ignore_error_when_export: bool = False,
+    ):
+        BaseExporter.__init__(self, ignore_error_when_export)
+        self.exporter = exporter
+        self.manifest = manifest
+        self.files = files
+        self.outputs: dict[str, set[str]] = defaultdict(set)
+
+    def pre_export(self):
+        self.exporter.pre_export()
+
+    def post_export(self):
+        self.exporter.post_export()
+        self.manifest.record(self.files, self.outputs)
+        logger.info(f"Recorded {len(self.files)} source files in the manifest")
+
+    def export_item(self, item: ImageItem):
+        self.exporter.export_item(item)
+        source = item.meta.get("video") or item.meta.get("path")
+        if source:
+            self.outputs[os.path.abspath(source)].update(
+                os.path.abspath(path)
+                for path in getattr(self.exporter, "last_written", [])
+            )
+
+    def flush(self):
+        flush = getattr(self.exporter, "flush", None)
+        if flush is not None:
+            flush()
+
+    def reset(self):
+        self.exporter.reset()
+        self.outputs = defaultdict(set)
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__
+        # to reuse the same manifest
+        return ManifestExporter(
+            self.exporter, self.manifest, self.files, self.ignore_error_when_export
+        )
@@ -0,0 +1,78 @@
+import argparse
+import logging
+import os
+import time
+
+from caption_store import CAPTION_STORE_FILENAME, CaptionStore, materialize_captions
+
+# Examples:
+# python .\process.py --input-type video --input "T:\..." --output "T:\...\dataset" --output-meta store
+# python .\materialize-captions.py --output "T:\...\dataset"
+# python .\materialize-captions.py --output "T:\...\dataset" --tag-counts
+
+parser = argparse.ArgumentParser(
+    prog="materialize-captions",
+    description="Writes the .txt caption of every image recorded in a caption store (process.py --output-meta store)",
+)
+parser.add_argument(
+    "--output",
+    dest="output",
+    help="Folder of the images, captions are written next to them",
+    required=True,
+)
+parser.add_argument(
+    "--caption-store",
+    dest="caption_store",
+    help="Path of the caption store (defaults to captions.sqlite3 in the output folder)",
+)
+parser.add_argument(
+    "--include-score",
+    dest="include_score",
+    action="store_true",
+    help="Include tag scores in the captions, e.g. (1girl:0.998)",
+    default=False,
+)
+parser.add_argument(
+    "--threads",
+    dest="threads",
+    help="Number of threads writing captions",
+    type=int,
+    default=8,
+)
+parser.add_argument(
+    "--tag-counts",
+    dest="tag_counts",
+    action="store_true",
+    help="Print the number of images per tag instead of writing captions",
+    default=False,
+)
+args = parser.parse_args()
+
+output: str = args.output
+caption_store_path: str = args.caption_store or os.path.join(
+    output, CAPTION_STORE_FILENAME
+)
+include_score: bool = args.include_score
+threads: int = args.threads
+tag_counts: bool = args.tag_counts
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not os.path.exists(caption_store_path):
+        raise Exception(f"Caption store {caption_store_path} does not exist")
+    store = CaptionStore(caption_store_path)
+
+    if tag_counts:
+        for tag, count in store.tag_counts().items():
+            print(f"{count}\t{tag}")
+    else:
+        start = time.perf_counter()
+        written, unchanged = materialize_captions(
+            store, output, include_score=include_score, threads=threads
+        )
+        logging.info(
+            f"Wrote {written} captions, {unchanged} unchanged, "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+    store.close()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+from dotenv import load_dotenv
+import runpod
+from rich.logging import RichHandler
+
+from pod_orchestrator import (
+    MockRunpodApi,
+    PodLostError,
+    PodOrchestrator,
+    PodTemplate,
+    RunpodApi,
+    TrainingJob,
+    get_ssh_port,
+)
+from pod_sync import PodSync
+from remote_shell import SshShell, to_local_path
+from training_log import TrainingLogTailer, format_progress
+
+# Trains every backend_input.json found in --input, on several pods at once.
+# Example usage
+# python .\orchestrate-runpod.py --pods 3 --use-wsl --input "/mnt/t/stablediffusion/training/transfer" `
+#   --rsync-to "/mnt/t/stablediffusion/training/output"
+# Dry run against fake pods:
+# python .\orchestrate-runpod.py --simulate --simulate-jobs 15 --pods 3
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    prog="orchestrate-runpod",
+    description="Trains a queue of LoRA configs on several pods on runpod.io",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--input",
+    dest="input",
+    help="Local folder transferred to every pod, every backend_input.json it contains is a training job",
+)
+parser.add_argument("--pods", dest="pods", help="Maximum number of pods", default="2")
+parser.add_argument(
+    "--pod-name",
+    dest="pod_name",
+    help="Prefix of the names of the pods, followed by the index of the pod",
+    default="ht-lora-easy-training-scripts",
+)
+parser.add_argument("--password", dest="password", help="VNC password to use", default="password")
+parser.add_argument(
+    "--image-name",
+    dest="image_name",
+    help="Container image name to use",
+    default="happytentacle/ht-runpod-lora-easy-training-scripts:preinstalled-0.3",
+)
+parser.add_argument("--gpu", dest="gpu", help="GPU id to use", default="NVIDIA RTX 6000 Ada Generation")
+parser.add_argument(
+    "--checkpoint-url",
+    dest="checkpoint_url",
+    help="Url of checkpoint to download on pod startup",
+)
+parser.add_argument(
+    "--ssh-key", dest="ssh_key", help="Path to public SSH key", default="~/.ssh/id_ed25519"
+)
+parser.add_argument(
+    "--use-wsl",
+    dest="use_wsl",
+    action="store_true",
+    help="Use WSL to run ssh and rsync",
+    default=False,
+)
+parser.add_argument(
+    "--rsync-to",
+    dest="rsync_to",
+    help="Copy the pod files to a subfolder of this local folder named after the pod after each job",
+)
+parser.add_argument(
+    "--keep-pods",
+    dest="keep_pods",
+    action="store_true",
+    help="Keep pods running once the queue is drained",
+    default=False,
+)
+parser.add_argument(
+    "--no-reuse",
+    dest="no_reuse",
+    action="store_true",
+    help="Always create new pods instead of reusing existing pods of the same name",
+    default=False,
+)
+parser.add_argument(
+    "--iter-sec",
+    dest="iter_sec",
+    help="Wait for X seconds between status checks of each pod",
+    default="10",
+)
+parser.add_argument(
+    "--max-attempts",
+    dest="max_attempts",
+    help="Number of times a job is tried when its pod is lost",
+    default="2",
+)
+parser.add_argument(
+    "--simulate",
+    dest="simulate",
+    action="store_true",
+    help="Run against fake pods and training backends on localhost instead of runpod.io",
+    default=False,
+)
+parser.add_argument(
+    "--simulate-jobs",
+    dest="simulate_jobs",
+    help="With --simulate and no --input, number of generated jobs",
+    default="15",
+)
+parser.add_argument(
+    "--simulate-duration",
+    dest="simulate_duration",
+    help="With --simulate, seconds each fake training takes",
+    default="3",
+)
+
+args = parser.parse_args()
+
+input_dir: str = args.input
+pod_count: int = int(args.pods)
+pod_name: str = args.pod_name
+password: str = args.password
+image_name: str = args.image_name
+gpu: str = args.gpu
+checkpoint_url: str = args.checkpoint_url
+ssh_key: str = args.ssh_key
+use_wsl: bool = args.use_wsl
+rsync_to: str = args.rsync_to
+keep_pods: bool = args.keep_pods
+reuse_existing: bool = not args.no_reuse
+iter_sec: float = float(args.iter_sec)
+max_attempts: int = int(args.max_attempts)
+simulate: bool = args.simulate
+simulate_jobs: int = int(args.simulate_jobs)
+simulate_duration: float = float(args.simulate_duration)
+
+load_dotenv()
+
+runpod.api_key = os.getenv("RUNPOD_API_KEY")
+
+command_prefix = "wsl " if use_wsl else ""
+
+REMOTE_TRAINING_DIR = "/home/ht/training"
+
+shells: dict[str, SshShell] = {}
+training_logs: dict[str, TrainingLogTailer] = {}
+pod_syncs: dict[str, PodSync] = {}
+
+
+def find_jobs(directory: str) -> list[TrainingJob]:
+    jobs = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        if "backend_input.json" in filenames:
+            name = os.path.relpath(root, directory).replace(os.sep, "/")
+            jobs.append(TrainingJob(name, os.path.join(root, "backend_input.json")))
+    return jobs
+
+
+def generate_jobs(directory: str, count: int) -> list[TrainingJob]:
+    jobs = []
+    for i in range(count):
+        path = os.path.join(directory, f"job-{i:03}", "backend_input.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"args": {"general_args": {}}}, f)
+        jobs.append(TrainingJob(f"job-{i:03}", path))
+    return jobs
+
+
+def get_shell(pod: dict) -> SshShell:
+    port = get_ssh_port(pod)
+    shell = shells.get(pod["id"])
+    if shell is None or (shell.host, shell.port) != (f"kasm-user@{port['ip']}", port["publicPort"]):
+        shell = SshShell(f"kasm-user@{port['ip']}", port["publicPort"], ssh_key, command_prefix)
+        shells[pod["id"]] = shell
+    return shell
+
+
+async def setup_pod(pod: dict):
+    logger.info(f"Transfering {input_dir} to pod {pod['name']}")
+    shell = get_shell(pod)
+    process = await asyncio.create_subprocess_shell(
+        f"{command_prefix}rsync -azq -e '{shell.rsync_shell()}' "
+        f"{input_dir} {shell.host}:{REMOTE_TRAINING_DIR}/"
+    )
+    if await process.wait() != 0:
+        raise PodLostError(f"Failed to transfer files to pod {pod['name']}")
+
+
+async def print_progress(pod: dict, job: TrainingJob):
+    training_log = training_logs.get(pod["id"])
+    if training_log is None:
+        training_log = TrainingLogTailer(get_shell(pod))
+        training_logs[pod["id"]] = training_log
+    training_log.shell = get_shell(pod)
+    metrics = await asyncio.to_thread(training_log.poll)
+    if metrics is not None and (metrics.epoch is not None or metrics.step is not None):
+        logger.info(f"Job {job.name} on pod {pod['name']} at {format_progress(metrics)}")
+
+
+async def transfer_files_from_pod(pod: dict, job: TrainingJob):
+    pod_sync = pod_syncs.get(pod["id"])
+    if pod_sync is None:
+        pod_sync = PodSync(
+            get_shell(pod),
+            REMOTE_TRAINING_DIR,
+            os.path.join(to_local_path(rsync_to, use_wsl), pod["name"]),
+        )
+        pod_syncs[pod["id"]] = pod_sync
+    pod_sync.shell = get_shell(pod)
+    # The job is over, files written in its last seconds are complete
+    await asyncio.to_thread(pod_sync.sync, final=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        datefmt="%H:%M:%S",
+        handlers=[RichHandler()],
+        force=True,
+    )
+
+    if not input_dir and not simulate:
+        logger.error("--input is required unless using --simulate")
+        exit(1)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if input_dir:
+            jobs = find_jobs(to_local_path(input_dir, use_wsl))
+        else:
+            jobs = generate_jobs(temp_dir, simulate_jobs)
+        if not jobs:
+            logger.error("No training files found")
+            exit(1)
+        logger.info(f"Found {len(jobs)} jobs: {', '.join(job.name for job in jobs)}")
+
+        if simulate:
+            api = MockRunpodApi(boot_delay=iter_sec, training_duration=simulate_duration)
+        else:
+            api = RunpodApi(PodTemplate(image_name, gpu, password, checkpoint_url))
+        orchestrator = PodOrchestrator(
+            api,
+            jobs,
+            pod_count=pod_count,
+            pod_name=pod_name,
+            reuse_existing=reuse_existing,
+            terminate_when_done=not keep_pods,
+            poll_interval=iter_sec,
+            max_attempts=max_attempts,
+            # Fake pods have no SSH
+            setup_pod=setup_pod if input_dir and not simulate else None,
+            on_progress=print_progress if not simulate else None,
+            after_job=transfer_files_from_pod if rsync_to and not simulate else None,
+        )
+        try:
+            asyncio.run(orchestrator.run())
+        finally:
+            for pod_sync in pod_syncs.values():
+                pod_sync.close()
+            for shell in shells.values():
+                shell.close()
+
+    if simulate:
+        logger.info(f"{api.calls} runpod API calls")
+    sys.exit(0 if all(job.status == "done" for job in jobs) else 1)
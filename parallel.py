@@ -0,0 +1,77 @@
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Shard:
+    index: int
+    files: List[str]
+
+
+@dataclass
+class ShardResult:
+    index: int
+    pid: int
+    items_in: int
+    items_out: int
+    elapsed: float
+    # Report of the instrumented pipeline, see PipelineStats.to_dict
+    stats: Optional[dict] = None
+
+
+def run_shards(
+    shards: List[Shard],
+    process_shard: Callable[[Shard], ShardResult],
+    workers: int,
+    on_result: Optional[Callable[[ShardResult], None]] = None,
+) -> List[ShardResult]:
+    """
+    Runs process_shard for every shard in a pool of worker processes and
+    reports throughput per worker. process_shard must be a module-level
+    function so that it can be pickled. on_result is called in the main
+    process as soon as each shard is done.
+    """
+    logger.info(f"Processing {len(shards)} shards with {workers} workers")
+    start = time.perf_counter()
+    results: List[ShardResult] = []
+
+    # Spawn instead of fork so that ONNX sessions and CUDA contexts are never inherited
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        for result in pool.imap_unordered(process_shard, shards):
+            results.append(result)
+            logger.info(
+                f"Shard {result.index + 1}/{len(shards)} done by worker {result.pid}: "
+                f"{result.items_in} in, {result.items_out} out in {result.elapsed:.1f}s"
+            )
+            if on_result is not None:
+                on_result(result)
+
+    elapsed = time.perf_counter() - start
+    by_worker: dict[int, List[ShardResult]] = defaultdict(list)
+    for result in results:
+        by_worker[result.pid].append(result)
+
+    for pid, worker_results in sorted(by_worker.items()):
+        items_in = sum(r.items_in for r in worker_results)
+        items_out = sum(r.items_out for r in worker_results)
+        busy = sum(r.elapsed for r in worker_results)
+        logger.info(
+            f"Worker {pid}: {len(worker_results)} shards, {items_in} in, {items_out} out, "
+            f"{items_in / busy if busy else 0:.2f} items/s"
+        )
+
+    items_in = sum(r.items_in for r in results)
+    items_out = sum(r.items_out for r in results)
+    logger.info(
+        f"Processed {items_in} items ({items_out} exported) in {elapsed:.1f}s, "
+        f"{items_in / elapsed if elapsed else 0:.2f} items/s"
+    )
+
+    return sorted(results, key=lambda r: r.index)
@@ -0,0 +1,454 @@
+import asyncio
+import json
+import logging
+import socket
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Union
+
+import aiohttp
+import runpod
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+TRAINING_PORT = 8000
+# Consecutive failed status checks after which a pod is considered lost
+MAX_STATUS_ERRORS = 6
+
+
+@dataclass
+class TrainingJob:
+    name: str
+    # Local backend_input.json
+    config_path: str
+    status: str = "queued"
+    attempts: int = 0
+    pod_name: Optional[str] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+
+@dataclass
+class PodTemplate:
+    image_name: str
+    gpu: str
+    password: str = "password"
+    checkpoint_url: Optional[str] = None
+    runpodctl_receive: Optional[str] = None
+    runpodctl_unzip: bool = False
+
+
+class PodLostError(Exception):
+    pass
+
+
+class AfterJobError(Exception):
+    # The job trained but its outputs may still only be on the pod
+    pass
+
+
+def get_ssh_port(pod: dict) -> Optional[dict]:
+    runtime = pod.get("runtime") or {}
+    ports = [port for port in runtime.get("ports") or [] if port["privatePort"] == 22]
+    return ports[0] if ports else None
+
+
+class RunpodApi:
+    """
+    Runs the blocking calls of the runpod SDK in threads so that pods are managed concurrently.
+    """
+
+    def __init__(self, template: PodTemplate):
+        self.template = template
+
+    async def get_pods(self) -> list[dict]:
+        return await asyncio.to_thread(runpod.get_pods)
+
+    async def get_pod(self, pod_id: str) -> dict:
+        return await asyncio.to_thread(runpod.get_pod, pod_id)
+
+    async def create_pod(self, name: str) -> dict:
+        # Same pod as start-runpod.py
+        return await asyncio.to_thread(
+            runpod.create_pod,
+            name=name,
+            image_name=self.template.image_name,
+            gpu_type_id=self.template.gpu,
+            volume_in_gb=0,
+            container_disk_in_gb=60,
+            support_public_ip=True,
+            ports=f"6901/http,{TRAINING_PORT}/http,22/tcp",
+            env={
+                "VNC_PW": self.template.password,
+                "HT_RUNPODCTL_RECEIVE": self.template.runpodctl_receive or "",
+                "HT_CHECKPOINT_URL": self.template.checkpoint_url or "",
+                "HT_RUNPODCTL_UNZIP": "True" if self.template.runpodctl_unzip else "False",
+            },
+        )
+
+    async def terminate_pod(self, pod_id: str):
+        await asyncio.to_thread(runpod.terminate_pod, pod_id)
+
+    def training_url(self, pod: dict) -> str:
+        return f"https://{pod['id']}-{TRAINING_PORT}.proxy.runpod.net"
+
+
+class FakeTrainingBackend:
+    """
+    Stand-in for the LoRA_Easy_Training_Scripts backend API of a pod, serves
+    /validate, /train, /is_training and /stop_training on localhost and
+    "trains" every validated config for `duration` seconds.
+    """
+
+    def __init__(self, duration: float = 2.0):
+        self.duration = duration
+        self.config: Optional[dict] = None
+        self.trained: list[dict] = []
+        self.training_until = 0.0
+        self.runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    async def validate(self, request: web.Request) -> web.Response:
+        config = await request.json()
+        if "args" not in config:
+            return web.json_response({"detail": "Missing args"}, status=400)
+        self.config = config
+        return web.json_response({"detail": "Validated"})
+
+    async def train(self, request: web.Request) -> web.Response:
+        if self.config is None or self.is_training():
+            return web.json_response({"detail": "Cannot start training"}, status=400)
+        self.trained.append(self.config)
+        self.config = None
+        self.training_until = time.monotonic() + self.duration
+        return web.json_response({"detail": "Training started"})
+
+    def is_training(self) -> bool:
+        return time.monotonic() < self.training_until
+
+    async def get_is_training(self, request: web.Request) -> web.Response:
+        return web.json_response({"training": self.is_training()})
+
+    async def stop_training(self, request: web.Request) -> web.Response:
+        self.training_until = 0.0
+        return web.json_response({"detail": "Training stopped"})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/validate", self.validate)
+        app.router.add_get("/train", self.train)
+        app.router.add_get("/is_training", self.get_is_training)
+        app.router.add_get("/stop_training", self.stop_training)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(self.runner, sock).start()
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class MockRunpodApi:
+    """
+    Stand-in for RunpodApi keeping pods in memory, each pod boots in
+    `boot_delay` seconds and then serves a FakeTrainingBackend.
+    """
+
+    def __init__(self, boot_delay: float = 1.0, training_duration: float = 2.0):
+        self.boot_delay = boot_delay
+        self.training_duration = training_duration
+        self.pods: dict[str, dict] = {}
+        self.backends: dict[str, FakeTrainingBackend] = {}
+        self.boots: dict[str, asyncio.Task] = {}
+        self.created = 0
+        self.calls = 0
+
+    async def get_pods(self) -> list[dict]:
+        self.calls += 1
+        return [self.describe(pod_id) for pod_id in self.pods]
+
+    async def get_pod(self, pod_id: str) -> dict:
+        self.calls += 1
+        return self.describe(pod_id)
+
+    def describe(self, pod_id: str) -> dict:
+        pod = dict(self.pods[pod_id])
+        backend = self.backends.get(pod_id)
+        if backend is not None and backend.url:
+            pod["runtime"] = {
+                "ports": [
+                    {"ip": "127.0.0.1", "privatePort": 22, "publicPort": 22, "type": "tcp"}
+                ]
+            }
+        return pod
+
+    async def create_pod(self, name: str) -> dict:
+        self.calls += 1
+        pod_id = f"mock{self.created:04}"
+        self.created += 1
+        self.pods[pod_id] = {"id": pod_id, "name": name, "desiredStatus": "RUNNING", "runtime": None}
+        backend = FakeTrainingBackend(self.training_duration)
+        self.backends[pod_id] = backend
+
+        async def boot():
+            await asyncio.sleep(self.boot_delay)
+            await backend.start()
+
+        self.boots[pod_id] = asyncio.create_task(boot())
+        return self.describe(pod_id)
+
+    async def terminate_pod(self, pod_id: str):
+        self.calls += 1
+        backend = self.backends.pop(pod_id, None)
+        if backend is not None:
+            self.boots.pop(pod_id).cancel()
+            await backend.stop()
+        self.pods.pop(pod_id, None)
+
+    def training_url(self, pod: dict) -> str:
+        return self.backends[pod["id"]].url
+
+
+class PodOrchestrator:
+    """
+    Trains a queue of LoRA configs on up to `pod_count` pods at once. Every pod
+    takes the next job as soon as it is idle, so jobs are not trained one
+    after the other on a single GPU. Pods are created, or reused when a pod of
+    the same name exists, and terminated as soon as the queue is drained.
+    The training API of all pods is polled concurrently over one pooled HTTP
+    session. A job whose pod is lost or fails with any other error is queued
+    again, up to max_attempts times, and the pod is replaced.
+
+    Hooks run the SSH side of things: setup_pod once a pod is ready (e.g.
+    transferring the dataset), on_progress while a job trains and after_job
+    once it has finished (e.g. copying the outputs). When after_job fails the
+    job is failed and its pod is never terminated, so that its outputs can
+    still be copied.
+    """
+
+    def __init__(
+        self,
+        api: Union[RunpodApi, MockRunpodApi],
+        jobs: list[TrainingJob],
+        pod_count: int = 2,
+        pod_name: str = "ht-lora-easy-training-scripts",
+        reuse_existing: bool = True,
+        terminate_when_done: bool = True,
+        poll_interval: float = 10.0,
+        ready_timeout: float = 1800.0,
+        max_attempts: int = 2,
+        setup_pod: Optional[Callable[[dict], Awaitable[None]]] = None,
+        on_progress: Optional[Callable[[dict, TrainingJob], Awaitable[None]]] = None,
+        after_job: Optional[Callable[[dict, TrainingJob], Awaitable[None]]] = None,
+    ):
+        self.api = api
+        self.jobs = jobs
+        self.pod_count = pod_count
+        self.pod_name = pod_name
+        self.reuse_existing = reuse_existing
+        self.terminate_when_done = terminate_when_done
+        self.poll_interval = poll_interval
+        self.ready_timeout = ready_timeout
+        self.max_attempts = max_attempts
+        self.setup_pod = setup_pod
+        self.on_progress = on_progress
+        self.after_job = after_job
+        self.queue: asyncio.Queue[TrainingJob] = asyncio.Queue()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def run(self) -> list[TrainingJob]:
+        start = time.perf_counter()
+        for job in self.jobs:
+            self.queue.put_nowait(job)
+
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(timeout=timeout) as self.session:
+            pod_index = 0
+            lost_pods = 0
+            tasks = set()
+            while True:
+                # Pods lost along the way are replaced while jobs are left,
+                # never more pods than jobs left to train
+                while (
+                    not self.queue.empty()
+                    and len(tasks) < min(self.pod_count, self.jobs_left())
+                    and lost_pods < self.pod_count * self.max_attempts
+                ):
+                    tasks.add(asyncio.create_task(self.run_pod(f"{self.pod_name}-{pod_index}")))
+                    pod_index += 1
+                if not tasks:
+                    break
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # run_pod handles its errors, this only keeps the other pods running if it does not
+                    error = task.exception()
+                    if error is not None:
+                        logger.error(f"Pod task failed: {error!r}")
+                    if error is not None or not task.result():
+                        lost_pods += 1
+
+        for job in self.jobs:
+            if job.status in ("queued", "running"):
+                job.status = "failed"
+        self.log_summary(time.perf_counter() - start)
+        return self.jobs
+
+    def jobs_left(self) -> int:
+        return sum(job.status in ("queued", "running") for job in self.jobs)
+
+    async def get_or_create_pod(self, name: str) -> dict:
+        if self.reuse_existing:
+            for pod in await self.api.get_pods():
+                if pod["name"] == name:
+                    logger.info(f"Reusing pod {name} with id {pod['id']}")
+                    return pod
+        pod = await self.api.create_pod(name)
+        logger.info(f"Created pod {name} with id {pod['id']}")
+        return pod
+
+    async def is_training(self, pod: dict) -> Optional[bool]:
+        try:
+            async with self.session.get(f"{self.api.training_url(pod)}/is_training") as res:
+                if res.status != 200:
+                    return None
+                return (await res.json())["training"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            return None
+
+    async def wait_until_ready(self, pod: dict) -> dict:
+        start = time.perf_counter()
+        while True:
+            pod = await self.api.get_pod(pod["id"])
+            # Both SSH and the training API are needed to run jobs
+            if get_ssh_port(pod) and await self.is_training(pod) is not None:
+                logger.info(f"Pod {pod['name']} ready in {time.perf_counter() - start:.0f}s")
+                return pod
+            if time.perf_counter() - start > self.ready_timeout:
+                raise PodLostError(f"Pod {pod['name']} not ready after {self.ready_timeout:.0f}s")
+            await asyncio.sleep(self.poll_interval)
+
+    async def run_pod(self, name: str) -> bool:
+        """
+        Runs jobs on one pod until the queue is empty, returns False if the pod was lost.
+        """
+        pod = None
+        keep_pod = False
+        try:
+            pod = await self.get_or_create_pod(name)
+            pod = await self.wait_until_ready(pod)
+            if self.setup_pod:
+                await self.setup_pod(pod)
+            while True:
+                try:
+                    job = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return True
+                try:
+                    await self.run_job(pod, job)
+                except AfterJobError as e:
+                    logger.error(f"{e}, keeping pod {name} with id {pod['id']} to copy its outputs")
+                    job.status = "failed"
+                    keep_pod = True
+                    return False
+                except Exception as e:
+                    logger.error(f"Lost pod {name} while running job {job.name}: {e!r}")
+                    if job.attempts < self.max_attempts:
+                        job.status = "queued"
+                        self.queue.put_nowait(job)
+                    else:
+                        job.status = "failed"
+                    return False
+        except Exception as e:
+            logger.error(f"Lost pod {name}: {e!r}")
+            return False
+        finally:
+            if self.terminate_when_done and not keep_pod and pod is not None:
+                logger.info(f"Terminating pod {name} with id {pod['id']}")
+                try:
+                    await self.api.terminate_pod(pod["id"])
+                except Exception as e:
+                    logger.error(f"Failed to terminate pod {name} with id {pod['id']}: {e!r}")
+
+    async def run_job(self, pod: dict, job: TrainingJob):
+        job.attempts += 1
+        job.status = "running"
+        job.pod_name = pod["name"]
+        job.started = time.time()
+        url = self.api.training_url(pod)
+
+        try:
+            with open(job.config_path, encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read the config of job {job.name}: {e}")
+            job.status = "failed"
+            return
+        # Same change as the jq filter of start-runpod.py
+        config.setdefault("args", {}).setdefault("general_args", {})[
+            "gradient_checkpointing"
+        ] = "false"
+
+        logger.info(f"Starting job {job.name} on pod {pod['name']}")
+        async with self.session.post(f"{url}/validate", json=config) as res:
+            if res.status != 200:
+                logger.error(f"Job {job.name} failed validation: {await res.text()}")
+                job.status = "failed"
+                return
+        async with self.session.get(
+            f"{url}/train", params={"train_mode": "lora", "sdxl": "True"}
+        ) as res:
+            if res.status != 200:
+                logger.error(f"Job {job.name} failed to start: {await res.text()}")
+                job.status = "failed"
+                return
+
+        # Like start-runpod.py, training is over after two consecutive idle answers
+        idle = 0
+        errors = 0
+        while idle < 2:
+            await asyncio.sleep(self.poll_interval)
+            is_training = await self.is_training(pod)
+            if is_training is None:
+                errors += 1
+                if errors >= MAX_STATUS_ERRORS:
+                    raise PodLostError("Training status could not be retrieved")
+                continue
+            errors = 0
+            if is_training:
+                idle = 0
+                if self.on_progress:
+                    try:
+                        await self.on_progress(pod, job)
+                    except Exception as e:
+                        # Progress is only logged, it never fails the job
+                        logger.warning(f"Failed to retrieve the progress of job {job.name}: {e!r}")
+            else:
+                idle += 1
+
+        if self.after_job:
+            try:
+                await self.after_job(pod, job)
+            except Exception as e:
+                raise AfterJobError(f"After job {job.name} failed: {e!r}") from e
+        job.status = "done"
+        job.finished = time.time()
+        logger.info(
+            f"Job {job.name} done on pod {pod['name']} in {job.finished - job.started:.0f}s"
+        )
+
+    def log_summary(self, elapsed: float):
+        done = [job for job in self.jobs if job.status == "done"]
+        failed = [job for job in self.jobs if job.status == "failed"]
+        serial = sum(job.finished - job.started for job in done)
+        logger.info(
+            f"{len(done)} jobs done, {len(failed)} failed in {elapsed:.0f}s "
+            f"({serial:.0f}s of training in total)"
+        )
+        for job in failed:
+            logger.warning(f"Job {job.name} failed after {job.attempts} attempts")
@@ -0,0 +1,171 @@
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = 30
+
+
+def create_session() -> requests.Session:
+    # Connections to the pod proxy are kept alive between polls instead of one TLS handshake per poll
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AdaptiveInterval:
+    """
+    Time to wait between two polls. Starts at min_interval and grows by
+    `factor` after every poll, up to max_interval, reset() goes back to
+    min_interval when something changed. When the awaited event is expected
+    in `remaining` seconds, e.g. the end of training, the interval shrinks so
+    that it is noticed soon after it happens.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, factor: float = 1.5):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.factor = factor
+        self.current = min_interval
+
+    def reset(self):
+        self.current = self.min_interval
+
+    def next(self, remaining: Optional[float] = None) -> float:
+        interval = self.current
+        if remaining is not None:
+            interval = min(interval, max(self.min_interval, remaining / 2))
+        self.current = min(self.current * self.factor, self.max_interval)
+        return interval
+
+
+class PhaseTimer:
+    """
+    Counts the checks of a wait phase and logs how long it took once over.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.checks = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def done(self, detail: str = ""):
+        logger.info(
+            f"{self.name} after {self.elapsed:.1f}s, {self.checks} checks"
+            + (f", {detail}" if detail else "")
+        )
+
+
+def check_http(session: requests.Session, url: str) -> Optional[requests.Response]:
+    try:
+        return session.get(url, timeout=HTTP_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+
+
+def check_tcp(host: str, port: int, timeout: float = 5) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class PodReadiness:
+    """
+    Waits for a pod to accept VNC and SSH connections. Every check runs the
+    runpod API call, the VNC request, the SSH port connection and the training
+    API request concurrently, and logs when each of them first succeeds.
+    The training API is not waited for, the pod may be used before it is up.
+    """
+
+    def __init__(
+        self,
+        pod_id: str,
+        vnc_url: str,
+        training_url: str,
+        session: requests.Session,
+        get_pod: Callable[[str], dict],
+    ):
+        self.pod_id = pod_id
+        self.vnc_url = vnc_url
+        self.training_url = training_url
+        self.session = session
+        self.get_pod = get_pod
+        self.ssh_port: Optional[dict] = None
+        self.ready: dict[str, float] = {}
+        # Whether a component came up during the last check
+        self.changed = False
+        self.api_calls = 0
+        self.requests = 0
+        self.timer = PhaseTimer("Pod ready")
+
+    def mark_ready(self, component: str) -> bool:
+        if component in self.ready:
+            return False
+        self.ready[component] = self.timer.elapsed
+        logger.info(f"{component} ready after {self.timer.elapsed:.1f}s")
+        return True
+
+    def check(self, executor: ThreadPoolExecutor) -> bool:
+        """
+        Runs one round of checks, returns True once both VNC and SSH are ready.
+        """
+        self.timer.checks += 1
+        pod = executor.submit(self.get_pod, self.pod_id)
+        vnc = executor.submit(check_http, self.session, self.vnc_url)
+        training = executor.submit(check_http, self.session, f"{self.training_url}/is_training")
+        # The SSH port is known from the previous runpod API call
+        ssh = (
+            executor.submit(check_tcp, self.ssh_port["ip"], self.ssh_port["publicPort"])
+            if self.ssh_port
+            else None
+        )
+        self.api_calls += 1
+        self.requests += 2
+
+        changed = False
+        try:
+            runtime = pod.result()["runtime"] or {}
+            ports = [port for port in runtime.get("ports") or [] if port["privatePort"] == 22]
+            if ports:
+                self.ssh_port = ports[0]
+                changed |= self.mark_ready("SSH port")
+        except Exception as e:
+            logger.warning(f"Failed to retrieve pod information: {e}")
+        response = vnc.result()
+        if response is not None and response.status_code == 200:
+            changed |= self.mark_ready("VNC")
+        response = training.result()
+        if response is not None and response.status_code == 200:
+            changed |= self.mark_ready("Training API")
+        if ssh is not None and ssh.result():
+            changed |= self.mark_ready("SSH")
+        self.changed = changed
+        return "VNC" in self.ready and "SSH" in self.ready
+
+    def wait(self, interval: AdaptiveInterval) -> dict:
+        """
+        Polls until the pod is ready and returns its SSH port, the interval is reset every time a component comes up.
+        """
+        with ThreadPoolExecutor(4, thread_name_prefix="pod-readiness") as executor:
+            while not self.check(executor):
+                if self.changed:
+                    interval.reset()
+                wait = interval.next()
+                logger.info(f"Pod is not ready yet, waiting {wait:.0f} seconds")
+                time.sleep(wait)
+        self.timer.done(f"{self.api_calls} runpod API calls, {self.requests} HTTP requests")
+        return self.ssh_port
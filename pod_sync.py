@@ -0,0 +1,265 @@
+import hashlib
+import json
+import logging
+import os
+import shlex
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+from remote_shell import LocalShell, SshShell
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".pod-sync.sqlite3"
+# Same folders as the rsync filters of transfer_files_from_pod
+DEFAULT_EXCLUDES = ["LoRA_Easy_Training_Scripts", ".shards"]
+
+
+@dataclass
+class RemoteFile:
+    path: str
+    size: int
+    mtime: float
+    hash: Optional[str] = None
+
+
+@dataclass
+class SyncReport:
+    transferred_files: int = 0
+    transferred_bytes: int = 0
+    skipped_files: int = 0
+    skipped_bytes: int = 0
+    # Files still being written on the pod, synced on a later run
+    deferred_files: int = 0
+    failed_files: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def saved_seconds(self) -> float:
+        # Time a full copy of the skipped files would have taken at the measured throughput
+        if not self.transferred_bytes or not self.elapsed:
+            return 0.0
+        return self.skipped_bytes / (self.transferred_bytes / self.elapsed)
+
+
+class PodSync:
+    """
+    Copies the new and changed files of the pod's training folder (checkpoints,
+    samples, logs) to a local folder. A remote listing of (path, size, mtime)
+    is compared with the previous one, only files whose size or mtime changed
+    are hashed on the pod and only files whose hash differs from the local copy
+    are downloaded, over `streams` parallel ssh streams. Hashes of both sides
+    are kept in a sqlite manifest in the local folder.
+    """
+
+    def __init__(
+        self,
+        shell: Union[SshShell, LocalShell],
+        remote_root: str,
+        local_root: str,
+        streams: int = 4,
+        excludes: Iterable[str] = DEFAULT_EXCLUDES,
+        min_age: float = 10.0,
+        manifest_path: Optional[str] = None,
+    ):
+        self.shell = shell
+        self.remote_root = remote_root
+        self.local_root = local_root
+        self.streams = streams
+        self.excludes = list(excludes)
+        # Files modified less than min_age seconds ago may still be written
+        self.min_age = min_age
+        self.manifest_path = manifest_path or os.path.join(local_root, MANIFEST_FILENAME)
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+            # Downloads run in worker threads but only the calling thread uses the connection
+            self._conn = sqlite3.connect(self.manifest_path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS remote_files ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, "
+                "hash TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS local_files ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "hash TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def list_remote(self) -> tuple[float, list[RemoteFile]]:
+        # Top-level files are excluded like with rsync, only subfolders are synced
+        excludes = " ".join(
+            f"! -path {shlex.quote('./' + exclude + '/*')}" for exclude in self.excludes
+        )
+        result = self.shell.run(
+            f"cd {shlex.quote(self.remote_root)} && date +%s.%N && "
+            f"find . -mindepth 2 -type f {excludes} -printf '%P\\t%s\\t%T@\\n'"
+        )
+        lines = result.stdout.splitlines()
+        now = float(lines[0])
+        files = []
+        for line in lines[1:]:
+            path, size, mtime = line.rsplit("\t", 2)
+            files.append(RemoteFile(path, int(size), float(mtime)))
+        return now, files
+
+    def hash_remote(self, files: list[RemoteFile]):
+        # Batched so that hashing costs one ssh call per sync, not one per file
+        for start in range(0, len(files), 200):
+            batch = files[start : start + 200]
+            paths = " ".join(shlex.quote(file.path) for file in batch)
+            # sha256sum exits with 1 when a file was deleted since it was listed, the others are still hashed
+            result = self.shell.run(
+                f"cd {shlex.quote(self.remote_root)} && sha256sum -- {paths}", check=False
+            )
+            if result.returncode not in (0, 1):
+                raise subprocess.CalledProcessError(
+                    result.returncode, result.args, result.stdout, result.stderr
+                )
+            hashes = {}
+            for line in result.stdout.splitlines():
+                file_hash, path = line.split("  ", 1)
+                hashes[path] = file_hash
+            for file in batch:
+                file.hash = hashes.get(file.path)
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.local_root, *path.split("/"))
+
+    def is_local_current(self, file: RemoteFile, local: dict[str, tuple]) -> bool:
+        row = local.get(file.path)
+        if row is None:
+            return False
+        size, mtime_ns, file_hash = row
+        try:
+            stat = os.stat(self.local_path(file.path))
+        except FileNotFoundError:
+            return False
+        return (
+            stat.st_size == size == file.size
+            and stat.st_mtime_ns == mtime_ns
+            and file_hash == file.hash
+        )
+
+    def download(self, file: RemoteFile) -> Optional[tuple[str, int, int, str]]:
+        path = self.local_path(file.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.part"
+        digest = hashlib.sha256()
+        process = self.shell.open(
+            f"cat -- {shlex.quote(self.remote_root + '/' + file.path)}"
+        )
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+            process.wait()
+            if process.returncode != 0 or digest.hexdigest() != file.hash:
+                # The file changed while it was copied, it is synced again on the next run
+                os.remove(temp_path)
+                return None
+            os.utime(temp_path, (file.mtime, file.mtime))
+            os.replace(temp_path, path)
+        except BaseException:
+            process.kill()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        stat = os.stat(path)
+        return file.path, stat.st_size, stat.st_mtime_ns, file.hash
+
+    def sync(self, final: bool = False) -> SyncReport:
+        """
+        Copies the files that changed since the last sync. Recently modified
+        files are deferred to the next sync unless final is set, e.g. once
+        training is over and before the pod is terminated.
+        """
+        start = time.perf_counter()
+        report = SyncReport()
+        now, files = self.list_remote()
+
+        known = {
+            row[0]: row[1:]
+            for row in self.conn.execute("SELECT path, size, mtime, hash FROM remote_files")
+        }
+        to_hash = []
+        for file in files:
+            if not final and now - file.mtime < self.min_age:
+                report.deferred_files += 1
+                continue
+            row = known.get(file.path)
+            if row is not None and row[0] == file.size and row[1] == file.mtime:
+                file.hash = row[2]
+            else:
+                to_hash.append(file)
+        if to_hash:
+            self.hash_remote(to_hash)
+        stable = [file for file in files if file.hash is not None]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO remote_files (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+            [(file.path, file.size, file.mtime, file.hash) for file in stable],
+        )
+        self.conn.execute(
+            "DELETE FROM remote_files WHERE path NOT IN (SELECT value FROM json_each(?))",
+            (json.dumps([file.path for file in files]),),
+        )
+
+        local = {
+            row[0]: row[1:]
+            for row in self.conn.execute("SELECT path, size, mtime_ns, hash FROM local_files")
+        }
+        to_download = []
+        for file in stable:
+            if self.is_local_current(file, local):
+                report.skipped_files += 1
+                report.skipped_bytes += file.size
+            else:
+                to_download.append(file)
+
+        # Largest first so that a big checkpoint does not start last
+        to_download.sort(key=lambda file: file.size, reverse=True)
+        with ThreadPoolExecutor(self.streams, thread_name_prefix="pod-sync") as executor:
+            for file, result in zip(to_download, executor.map(self.download, to_download)):
+                if result is None:
+                    report.failed_files += 1
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO local_files (path, size, mtime_ns, hash) "
+                    "VALUES (?, ?, ?, ?)",
+                    result,
+                )
+                report.transferred_files += 1
+                report.transferred_bytes += file.size
+        self.conn.commit()
+
+        report.elapsed = time.perf_counter() - start
+        self.log_report(report)
+        return report
+
+    def log_report(self, report: SyncReport):
+        logger.info(
+            f"Synced {report.transferred_files} files ({report.transferred_bytes / 1024 / 1024:.1f}MB) "
+            f"in {report.elapsed:.1f}s, skipped {report.skipped_files} unchanged files "
+            f"({report.skipped_bytes / 1024 / 1024:.1f}MB, ~{report.saved_seconds:.0f}s saved), "
+            f"{report.deferred_files} still being written, {report.failed_files} failed"
+        )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,430 @@
+import argparse
+import difflib
+import logging
+import os
+import subprocess
+import sys
+from itertools import chain
+
+from tag_processing import (
+    DEFAULT_CONFIG_PATH,
+    TAG_SCORE_THRESHOLD,
+    Caption,
+    TagConfig,
+    TagProcessor,
+)
+from vocabulary import DEFAULT_BOORU_TAGS_PATH, DEFAULT_VOCABULARY_PATH, load_vocabulary
+
+# Python port of process-tags.ps1, with the same options and config file
+#
+# Example:
+# python .\process-tags.py --sort-tags-by-count --keep-tags 1 --log-tags --log-folder-name --log-stats `
+#   --recursive --path "..."
+# python .\process-tags.py --preset1 --add-tags "ht_delilah" --dry-run --path "..."
+
+parser = argparse.ArgumentParser(
+    prog="process-tags",
+    description="Adds, removes, sorts and organizes tags of caption .txt files",
+)
+parser.add_argument("--path", dest="path", required=True)
+parser.add_argument(
+    "--add-tags",
+    dest="add_tags",
+    help='Tags to add, "-tag" removes a tag',
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--remove-tags", dest="remove_tags", help="Tags to remove", nargs="+", default=[]
+)
+parser.add_argument(
+    "--find-tags",
+    dest="find_tags",
+    help="Tags to highlight in logs",
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--replace-tags",
+    dest="replace_tags",
+    help='Tags to replace, syntax: "OldTag:NewTag"',
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--prepend-tags",
+    dest="prepend_tags",
+    help="Tags to move or add at the start of captions",
+    nargs="+",
+    default=[],
+)
+parser.add_argument(
+    "--run-tagger",
+    dest="run_tagger",
+    action="store_true",
+    help="Tag images with process.py --tag-only first",
+)
+parser.add_argument(
+    "--tag-folder-name",
+    dest="tag_folder_name",
+    action="store_true",
+    help="Add folder names as tags, applied before files are reorganized with --organize-files-by",
+)
+parser.add_argument("--log-file-name", dest="log_file_name", action="store_true")
+parser.add_argument("--log-folder-name", dest="log_folder_name", action="store_true")
+parser.add_argument("--log-tags", dest="log_tags", action="store_true")
+parser.add_argument("--log-stats", dest="log_stats", action="store_true")
+parser.add_argument(
+    "--recursive",
+    dest="recursive",
+    action="store_true",
+    help="Traverse input directory recursively",
+)
+parser.add_argument(
+    "--sort-tags-by-count", dest="sort_tags_by_count", action="store_true"
+)
+parser.add_argument(
+    "--sort-tags-by-frequency",
+    dest="sort_tags_by_frequency",
+    action="store_true",
+    help="Sort tags by their post count on danbooru instead of their count in the dataset",
+)
+parser.add_argument(
+    "--remove-redundant-tags",
+    dest="remove_redundant_tags",
+    action="store_true",
+    help='Remove tags implied by a more specific tag, e.g. "dress" when "red dress" is present',
+)
+parser.add_argument(
+    "--remove-unwanted-tags",
+    dest="remove_unwanted_tags",
+    action="store_true",
+    help="Remove tags listed in unwantedTags of the config",
+)
+parser.add_argument(
+    "--organize-files-by",
+    dest="organize_files_by",
+    help="Move files to folders named after the tags of this category, or of these comma separated tags",
+)
+parser.add_argument(
+    "--suffix-file-count",
+    dest="suffix_file_count",
+    action="store_true",
+    help="Suffix folder names with the number of files they contain",
+)
+parser.add_argument(
+    "--process-multiline",
+    dest="process_multiline",
+    action="store_true",
+    help="Also process caption files with multiple lines",
+)
+parser.add_argument(
+    "--keep-tags",
+    dest="keep_tags",
+    help="Number of leading tags kept in place when sorting, e.g. trigger words",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--dry-run",
+    dest="dry_run",
+    action="store_true",
+    help="Print a diff of the changes instead of writing, moving or renaming files",
+)
+parser.add_argument(
+    "--preset1",
+    dest="preset1",
+    action="store_true",
+    help="Shortcut for --log-folder-name --log-tags --log-stats --remove-redundant-tags "
+    "--remove-unwanted-tags --sort-tags-by-count --keep-tags 1",
+)
+parser.add_argument(
+    "--config",
+    dest="config",
+    help="Path of the tag config",
+    default=DEFAULT_CONFIG_PATH,
+)
+parser.add_argument(
+    "--booru-tags",
+    dest="booru_tags",
+    help="Path of the danbooru tag list, downloaded if missing",
+    default=DEFAULT_BOORU_TAGS_PATH,
+)
+parser.add_argument(
+    "--vocabulary",
+    dest="vocabulary",
+    help="Path of the tag vocabulary compiled from --booru-tags, see compile-vocabulary.py",
+    default=DEFAULT_VOCABULARY_PATH,
+)
+args = parser.parse_args()
+
+if args.preset1:
+    args.log_folder_name = True
+    args.log_tags = True
+    args.log_stats = True
+    args.remove_redundant_tags = True
+    args.remove_unwanted_tags = True
+    args.sort_tags_by_count = True
+    if args.keep_tags == 0:
+        args.keep_tags = 1  # Keep trigger word
+
+if args.keep_tags == 0 and args.prepend_tags:
+    args.keep_tags = len(args.prepend_tags)
+
+path: str = args.path.rstrip("\\/")
+add_tags: list[str] = args.add_tags
+remove_tags: list[str] = args.remove_tags
+find_tags: set[str] = {
+    tag.strip().lower()
+    for tag in chain.from_iterable(tags.split(",") for tags in args.find_tags)
+}
+replace_tags: list[str] = args.replace_tags
+prepend_tags: list[str] = args.prepend_tags
+run_tagger: bool = args.run_tagger
+tag_folder_name: bool = args.tag_folder_name
+log_file_name: bool = args.log_file_name
+log_folder_name: bool = args.log_folder_name
+log_tags: bool = args.log_tags
+log_stats: bool = args.log_stats
+recursive: bool = args.recursive
+sort_tags_by_count: bool = args.sort_tags_by_count
+sort_tags_by_frequency: bool = args.sort_tags_by_frequency
+remove_redundant_tags: bool = args.remove_redundant_tags
+remove_unwanted_tags: bool = args.remove_unwanted_tags
+organize_files_by: str = args.organize_files_by
+suffix_file_count: bool = args.suffix_file_count
+process_multiline: bool = args.process_multiline
+keep_tags: int = args.keep_tags
+dry_run: bool = args.dry_run
+config_path: str = args.config
+booru_tags_path: str = args.booru_tags
+vocabulary_path: str = args.vocabulary
+
+RED = "\033[31m"
+GREEN = "\033[32m"
+DARK_YELLOW = "\033[33m"
+BLUE = "\033[34m"
+RESET = "\033[0m"
+
+
+def color(text: str, code: str) -> str:
+    return f"{code}{text}{RESET}" if sys.stdout.isatty() else text
+
+
+def header(title: str) -> str:
+    return f"--  {title}:  ".ljust(80, "-")
+
+
+def relative(target: str) -> str:
+    return os.path.relpath(target, path)
+
+
+def format_tag(tag: str, added: bool) -> str:
+    if tag in find_tags:
+        return color(tag, DARK_YELLOW)
+    if added:
+        return color(tag, GREEN)
+    return tag
+
+
+def tag_with_tagger():
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "process.py"),
+        "--input-type",
+        "image",
+        "--output-meta",
+        "txt",
+        "--tag-only",
+        "--input",
+        path,
+        "--output",
+        path,
+        *(["--recursive"] if recursive else []),
+    ]
+    print(" ".join(command))
+    subprocess.run(command, check=True)
+
+    # Captions of images in subfolders are written to the root folder, move them next to their image
+    images = {}
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            stem, extension = os.path.splitext(filename)
+            if extension.lower() != ".txt":
+                images.setdefault(stem, directory)
+        if not recursive:
+            break
+    for caption_file in os.listdir(path):
+        stem, extension = os.path.splitext(caption_file)
+        directory = images.get(stem)
+        if (
+            extension == ".txt"
+            and directory
+            and os.path.abspath(directory) != os.path.abspath(path)
+        ):
+            os.replace(
+                os.path.join(path, caption_file), os.path.join(directory, caption_file)
+            )
+
+
+def print_captions(processor: TagProcessor):
+    captions = processor.captions
+    count = str(len(captions))
+    name_width = max(
+        (
+            len(os.path.basename(c.path) if log_folder_name else relative(c.path))
+            for c in captions
+        ),
+        default=0,
+    )
+    folder_width = max((len(relative(c.directory)) for c in captions), default=0)
+
+    for number, caption in enumerate(captions, 1):
+        line = f"{str(number).rjust(len(count), '0')}/{count}"
+        if log_folder_name:
+            line += color(f" | {relative(caption.directory).rjust(folder_width)}", BLUE)
+        if log_file_name:
+            name = (
+                os.path.basename(caption.path)
+                if log_folder_name
+                else relative(caption.path)
+            )
+            line += color(f" | {name.ljust(name_width)}", BLUE)
+        if log_tags:
+            vocabulary = processor.vocabulary
+            tags = [
+                format_tag(vocabulary[tag_id], tag_id in caption.added)
+                for tag_id in caption.tags
+            ] + [color(vocabulary[tag_id], RED) for tag_id in caption.removed]
+            line += " | " + ", ".join(tags)
+        print(line)
+
+
+def print_diff(processor: TagProcessor, changed: list[Caption]):
+    for caption in changed:
+        sys.stdout.writelines(
+            difflib.unified_diff(
+                # One tag per line so that the diff shows added, removed and moved tags
+                [tag.strip() + "\n" for tag in caption.original.split(",") if tag.strip()],
+                [processor.vocabulary[tag_id] + "\n" for tag_id in caption.tags],
+                fromfile=relative(caption.path),
+                tofile=relative(caption.path),
+                lineterm="\n",
+            )
+        )
+    print(f"{len(changed)} of {len(processor.captions)} captions would change")
+
+
+def print_stats(processor: TagProcessor):
+    vocabulary = processor.vocabulary
+    captions = processor.captions
+    counts = processor.count_tags()
+    added = set(chain.from_iterable(caption.added for caption in captions))
+    width = len(str(len(captions)))
+
+    print(header("Tag statistics"))
+    tags_by_count: dict[int, list[int]] = {}
+    for tag_id, tag_count in counts.items():
+        tags_by_count.setdefault(tag_count, []).append(tag_id)
+    for tag_count in sorted(tags_by_count, reverse=True):
+        tags = [
+            format_tag(vocabulary[tag_id], tag_id in added)
+            for tag_id in tags_by_count[tag_count]
+        ]
+        print(f"{str(tag_count).rjust(width)}: " + ", ".join(tags))
+
+    scores = []
+    organized_category = (organize_files_by or "").lower()
+    for category in processor.config.categories:
+        by_category = processor.captions_by_category(category)
+        uncategorized = by_category[-1][1]
+        scores.append((category, processor.category_score(category)))
+        # Only the category used to organize files is printed, if any
+        if (
+            organized_category in processor.config.categories
+            and category != organized_category
+        ):
+            continue
+
+        print(header(f"Files by {category}"))
+        entries = sorted(
+            (entry for entry in by_category[:-1] if entry[1]),
+            key=lambda entry: len(entry[1]),
+            reverse=True,
+        )
+        parts = [f"{tag}: {color(str(len(files)), GREEN)}" for tag, files in entries]
+        parts += [f"{tag}: 0" for tag, files in by_category[:-1] if not files]
+        if uncategorized:
+            parts.append(f"none: {color(str(len(uncategorized)), RED)}")
+        print(", ".join(parts))
+        if log_file_name:
+            for caption in uncategorized:
+                print(color(relative(caption.path), RED))
+
+    def format_score(score: float) -> str:
+        return color(f"{score:.2f}", GREEN if score >= TAG_SCORE_THRESHOLD else RED)
+
+    print(header("Tag scores"))
+    print(", ".join(f"{category}: {format_score(score)}" for category, score in scores))
+    total = sum(score for _, score in scores) / len(scores) if scores else 0
+    print(f"Total: {format_score(total)}")
+
+    vocabulary = load_vocabulary(vocabulary_path, booru_tags_path)
+    suggestions = processor.suggestions(keep_tags, vocabulary)
+    if any(suggestions.values()):
+        print("".ljust(80, "-"))
+        for reason, tags in suggestions.items():
+            if tags:
+                print(f"{reason}: {color(', '.join(tags), RED)}")
+        if not remove_unwanted_tags:
+            print("Tip: add --remove-unwanted-tags to remove all unwanted tags")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if run_tagger:
+        tag_with_tagger()
+
+    processor = TagProcessor(path, TagConfig.load(config_path))
+    processor.load(recursive, process_multiline)
+
+    processor.add_tags(prepend_tags, prepend=True)
+    processor.add_tags(add_tags)
+    if tag_folder_name:
+        processor.tag_folder_names()
+    if replace_tags:
+        processor.replace_tags(replace_tags)
+    processor.remove_tags(remove_tags)
+    if remove_redundant_tags:
+        processor.remove_redundant_tags()
+    if remove_unwanted_tags:
+        processor.remove_unwanted_tags()
+
+    if organize_files_by:
+        moves = processor.organize_by_category(organize_files_by, dry_run)
+        for source, destination in moves:
+            if dry_run:
+                print(f"Would move {relative(source)} -> {relative(destination)}")
+
+    if suffix_file_count:
+        for source, destination in processor.suffix_file_count(dry_run):
+            if dry_run:
+                print(f"Would rename {relative(source)} -> {relative(destination)}")
+
+    if sort_tags_by_count:
+        processor.sort_tags_by_count(keep_tags)
+    elif sort_tags_by_frequency:
+        processor.sort_tags_by_frequency(
+            load_vocabulary(vocabulary_path, booru_tags_path), keep_tags
+        )
+
+    if dry_run:
+        print_diff(processor, processor.changed_captions())
+    else:
+        processor.save()
+
+    print_captions(processor)
+
+    if log_stats:
+        print_stats(processor)
@@ -1,7 +1,11 @@
 import argparse
+import json
+import logging
 import os
-from waifuc.export import SaveExporter
-from waifuc.source import VideoSource, LocalSource
+import time
+from typing import Optional
+from waifuc.export import BaseExporter
+from waifuc.source import BaseDataSource, VideoSource, LocalSource
 from waifuc.action import (
     PersonSplitAction,
     MinSizeFilterAction,
@@ -10,11 +14,40 @@ from waifuc.action import (
     BlacklistedTagDropAction,
     FilterSimilarAction,
     TagRemoveUnderlineAction,
-    TaggingAction,
 )
 
-from actions import TagAddAction, TagFilterAnyOfAction
-from exporters import ChainedExporter, TextualInversionExporter
+from actions import (
+    BatchedTaggingAction,
+    CountAction,
+    DedupAction,
+    ShardFilenameAction,
+    TagAddAction,
+    TagFilterAnyOfAction,
+)
+from caption_store import CAPTION_STORE_FILENAME, CaptionStore, CaptionStoreExporter
+from dedup import DedupExporter
+from exporters import (
+    AsyncSaveExporter,
+    ChainedExporter,
+    ExportPool,
+    LocalSaveExporter,
+    TextualInversionExporter,
+)
+from instrumentation import PipelineStats
+from journal import JournalExporter, JournalStartAction, ProcessingJournal
+from manifest import FileManifest, ManifestExporter
+from parallel import Shard, ShardResult, run_shards
+from sources import (
+    ComposedSource,
+    LocalFilesSource,
+    ParallelVideoSource,
+    SceneVideoSource,
+    list_image_files,
+    list_video_files,
+)
+from score_matrix import get_score_matrix_writer
+from tag_cache import DEFAULT_TAG_CACHE_MAX_SIZE_MB, DEFAULT_TAG_CACHE_PATH, TagCache
+from tagger import STUB_METHOD, WD14_MODEL_NAMES
 
 # Examples
 #
@@ -57,9 +90,15 @@ parser.add_argument(
 parser.add_argument(
     "--output-meta",
     dest="output_meta",
-    choices=["txt", "json", "all", "none"],
+    choices=["txt", "json", "all", "store", "none"],
     default="all",
-    help="Type of metadata output for textual inversion",
+    help="Type of metadata output for textual inversion, store adds the captions of all images "
+    "to a single --caption-store file instead, see materialize-captions.py",
+)
+parser.add_argument(
+    "--caption-store",
+    dest="caption_store",
+    help="Path of the caption store used by --output-meta store (defaults to captions.sqlite3 in the output folder)",
 )
 parser.add_argument(
     "--add-tags",
@@ -129,6 +168,177 @@ parser.add_argument(
     help="Organize output images in folders based on the given tags",
     nargs="+",
 )
+parser.add_argument(
+    "--tagger",
+    dest="tagger",
+    help="Tagging model",
+    choices=list(WD14_MODEL_NAMES),
+    default="wd14_v3_swinv2",
+)
+parser.add_argument(
+    "--tag-cache",
+    dest="tag_cache",
+    help="Path of the persistent tag cache (keyed by image content, tagger model and thresholds)",
+    default=DEFAULT_TAG_CACHE_PATH,
+)
+parser.add_argument(
+    "--tag-cache-size",
+    dest="tag_cache_size",
+    help="Maximum size of the tag cache in MB, least recently used entries are evicted first",
+    type=float,
+    default=DEFAULT_TAG_CACHE_MAX_SIZE_MB,
+)
+parser.add_argument(
+    "--tag-batch-size",
+    dest="tag_batch_size",
+    help="Number of images to tag per model call",
+    type=int,
+    default=16,
+)
+parser.add_argument(
+    "--tag-flush-timeout",
+    dest="tag_flush_timeout",
+    help="Tag a partial batch once its oldest image has waited for this many seconds",
+    type=float,
+)
+parser.add_argument(
+    "--score-matrix",
+    dest="score_matrix",
+    help="Directory where the raw tagger scores of every image are recorded, see query-scores.py",
+)
+parser.add_argument(
+    "--no-tag-cache",
+    dest="no_tag_cache",
+    action="store_true",
+    help="Always run the tagger instead of reading from/writing to the tag cache",
+    default=False,
+)
+parser.add_argument(
+    "--workers",
+    dest="workers",
+    help="Number of worker processes, each one processes and exports a shard of the input "
+    "(one video per shard, or --shard-size images per shard) and loads its own models",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--shard-size",
+    dest="shard_size",
+    help="Number of images per shard when running with --workers",
+    type=int,
+    default=64,
+)
+parser.add_argument(
+    "--async-export",
+    dest="async_export",
+    action="store_true",
+    help="Encode and write output files in background threads while the pipeline keeps running",
+    default=False,
+)
+parser.add_argument(
+    "--export-threads",
+    dest="export_threads",
+    help="Number of background threads used by --async-export",
+    type=int,
+    default=4,
+)
+parser.add_argument(
+    "--dedup-scope",
+    dest="dedup_scope",
+    choices=["none", "run", "global"],
+    default="none",
+    help="Drop near-duplicates of any image kept so far in this run (run), "
+    "or in this run and previous runs sharing the same --dedup-index (global). "
+    "With --workers, run only drops near-duplicates within the shard of each worker",
+)
+parser.add_argument(
+    "--dedup-index",
+    dest="dedup_index",
+    help="Path of the persistent perceptual hash index used by --dedup-scope global",
+)
+parser.add_argument(
+    "--dedup-distance",
+    dest="dedup_distance",
+    help="Maximum number of differing perceptual hash bits (out of 64) for images to count as duplicates",
+    type=int,
+    default=4,
+)
+parser.add_argument(
+    "--frame-extraction",
+    dest="frame_extraction",
+    choices=["interval", "scene", "keyframe"],
+    default="interval",
+    help="How video frames are extracted: every 0.2s (interval), only when the picture changes (scene), "
+    "or keyframes only (keyframe)",
+)
+parser.add_argument(
+    "--scene-threshold",
+    dest="scene_threshold",
+    help="Minimum mean pixel difference in the range [0-1] between two frames extracted with --frame-extraction scene",
+    type=float,
+    default=0.05,
+)
+parser.add_argument(
+    "--decode-workers",
+    dest="decode_workers",
+    help="Number of videos decoded concurrently in worker processes when --input is a directory of videos",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--lazy-decode",
+    dest="lazy_decode",
+    action="store_true",
+    help="Only read image headers up front so that images rejected by --min-size are never decoded",
+    default=False,
+)
+parser.add_argument(
+    "--resume",
+    dest="resume",
+    action="store_true",
+    help="Record completed images and video frames in a journal and skip them when rerun, "
+    "must also be set on the first run",
+    default=False,
+)
+parser.add_argument(
+    "--journal",
+    dest="journal",
+    help="Path of the journal used by --resume (defaults to .process-journal.sqlite3 in the output folder)",
+)
+parser.add_argument(
+    "--incremental",
+    dest="incremental",
+    action="store_true",
+    help="Only process source files that are new or changed since the last run with the same options, "
+    "and delete the outputs of source files that were deleted",
+    default=False,
+)
+parser.add_argument(
+    "--manifest",
+    dest="manifest",
+    help="Path of the manifest used by --incremental (defaults to .process-manifest.sqlite3 in the output folder)",
+)
+parser.add_argument(
+    "--stats",
+    dest="stats",
+    help="Instrument every action and exporter and write per-stage wall time, item counts, drop rate "
+    "and peak RSS to this JSON file, and in the Prometheus text format to the same path with a .prom extension",
+)
+parser.add_argument(
+    "--stats-interval",
+    dest="stats_interval",
+    type=float,
+    help="Seconds between snapshots of the --stats report during the run",
+    default=60,
+)
+# Only for benchmark-pipeline.py, runs offline and without onnxruntime
+parser.add_argument(
+    "--benchmark-stubs",
+    dest="benchmark_stubs",
+    action="store_true",
+    help=argparse.SUPPRESS,
+    default=False,
+)
 
 args = parser.parse_args()
 
@@ -140,131 +350,466 @@ input_type: str = args.input_type
 recursive: bool = args.recursive
 output: str = args.output
 output_meta: str = args.output_meta
+caption_store_path: str = args.caption_store
 overwrite_tags: bool = args.overwrite_tags
 split_person: bool = args.split_person
 tag_any_of: list[str] = args.tag_any_of
 tag_all_of: list[str] = args.tag_all_of
 tag_none_of: list[str] = args.tag_none_of
 tag_confidence: float = args.tag_confidence
+benchmark_stubs: bool = args.benchmark_stubs
+# The fake color-based tagger must never write tags to a real dataset
+tagger: str = STUB_METHOD if benchmark_stubs else args.tagger
+tag_cache_path: str = args.tag_cache
+tag_cache_size: float = args.tag_cache_size
+no_tag_cache: bool = args.no_tag_cache
+score_matrix_path: str = args.score_matrix
+tag_batch_size: int = args.tag_batch_size
+tag_flush_timeout: float = args.tag_flush_timeout
 tag_only: bool = args.tag_only
 organize_by_tags: list[str] = args.organize_by_tags
+workers: int = args.workers
+shard_size: int = args.shard_size
+async_export: bool = args.async_export
+export_threads: int = args.export_threads
+dedup_scope: str = args.dedup_scope
+dedup_index: str = args.dedup_index
+dedup_distance: int = args.dedup_distance
+frame_extraction: str = args.frame_extraction
+scene_threshold: float = args.scene_threshold
+decode_workers: int = args.decode_workers
+lazy_decode: bool = args.lazy_decode
+resume: bool = args.resume
+journal_path: str = args.journal
+incremental: bool = args.incremental
+manifest_path: str = args.manifest
+stats_path: str = args.stats
+stats_interval: float = args.stats_interval
 
-# See https://deepghs.github.io/waifuc/main/tutorials/crawl_videos/index.html
-# See https://deepghs.github.io/waifuc/main/tutorials/process_images/index.html#common-actions-and-usage-examples
-# Make sure the following are installed first:
-# - https://developer.nvidia.com/cudnn-downloads?target_os=Windows&target_arch=x86_64&target_version=10&target_type=exe_local
-# - https://developer.nvidia.com/cuda-downloads?target_os=Windows&target_arch=x86_64&target_version=11&target_type=exe_local
-if __name__ == "__main__":
+# Options that change how files are processed, a change in any of them makes every file be processed again
+PIPELINE_OPTIONS = [
+    "input_type",
+    "output",
+    "output_meta",
+    "add_tags",
+    "drop_tags",
+    "overwrite_tags",
+    "split_person",
+    "tag_all_of",
+    "tag_none_of",
+    "tag_any_of",
+    "tag_confidence",
+    "tagger",
+    "min_size",
+    "tag_only",
+    "organize_by_tags",
+    "dedup_scope",
+    "dedup_distance",
+    "frame_extraction",
+    "scene_threshold",
+]
+
+
+def create_tag_cache() -> Optional[TagCache]:
+    if no_tag_cache:
+        return None
+    return TagCache(tag_cache_path, max_size_mb=tag_cache_size)
+
+
+def create_journal() -> Optional[ProcessingJournal]:
+    if not resume:
+        return None
+    return ProcessingJournal(
+        journal_path or os.path.join(get_output_dir(), ".process-journal.sqlite3")
+    )
+
+
+def create_manifest() -> Optional[FileManifest]:
+    if not incremental:
+        return None
+    fingerprint = json.dumps(
+        {option: getattr(args, option) for option in PIPELINE_OPTIONS},
+        sort_keys=True,
+    )
+    return FileManifest(
+        manifest_path or os.path.join(get_output_dir(), ".process-manifest.sqlite3"),
+        fingerprint,
+    )
+
+
+def create_pipeline_stats(write_reports: bool = True) -> Optional[PipelineStats]:
+    if not stats_path:
+        return None
+    return PipelineStats(stats_path if write_reports else None, stats_interval)
+
+
+def create_video_source(
+    video_file: str, journal: Optional[ProcessingJournal] = None
+) -> BaseDataSource:
+    if frame_extraction == "interval" and journal is None:
+        return VideoSource(video_file, min_frame_interval=0.2)
+    # VideoSource cannot seek, so resumed runs always go through SceneVideoSource
+    return SceneVideoSource(
+        video_file,
+        mode=frame_extraction,
+        min_frame_interval=0.2,
+        scene_threshold=scene_threshold,
+        start_after=journal.video_resume_time(video_file) if journal else None,
+    )
+
+
+def list_input_files(
+    journal: Optional[ProcessingJournal], manifest: Optional[FileManifest] = None
+) -> list[str]:
     if input_type == "video":
         if os.path.isdir(input):
-            source = VideoSource.from_directory(
+            files = list_video_files(input, recursive=recursive)
+        else:
+            files = [input]
+        if journal is not None:
+            files = [file for file in files if not journal.is_video_completed(file)]
+    else:
+        files = list_image_files(input)
+        if journal is not None:
+            files = [file for file in files if not journal.is_file_completed(file)]
+    if manifest is not None:
+        total = len(files)
+        files = manifest.changed_files(files)
+        logging.info(f"{len(files)} of {total} source files are new or changed")
+    return files
+
+
+def create_source(
+    journal: Optional[ProcessingJournal], files: Optional[list[str]] = None
+) -> BaseDataSource:
+    # files is the explicit list of input files to process, if already filtered by the journal or manifest
+    if input_type == "video":
+        if files is not None or (os.path.isdir(input) and decode_workers > 1):
+            sources = [
+                create_video_source(file, journal)
+                for file in (files if files is not None else list_input_files(journal))
+            ]
+            if decode_workers > 1:
+                return ParallelVideoSource(sources, decode_workers)
+            return ComposedSource(sources)
+        elif os.path.isdir(input):
+            if frame_extraction != "interval":
+                return SceneVideoSource.from_directory(
+                    input,
+                    recursive=recursive,
+                    mode=frame_extraction,
+                    min_frame_interval=0.2,
+                    scene_threshold=scene_threshold,
+                )
+            return VideoSource.from_directory(
                 input, min_frame_interval=0.2, recursive=recursive
             )
         else:
-            source = VideoSource(input, min_frame_interval=0.2)
+            return create_video_source(input)
+    elif input_type == "image":
+        if os.path.isdir(input) and (lazy_decode or files is not None):
+            if files is None:
+                files = list_input_files(journal)
+            return LocalFilesSource(input, files, lazy=lazy_decode)
+        elif os.path.isdir(input):
+            return LocalSource(input)
+        else:
+            raise Exception("Input is not a directory")
+    else:
+        raise Exception("Unknown input type: " + input_type)
+
+
+def create_shards(files: list[str]) -> list[Shard]:
+    if input_type == "video":
+        # One shard per video so that similar frames are still compared within each video
+        return [Shard(index, [file]) for index, file in enumerate(files)]
     elif input_type == "image":
         if os.path.isdir(input):
-            source = LocalSource(input)
+            return [
+                Shard(index, files[start : start + shard_size])
+                for index, start in enumerate(range(0, len(files), shard_size))
+            ]
         else:
             raise Exception("Input is not a directory")
     else:
         raise Exception("Unknown input type: " + input_type)
 
+
+def create_shard_source(
+    shard: Shard, journal: Optional[ProcessingJournal]
+) -> BaseDataSource:
+    if input_type == "video":
+        return create_video_source(shard.files[0], journal)
+    else:
+        return LocalFilesSource(input, shard.files, lazy=lazy_decode)
+
+
+def attach_actions(
+    source: BaseDataSource,
+    tag_cache: Optional[TagCache],
+    journal: Optional[ProcessingJournal] = None,
+    stats: Optional[PipelineStats] = None,
+) -> BaseDataSource:
+    attach = stats.attach if stats is not None else BaseDataSource.attach
+
+    if journal is not None:
+        source = attach(source, JournalStartAction(journal))
+
     if split_person:
-        source = source.attach(PersonSplitAction(conf_threshold=0.5))
+        source = attach(source, PersonSplitAction(conf_threshold=0.5))
 
     if not tag_only:
-        source = source.attach(
+        source = attach(
+            source,
             # Keep images with at least 320px of width and height
             MinSizeFilterAction(min_size),
-            # Remove images similar to the last 5 captured
-            FilterSimilarAction(capacity=5, threshold=0.3),
+        )
+        # The similarity model runs on onnxruntime
+        if not benchmark_stubs:
+            source = attach(
+                source,
+                # Remove images similar to the last 5 captured
+                FilterSimilarAction(capacity=5, threshold=0.3),
+            )
+
+    if dedup_scope != "none":
+        source = attach(
+            source,
+            # Remove images similar to any image kept so far, across videos and runs
+            DedupAction(dedup_scope, dedup_index, dedup_distance),
         )
 
-    source = source.attach(
+    source = attach(
+        source,
         # Tag images
-        TaggingAction(
-            method="wd14_v3_swinv2",
+        BatchedTaggingAction(
+            method=tagger,
             force=overwrite_tags,
             general_threshold=0.35,
             character_threshold=2,  # don't add character tags, e.g. "shimakaze \(kancolle\)"
             drop_overlap=True,  # drop overlapping tags
+            cache=tag_cache,
+            batch_size=tag_batch_size,
+            flush_timeout=tag_flush_timeout,
+            # Reused by the shards of a worker, each process writes a single segment
+            score_matrix=(
+                get_score_matrix_writer(score_matrix_path) if score_matrix_path else None
+            ),
         ),
         # Remove underlines from tags
         TagRemoveUnderlineAction(),
-        # Discard blacklisted tags
-        # See https://huggingface.co/datasets/alea31415/tag_filtering/blob/main/blacklist_tags.txt
-        BlacklistedTagDropAction(),
     )
 
+    # The blacklist is downloaded from huggingface
+    if not benchmark_stubs:
+        source = attach(
+            source,
+            # Discard blacklisted tags
+            # See https://huggingface.co/datasets/alea31415/tag_filtering/blob/main/blacklist_tags.txt
+            BlacklistedTagDropAction(),
+        )
+
     if not tag_only:
-        source = source.attach(
+        source = attach(
+            source,
             # # Split images into full body, upper body, and head
             # ThreeStageSplitAction(),
             # Discard images with bad quality tags
-            TagFilterAction({"blurry": 0.8, "dark": 0.9}, reversed=True)
+            TagFilterAction({"blurry": 0.8, "dark": 0.9}, reversed=True),
         )
 
     if tag_any_of:
-        source = source.attach(
+        source = attach(
+            source,
             TagFilterAnyOfAction(
-                {tag.replace("_", " "): tag_confidence for tag in tag_any_of}
-            )
+                {tag.replace("_", " "): tag_confidence for tag in tag_any_of},
+                cache=tag_cache,
+            ),
         )
 
     if tag_all_of:
-        source = source.attach(
+        source = attach(
+            source,
             TagFilterAction(
                 {tag.replace("_", " "): tag_confidence for tag in tag_all_of}
-            )
+            ),
         )
 
     if tag_none_of:
-        source = source.attach(
+        source = attach(
+            source,
             TagFilterAction(
                 {tag.replace("_", " "): tag_confidence for tag in tag_none_of},
                 reversed=True,
-            )
+            ),
         )
 
     if add_tags:
-        source = source.attach(TagAddAction(tag.replace("_", " ") for tag in add_tags))
+        source = attach(
+            source, TagAddAction(tag.replace("_", " ") for tag in add_tags)
+        )
 
     if drop_tags:
-        source = source.attach(
-            TagDropAction(tag.replace("_", " ") for tag in drop_tags)
+        source = attach(
+            source, TagDropAction(tag.replace("_", " ") for tag in drop_tags)
         )
 
-    if not output:
-        if tag_only:
-            output = os.path.dirname(input) if os.path.isfile(input) else input
-        elif os.path.isdir(input):
-            output = os.path.join(input, "output")
-        else:
-            output = os.path.join(os.path.dirname(input), "output")
+    return source
+
+
+def get_output_dir() -> str:
+    if output:
+        return output
+    if tag_only:
+        return os.path.dirname(input) if os.path.isfile(input) else input
+    elif os.path.isdir(input):
+        return os.path.join(input, "output")
+    else:
+        return os.path.join(os.path.dirname(input), "output")
+
+
+def create_exporter(
+    output: str,
+    journal: Optional[ProcessingJournal] = None,
+    manifest: Optional[FileManifest] = None,
+    files: Optional[list[str]] = None,
+    stats: Optional[PipelineStats] = None,
+) -> BaseExporter:
+    exporter = create_output_exporter(output, stats)
+    if dedup_scope == "global":
+        exporter = DedupExporter(exporter, dedup_index)
+    if manifest is not None:
+        exporter = ManifestExporter(exporter, manifest, files)
+    if journal is not None:
+        return JournalExporter(exporter, journal)
+    return exporter
+
+
+def create_output_exporter(
+    output: str, stats: Optional[PipelineStats] = None
+) -> BaseExporter:
+    pool = ExportPool(max_workers=export_threads) if async_export else None
+    instrument = stats.instrument_exporter if stats is not None else lambda e: e
 
     if output_meta == "txt":
-        source.export(
+        return instrument(
             TextualInversionExporter(
                 output,
                 skip_when_image_exist=True,
                 skip_image_export=tag_only,
                 use_spaces=True,
-                organize_by_tags=organize_by_tags
+                organize_by_tags=organize_by_tags,
+                pool=pool,
             )
         )
     elif output_meta == "json":
-        source.export(SaveExporter(output))
+        return instrument(
+            AsyncSaveExporter(output, pool) if pool else LocalSaveExporter(output)
+        )
     elif output_meta == "all":
-        source.export(
-            ChainedExporter(
-                [
-                    SaveExporter(output, skip_when_image_exist=True),
+        # Captions are exported first so that the image is only written after its caption
+        return ChainedExporter(
+            [
+                instrument(
                     TextualInversionExporter(
-                        output, skip_when_image_exist=True, use_spaces=True, organize_by_tags=organize_by_tags
-                    ),
-                ]
+                        output,
+                        skip_when_image_exist=True,
+                        use_spaces=True,
+                        organize_by_tags=organize_by_tags,
+                        pool=pool,
+                    )
+                ),
+                instrument(
+                    AsyncSaveExporter(output, pool, skip_when_image_exist=True)
+                    if pool
+                    else LocalSaveExporter(output, skip_when_image_exist=True)
+                ),
+            ]
+        )
+    elif output_meta == "store":
+        return instrument(
+            CaptionStoreExporter(
+                output,
+                CaptionStore(
+                    caption_store_path or os.path.join(output, CAPTION_STORE_FILENAME)
+                ),
+                skip_image_export=tag_only,
+                skip_when_image_exist=True,
+                organize_by_tags=organize_by_tags,
+                pool=pool,
             )
         )
     elif output_meta == "none":
-        source.export(SaveExporter(output, no_meta=True))
+        if pool:
+            return instrument(AsyncSaveExporter(output, pool, no_meta=True))
+        return instrument(LocalSaveExporter(output, no_meta=True))
+    else:
+        raise Exception("Unknown output meta: " + output_meta)
+
+
+def process_shard(shard: Shard) -> ShardResult:
+    # Runs in a worker process, module-level arguments are parsed again on spawn
+    start = time.perf_counter()
+    journal = create_journal()
+    # Only the main process writes the report, from the stats of all shards
+    stats = create_pipeline_stats(write_reports=False)
+    source = create_shard_source(shard, journal)
+    counter_in = CountAction()
+    counter_out = CountAction()
+    source = attach_actions(
+        source.attach(counter_in), create_tag_cache(), journal, stats
+    )
+    # Name untitled items per shard so that workers never write to the same file
+    source = source.attach(ShardFilenameAction(shard.index), counter_out)
+    source.export(
+        create_exporter(
+            get_output_dir(), journal, create_manifest(), shard.files, stats
+        )
+    )
+    return ShardResult(
+        shard.index,
+        os.getpid(),
+        counter_in.count,
+        counter_out.count,
+        time.perf_counter() - start,
+        stats.to_dict() if stats is not None else None,
+    )
+
+
+# See https://deepghs.github.io/waifuc/main/tutorials/crawl_videos/index.html
+# See https://deepghs.github.io/waifuc/main/tutorials/process_images/index.html#common-actions-and-usage-examples
+# Make sure the following are installed first:
+# - https://developer.nvidia.com/cudnn-downloads?target_os=Windows&target_arch=x86_64&target_version=10&target_type=exe_local
+# - https://developer.nvidia.com/cuda-downloads?target_os=Windows&target_arch=x86_64&target_version=11&target_type=exe_local
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    journal = create_journal()
+    manifest = create_manifest()
+    files = None
+    if journal is not None or manifest is not None or workers > 1:
+        files = list_input_files(journal, manifest)
+    if manifest is not None:
+        manifest.prune_deleted(list_input_files(None))
+
+    stats = create_pipeline_stats()
+
+    if workers > 1:
+
+        def merge_shard_stats(result: ShardResult):
+            if stats is not None and result.stats is not None:
+                stats.merge(result.stats)
+                stats.maybe_snapshot()
+
+        run_shards(create_shards(files), process_shard, workers, merge_shard_stats)
+    else:
+        source = attach_actions(
+            create_source(journal, files), create_tag_cache(), journal, stats
+        )
+        source.export(
+            create_exporter(get_output_dir(), journal, manifest, files, stats)
+        )
+
+    if stats is not None:
+        stats.write()
+        stats.log_summary()
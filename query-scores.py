@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from score_matrix import ScoreMatrix
+
+# Examples:
+# python .\process.py --input "T:\..." --tag-only --score-matrix "T:\...\scores"
+# python .\query-scores.py --score-matrix "T:\...\scores" --tag-all-of "green hair" "1girl" --tag-confidence 0.5
+# python .\query-scores.py --score-matrix "T:\...\scores" --general-threshold 0.5 --format ndjson
+# python .\query-scores.py --score-matrix "T:\...\scores" --tag-counts --general-threshold 0.5
+
+parser = argparse.ArgumentParser(
+    prog="query-scores",
+    description=(
+        "Re-thresholds and filters the raw tagger scores recorded with --score-matrix "
+        "without running the tagger again"
+    ),
+)
+parser.add_argument(
+    "--score-matrix",
+    dest="score_matrix",
+    help="Directory of the score matrix",
+    required=True,
+)
+parser.add_argument(
+    "--tag-all-of",
+    dest="tag_all_of",
+    help="Print images that have all of the given tags",
+    nargs="+",
+)
+parser.add_argument(
+    "--tag-none-of",
+    dest="tag_none_of",
+    help="Print images that have none of the given tags",
+    nargs="+",
+)
+parser.add_argument(
+    "--tag-any-of",
+    dest="tag_any_of",
+    help="Print images that have any of the given tags",
+    nargs="+",
+)
+parser.add_argument(
+    "--tag-confidence",
+    dest="tag_confidence",
+    help="Confidence threshold for tag filtering in the range [0-1]",
+    type=float,
+    default=0.6,
+)
+parser.add_argument(
+    "--general-threshold",
+    dest="general_threshold",
+    help="Threshold of general tags printed with --format ndjson or counted with --tag-counts",
+    type=float,
+    default=0.35,
+)
+parser.add_argument(
+    "--character-threshold",
+    dest="character_threshold",
+    help="Threshold of character tags printed with --format ndjson",
+    type=float,
+    default=0.85,
+)
+parser.add_argument(
+    "--keep-overlap",
+    dest="keep_overlap",
+    action="store_true",
+    help="Keep the general tags printed with --format ndjson that overlap a more specific tag, process.py drops them",
+    default=False,
+)
+parser.add_argument(
+    "--format",
+    dest="format",
+    help="Print matching paths, or NDJSON records with the path and the tags above the thresholds",
+    choices=["path", "ndjson"],
+    default="path",
+)
+parser.add_argument(
+    "--tag-counts",
+    dest="tag_counts",
+    action="store_true",
+    help="Print the number of images per tag instead of the images",
+    default=False,
+)
+parser.add_argument(
+    "--compact",
+    dest="compact",
+    action="store_true",
+    help="Merge the segments written by previous runs into one before querying",
+    default=False,
+)
+args = parser.parse_args()
+
+score_matrix_path: str = args.score_matrix
+tag_all_of: list[str] = args.tag_all_of or []
+tag_none_of: list[str] = args.tag_none_of or []
+tag_any_of: list[str] = args.tag_any_of or []
+tag_confidence: float = args.tag_confidence
+general_threshold: float = args.general_threshold
+character_threshold: float = args.character_threshold
+keep_overlap: bool = args.keep_overlap
+output_format: str = args.format
+tag_counts: bool = args.tag_counts
+compact: bool = args.compact
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+
+    matrix = ScoreMatrix(score_matrix_path)
+    if compact:
+        matrix.compact()
+
+    start = time.perf_counter()
+    if tag_counts:
+        for tag, count in matrix.tag_counts(general_threshold).items():
+            print(f"{count}\t{tag.replace('_', ' ')}")
+    else:
+        paths = matrix.filter(tag_all_of, tag_any_of, tag_none_of, tag_confidence)
+        if output_format == "ndjson":
+            tags = matrix.threshold(
+                general_threshold, character_threshold, drop_overlap=not keep_overlap
+            )
+            for path in paths:
+                record = {
+                    "path": path,
+                    "tags": {
+                        tag.replace("_", " "): score
+                        for tag, score in tags.get(path, {}).items()
+                    },
+                }
+                print(json.dumps(record))
+        else:
+            for path in paths:
+                print(path)
+    logging.info(
+        f"Queried {len(matrix)} images in {(time.perf_counter() - start) * 1000:.1f}ms"
+    )
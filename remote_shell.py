@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import subprocess
+import time
+from typing import IO, Optional
+
+logger = logging.getLogger(__name__)
+
+# Exit code of ssh itself failing, as opposed to the remote command
+SSH_ERROR = 255
+
+
+def to_local_path(path: str, use_wsl: bool) -> str:
+    # rsync paths are WSL paths when using WSL, e.g. /mnt/t/... for T:\...
+    match = re.match("^/mnt/([a-z])(/.*)?$", path) if use_wsl else None
+    if not match:
+        return path
+    return f"{match.group(1).upper()}:" + (match.group(2) or "/").replace("/", "\\")
+
+
+def to_rsync_path(path: str, use_wsl: bool) -> str:
+    match = re.match(r"^([A-Za-z]):[\\/](.*)$", path) if use_wsl else None
+    if not match:
+        return path
+    return f"/mnt/{match.group(1).lower()}/" + match.group(2).replace("\\", "/")
+
+
+class SshShell:
+    """
+    Runs commands on a pod over ssh, from WSL when command_prefix is "wsl ".
+    With multiplex, all commands share one long-lived connection through an
+    OpenSSH control socket, so only the first command pays for the handshake.
+    A command failing with a connection error tears the master connection
+    down and is retried once on a fresh one.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        key: Optional[str] = None,
+        command_prefix: str = "",
+        multiplex: bool = True,
+        control_persist: int = 600,
+    ):
+        self.host = host
+        self.port = port
+        self.key = key
+        self.command_prefix = command_prefix
+        # The Windows build of OpenSSH does not support control sockets, WSL does
+        self.multiplex = multiplex and (bool(command_prefix) or os.name != "nt")
+        self.control_persist = control_persist
+        self.commands = 0
+        self.reconnects = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def options(self) -> list[str]:
+        options = ["-p", f"{self.port}"]
+        options.extend(["-i", f"{self.key}"] if self.key else [])
+        options.extend(
+            [
+                "-o",
+                "StrictHostKeyChecking=no",
+                # Detect dead connections instead of hanging on them
+                "-o",
+                "ServerAliveInterval=15",
+                "-o",
+                "ServerAliveCountMax=3",
+            ]
+        )
+        if self.multiplex:
+            options.extend(
+                [
+                    "-o",
+                    "ControlMaster=auto",
+                    # Expanded by ssh, in WSL when using WSL
+                    "-o",
+                    "ControlPath=~/.ssh/start-runpod-%C",
+                    "-o",
+                    f"ControlPersist={self.control_persist}",
+                ]
+            )
+        return options
+
+    def rsync_shell(self) -> str:
+        # Value of rsync -e, so that rsync reuses the same connection
+        return " ".join(["ssh", *self.options()])
+
+    def command(self, remote_command: str) -> list[str]:
+        command = list()
+        command.extend([self.command_prefix.strip()] if self.command_prefix else [])
+        command.extend(["ssh", *self.options(), self.host, remote_command])
+        return command
+
+    def run(
+        self,
+        remote_command: str,
+        check: bool = True,
+        stdin: Optional[IO] = None,
+        capture_output: bool = True,
+        text: bool = True,
+    ) -> subprocess.CompletedProcess:
+        for attempt in range(2):
+            if stdin is not None and attempt:
+                stdin.seek(0)
+            start = time.perf_counter()
+            result = subprocess.run(
+                self.command(remote_command),
+                capture_output=capture_output,
+                text=text,
+                stdin=stdin,
+            )
+            self.record_latency(remote_command, time.perf_counter() - start)
+            if result.returncode != SSH_ERROR or attempt:
+                break
+            logger.warning(f"SSH connection to {self.host} failed, reconnecting")
+            self.reconnects += 1
+            self.disconnect()
+
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(
+                result.returncode, result.args, result.stdout, result.stderr
+            )
+        return result
+
+    def open(self, remote_command: str) -> subprocess.Popen:
+        # Streams the binary output of the command, e.g. the content of a file
+        return subprocess.Popen(self.command(remote_command), stdout=subprocess.PIPE)
+
+    def record_latency(self, remote_command: str, latency: float):
+        self.commands += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        logger.debug(f"SSH command took {latency * 1000:.0f}ms: {remote_command[:80]}")
+
+    def disconnect(self):
+        # Stops the master connection, the next command opens a new one
+        if not self.multiplex:
+            return
+        command = list()
+        command.extend([self.command_prefix.strip()] if self.command_prefix else [])
+        command.extend(["ssh", *self.options(), "-O", "exit", self.host])
+        subprocess.run(command, capture_output=True)
+
+    def close(self):
+        self.disconnect()
+        self.log_stats()
+
+    def log_stats(self):
+        if not self.commands:
+            return
+        logger.info(
+            f"SSH: {self.commands} commands to {self.host}, "
+            f"{self.total_latency / self.commands * 1000:.0f}ms average latency, "
+            f"{self.max_latency * 1000:.0f}ms max, {self.reconnects} reconnects"
+        )
+
+
+class LocalShell:
+    """
+    Stand-in for SshShell running commands locally with bash, e.g. against a folder laid out like the pod.
+    """
+
+    def command(self, remote_command: str) -> list[str]:
+        return ["bash", "-c", remote_command]
+
+    def run(
+        self,
+        remote_command: str,
+        check: bool = True,
+        stdin: Optional[IO] = None,
+        capture_output: bool = True,
+        text: bool = True,
+    ) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            self.command(remote_command),
+            check=check,
+            capture_output=capture_output,
+            text=text,
+            stdin=stdin,
+        )
+
+    def open(self, remote_command: str) -> subprocess.Popen:
+        return subprocess.Popen(self.command(remote_command), stdout=subprocess.PIPE)
+
+    def close(self):
+        pass
@@ -0,0 +1,33 @@
+#!/bin/bash
+# Extracts the dataset shards written by dataset_shards.py, see start-runpod.py --ship-shards
+# Usage: unpack-shards.sh <shard folder> <destination folder>
+set -e
+
+SHARD_DIR="$1"
+DESTINATION="$2"
+
+cd "$SHARD_DIR"
+
+echo "Verifying shards"
+sha256sum --quiet -c SHA256SUMS
+
+mkdir -p "$DESTINATION"
+# Only the verified shards, never a leftover of an earlier transfer
+count=0
+while read -r _ shard; do
+    case "$shard" in
+        *.tar.zst)
+            zstd -dc "$shard" | tar -x -C "$DESTINATION"
+            ;;
+        *.tar.gz)
+            tar -xzf "$shard" -C "$DESTINATION"
+            ;;
+        *.tar)
+            tar -xf "$shard" -C "$DESTINATION"
+            ;;
+    esac
+    count=$((count + 1))
+done < SHA256SUMS
+
+echo "Unpacked $count shards to $DESTINATION"
+rm -f shard-* index.json SHA256SUMS
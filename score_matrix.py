@@ -0,0 +1,327 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import IO, Iterable, Optional
+import numpy as np
+
+from exporters import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+LABELS_FILENAME = "labels.json"
+SCORES_EXTENSION = ".f16"
+INDEX_EXTENSION = ".jsonl"
+
+
+def normalize_label(label: str) -> str:
+    return label.strip().lower().replace("_", " ")
+
+
+class ScoreMatrixWriter:
+    """
+    Appends raw tagger probabilities to a score matrix directory. Every writer
+    creates its own segment, a float16 file of rows x labels and a row index
+    with one JSON line per row, so that concurrent workers never write to the
+    same file. Rows are written before their index line, so an interrupted
+    write at worst leaves a row without index that readers ignore. A closed
+    writer appends to the same segment when it is used again.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segment = f"{time.time_ns()}-{os.getpid()}"
+        self._scores: Optional[IO[bytes]] = None
+        self._index: Optional[IO[str]] = None
+        self._known: Optional[set[str]] = None
+        self._label_count: Optional[int] = None
+
+    @property
+    def known(self) -> set[str]:
+        # Image hashes already in the matrix, from any segment
+        if self._known is None:
+            self._known = set()
+            for path in glob.glob(os.path.join(self.directory, "*" + INDEX_EXTENSION)):
+                with open(path, encoding="utf-8") as f:
+                    self._known.update(json.loads(line)["hash"] for line in f if line.endswith("\n"))
+        return self._known
+
+    def set_labels(
+        self,
+        method: str,
+        labels: list[str],
+        general_indexes: list[int],
+        character_indexes: list[int],
+    ):
+        """
+        Records the labels of the matrix columns, a matrix only holds scores of a single tagger.
+        """
+        path = os.path.join(self.directory, LABELS_FILENAME)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                existing = json.load(f)
+            if existing["method"] != method or existing["labels"] != labels:
+                raise ValueError(
+                    f"Score matrix {self.directory} holds scores of {existing['method']}, not {method}"
+                )
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            # Workers may create the matrix concurrently, they all write the same labels
+            labels_json = json.dumps(
+                {
+                    "method": method,
+                    "labels": labels,
+                    "general": [int(i) for i in general_indexes],
+                    "character": [int(i) for i in character_indexes],
+                }
+            )
+            write_file_atomic(path, labels_json.encode("utf-8"))
+        self._label_count = len(labels)
+
+    def append(
+        self,
+        hashes: list[str],
+        paths: list[Optional[str]],
+        scores: np.ndarray,
+    ):
+        """
+        Appends one row of scores per image, the index lines are only written once the rows are on disk.
+        """
+        if self._label_count is None:
+            raise ValueError("set_labels must be called before appending scores")
+        scores = np.asarray(scores, dtype="<f2").reshape(len(hashes), -1)
+        if scores.shape[1] != self._label_count:
+            raise ValueError(
+                f"Expected {self._label_count} scores per image, got {scores.shape[1]}"
+            )
+        if self._scores is None:
+            base = os.path.join(self.directory, self.segment)
+            self._scores = open(base + SCORES_EXTENSION, "ab")
+            self._index = open(base + INDEX_EXTENSION, "a", encoding="utf-8")
+
+        self._scores.write(scores.tobytes())
+        self._scores.flush()
+        self._index.write(
+            "".join(
+                json.dumps({"hash": image_hash, "path": path}) + "\n"
+                for image_hash, path in zip(hashes, paths)
+            )
+        )
+        self._index.flush()
+        self.known.update(hashes)
+
+    def close(self):
+        if self._scores is not None:
+            self._scores.close()
+            self._index.close()
+            self._scores = self._index = None
+
+
+_writers: dict[str, ScoreMatrixWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_score_matrix_writer(directory: str) -> ScoreMatrixWriter:
+    """
+    Returns the process-wide writer of a score matrix directory, so that all
+    the shards processed by a worker go to a single segment and the hashes
+    already in the matrix are only read once per process.
+    """
+    key = os.path.abspath(directory)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = ScoreMatrixWriter(directory)
+        return _writers[key]
+
+
+@dataclass
+class _Segment:
+    scores: np.ndarray
+    hashes: list[str]
+    paths: list[Optional[str]]
+    # Rows superseded by a more recent row of the same image are masked out
+    valid: np.ndarray
+
+
+class ScoreMatrix:
+    """
+    Read-only view of a score matrix directory: every segment is memory-mapped
+    and queries re-threshold the raw scores with vectorized NumPy, without
+    running the tagger again.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, LABELS_FILENAME), encoding="utf-8") as f:
+            labels = json.load(f)
+        self.method: str = labels["method"]
+        self.labels: list[str] = labels["labels"]
+        self.general_indexes = np.array(labels["general"], dtype=np.int64)
+        self.character_indexes = np.array(labels["character"], dtype=np.int64)
+        self.columns = {normalize_label(label): i for i, label in enumerate(self.labels)}
+        self.segments: list[_Segment] = []
+        self.load_segments()
+
+    def load_segments(self):
+        directory = self.directory
+        self.segments = []
+        latest: dict[str, tuple[int, int]] = {}
+        for index_path in sorted(glob.glob(os.path.join(directory, "*" + INDEX_EXTENSION))):
+            scores_path = index_path[: -len(INDEX_EXTENSION)] + SCORES_EXTENSION
+            with open(index_path, encoding="utf-8") as f:
+                # A line cut short by a crash has no trailing newline
+                rows = [json.loads(line) for line in f if line.endswith("\n")]
+            row_size = len(self.labels) * 2
+            rows = rows[: os.path.getsize(scores_path) // row_size]
+            if not rows:
+                continue
+            scores = np.memmap(
+                scores_path, dtype="<f2", mode="r", shape=(len(rows), len(self.labels))
+            )
+            segment = _Segment(
+                scores,
+                [row["hash"] for row in rows],
+                [row["path"] for row in rows],
+                np.zeros(len(rows), dtype=bool),
+            )
+            for row, image_hash in enumerate(segment.hashes):
+                latest[image_hash] = (len(self.segments), row)
+            self.segments.append(segment)
+
+        for segment_index, row in latest.values():
+            self.segments[segment_index].valid[row] = True
+        logger.info(
+            f"Loaded scores of {len(latest)} images from {len(self.segments)} segments of {directory}"
+        )
+
+    def __len__(self):
+        return sum(int(segment.valid.sum()) for segment in self.segments)
+
+    def column(self, tag: str) -> int:
+        column = self.columns.get(normalize_label(tag))
+        if column is None:
+            raise KeyError(f"{tag} is not a label of {self.method}")
+        return column
+
+    def filter(
+        self,
+        all_of: Iterable[str] = (),
+        any_of: Iterable[str] = (),
+        none_of: Iterable[str] = (),
+        confidence: float = 0.6,
+    ) -> list[str]:
+        """
+        Paths of images that have all of, any of and none of the given tags
+        with a score of at least confidence, like the --tag-*-of options.
+        """
+        all_columns = [self.column(tag) for tag in all_of]
+        any_columns = [self.column(tag) for tag in any_of]
+        none_columns = [self.column(tag) for tag in none_of]
+
+        paths = []
+        for segment in self.segments:
+            mask = segment.valid.copy()
+            if all_columns:
+                mask &= (segment.scores[:, all_columns] >= confidence).all(axis=1)
+            if any_columns:
+                mask &= (segment.scores[:, any_columns] >= confidence).any(axis=1)
+            if none_columns:
+                mask &= ~(segment.scores[:, none_columns] >= confidence).any(axis=1)
+            paths.extend(
+                segment.paths[row] or segment.hashes[row] for row in np.flatnonzero(mask)
+            )
+        return paths
+
+    def threshold(
+        self,
+        general_threshold: float = 0.35,
+        character_threshold: float = 0.85,
+        drop_overlap: bool = True,
+    ) -> dict[str, dict[str, float]]:
+        """
+        Tags of every image with the given thresholds, keyed by image path.
+        Like the pipeline, general tags overlapping a more specific tag are
+        dropped unless drop_overlap is False.
+        """
+        if drop_overlap:
+            # Only needed for the overlap drop, imgutils is slow to import
+            from imgutils.tagging import drop_overlap_tags
+
+            general_labels = set(np.array(self.labels, dtype=object)[self.general_indexes])
+        thresholds = np.full(len(self.labels), np.inf, dtype=np.float32)
+        thresholds[self.general_indexes] = general_threshold
+        thresholds[self.character_indexes] = character_threshold
+
+        labels = np.array(self.labels, dtype=object)
+        result = {}
+        for segment in self.segments:
+            rows, columns = np.nonzero(
+                (segment.scores > thresholds) & segment.valid[:, None]
+            )
+            # Split the matches by row so that only the dicts are built in Python
+            ends = np.searchsorted(rows, np.arange(len(segment.hashes)), side="right")
+            tags = labels[columns].tolist()
+            values = segment.scores[rows, columns].astype(np.float32).tolist()
+            for row in np.flatnonzero(segment.valid):
+                end = int(ends[row])
+                start = int(ends[row - 1]) if row else 0
+                path = segment.paths[row] or segment.hashes[row]
+                row_tags = dict(zip(tags[start:end], values[start:end]))
+                if drop_overlap:
+                    # Same order as wd14_prediction_to_tags, general tags first
+                    general = {
+                        tag: value for tag, value in row_tags.items() if tag in general_labels
+                    }
+                    row_tags = {
+                        **drop_overlap_tags(general),
+                        **{
+                            tag: value
+                            for tag, value in row_tags.items()
+                            if tag not in general_labels
+                        },
+                    }
+                result[path] = row_tags
+        return result
+
+    def tag_counts(self, threshold: float = 0.35) -> dict[str, int]:
+        """
+        Number of images per tag for the given threshold, most frequent first.
+        """
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        for segment in self.segments:
+            counts += ((segment.scores >= threshold) & segment.valid[:, None]).sum(axis=0)
+        order = np.argsort(-counts, kind="stable")
+        return {self.labels[i]: int(counts[i]) for i in order if counts[i] > 0}
+
+    def compact(self):
+        """
+        Rewrites all the valid rows into a single segment and deletes the others,
+        it must not run while the matrix is being written to.
+        """
+        segments = [
+            os.path.splitext(path)[0]
+            for path in glob.glob(os.path.join(self.directory, "*" + INDEX_EXTENSION))
+        ]
+        writer = ScoreMatrixWriter(self.directory)
+        writer.set_labels(
+            self.method, self.labels, self.general_indexes, self.character_indexes
+        )
+        for segment in self.segments:
+            rows = np.flatnonzero(segment.valid)
+            writer.append(
+                [segment.hashes[row] for row in rows],
+                [segment.paths[row] for row in rows],
+                segment.scores[rows],
+            )
+        writer.close()
+        # Memory maps must be released before their files can be deleted on Windows
+        self.segments = []
+        for base in segments:
+            os.remove(base + INDEX_EXTENSION)
+            if os.path.exists(base + SCORES_EXTENSION):
+                os.remove(base + SCORES_EXTENSION)
+        logger.info(f"Compacted {len(segments)} segments of {self.directory}")
+        self.load_segments()
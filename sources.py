@@ -0,0 +1,302 @@
+import logging
+import mimetypes
+import multiprocessing
+import os
+import queue
+from typing import Iterator, List, Optional
+import av
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+from waifuc.model import ImageItem
+from waifuc.source import BaseDataSource
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
+
+
+def list_image_files(directory: str, recursive: bool = True) -> List[str]:
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                files.append(os.path.join(root, filename))
+        if not recursive:
+            break
+    return files
+
+
+def list_video_files(directory: str, recursive: bool = True) -> List[str]:
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(filenames):
+            mimetype, _ = mimetypes.guess_type(filename)
+            if mimetype and mimetype.startswith("video/"):
+                files.append(os.path.join(root, filename))
+        if not recursive:
+            break
+    return files
+
+
+class LocalFilesSource(BaseDataSource):
+    """
+    Same as LocalSource but for an explicit list of files under directory,
+    so that a directory can be split into shards.
+    With lazy=True only the image header is read up front (width, height and
+    format are added to the meta), and pixels are decoded the first time a
+    later stage accesses them, so images dropped by size or format filters are
+    never decoded. `decoded` counts the images whose pixels were decoded.
+    """
+
+    def __init__(self, directory: str, files: List[str], lazy: bool = False):
+        self.directory = directory
+        self.files = files
+        self.lazy = lazy
+        self.decoded = 0
+
+    def _count_decode(self, image: Image.Image):
+        load = image.load
+
+        def counting_load():
+            if image.im is None:
+                self.decoded += 1
+            return load()
+
+        # PIL calls self.load() before any pixel access, so this catches every decode
+        image.load = counting_load
+
+    def _iter(self) -> Iterator[ImageItem]:
+        self.decoded = 0
+        for file in self.files:
+            try:
+                # Image.open only parses the header, pixels are read by load()
+                origin_item = ImageItem.load_from_image(file)
+                if self.lazy:
+                    self._count_decode(origin_item.image)
+                else:
+                    origin_item.image.load()
+                    self.decoded += 1
+            except UnidentifiedImageError:
+                continue
+
+            meta = origin_item.meta or {
+                "filename": os.path.relpath(file, self.directory)
+            }
+            # Sidecar meta may point to the file this image was extracted from, the journal and manifest need this file
+            meta = {**meta, "path": os.path.abspath(file)}
+            if self.lazy:
+                image = origin_item.image
+                meta = {
+                    **meta,
+                    "width": image.width,
+                    "height": image.height,
+                    "format": image.format,
+                }
+            yield ImageItem(origin_item.image, meta)
+
+        if self.lazy:
+            logger.info(
+                f"Decoded {self.decoded} of {len(self.files)} images, "
+                "the others were filtered out from their header"
+            )
+
+
+class ComposedSource(BaseDataSource):
+    def __init__(self, sources: List[BaseDataSource]):
+        self.sources = sources
+
+    def _iter(self) -> Iterator[ImageItem]:
+        for source in self.sources:
+            yield from source._iter()
+
+
+class SceneVideoSource(BaseDataSource):
+    """
+    Extracts frames from a video, skipping the ones that barely differ from
+    the last emitted frame before they are converted to RGB. Mode "scene"
+    compares a small grayscale thumbnail of each decoded frame with the last
+    emitted one, mode "keyframe" only decodes keyframes and mode "interval"
+    behaves like VideoSource.
+    """
+
+    def __init__(
+        self,
+        video_file: str,
+        mode: str = "scene",
+        min_frame_interval: Optional[float] = None,
+        scene_threshold: float = 0.05,
+        thumbnail_size: tuple[int, int] = (64, 36),
+        start_after: Optional[float] = None,
+    ):
+        if mode not in ("interval", "scene", "keyframe"):
+            raise ValueError(f"Unknown frame extraction mode - {mode!r}.")
+        self.video_file = video_file
+        self.mode = mode
+        self.min_frame_interval = min_frame_interval
+        self.scene_threshold = scene_threshold
+        self.thumbnail_size = thumbnail_size
+        # Frames up to this time (in seconds) are skipped, e.g. when resuming an interrupted run
+        self.start_after = start_after
+        self.decoded = 0
+        self.emitted = 0
+
+    @classmethod
+    def from_directory(
+        cls, directory: str, recursive: bool = True, **kwargs
+    ) -> ComposedSource:
+        return ComposedSource(
+            [cls(file, **kwargs) for file in list_video_files(directory, recursive)]
+        )
+
+    def _thumbnail(self, frame: av.VideoFrame) -> np.ndarray:
+        width, height = self.thumbnail_size
+        return frame.to_ndarray(width=width, height=height, format="gray").astype(
+            np.int16
+        )
+
+    def _iter(self) -> Iterator[ImageItem]:
+        filebody, _ = os.path.splitext(os.path.basename(self.video_file))
+        self.decoded = 0
+        self.emitted = 0
+        last_time: Optional[float] = None
+        last_thumbnail: Optional[np.ndarray] = None
+
+        try:
+            with av.open(self.video_file) as container:
+                stream = container.streams.video[0]
+                if self.mode == "keyframe":
+                    # Let the decoder skip every non-keyframe instead of decoding and dropping them
+                    stream.codec_context.skip_frame = "NONKEY"
+                if self.start_after is not None:
+                    # Seek to the keyframe before the resume point instead of decoding from the start
+                    container.seek(
+                        int(self.start_after / stream.time_base),
+                        backward=True,
+                        stream=stream,
+                    )
+                    last_time = self.start_after
+                frame_rate = float(stream.average_rate or 0)
+
+                for count, frame in enumerate(container.decode(stream)):
+                    self.decoded += 1
+                    frame_time = frame.time
+                    # Derive the index from the frame time so that it stays the same after a seek
+                    index = (
+                        round(frame_time * frame_rate)
+                        if frame_time is not None and frame_rate
+                        else count
+                    )
+                    if (
+                        self.start_after is not None
+                        and frame_time is not None
+                        and frame_time <= self.start_after
+                    ):
+                        continue
+                    if (
+                        self.min_frame_interval is not None
+                        and last_time is not None
+                        and frame_time is not None
+                        and frame_time - last_time < self.min_frame_interval
+                    ):
+                        continue
+
+                    if self.mode == "scene":
+                        thumbnail = self._thumbnail(frame)
+                        if last_thumbnail is not None:
+                            diff = np.abs(thumbnail - last_thumbnail).mean() / 255
+                            if diff < self.scene_threshold:
+                                continue
+                        last_thumbnail = thumbnail
+
+                    last_time = frame_time
+                    self.emitted += 1
+                    yield ImageItem(
+                        frame.to_image(),
+                        {
+                            "video": self.video_file,
+                            "time": frame_time,
+                            "index": index,
+                            "filename": f"{filebody}_frame_{index}.png",
+                        },
+                    )
+        except (av.error.InvalidDataError, av.error.EOFError) as e:
+            logger.warning(f"Failed to decode {self.video_file}: {e}")
+
+        logger.info(
+            f"{os.path.basename(self.video_file)}: {self.decoded} frames decoded, "
+            f"{self.emitted} emitted, {self.decoded - self.emitted} dropped"
+        )
+
+
+def _decode_to_queue(source: BaseDataSource, items: multiprocessing.Queue):
+    # Spawned processes start without the logging configuration of the parent
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    try:
+        for item in source._iter():
+            items.put(item)
+        items.put(None)
+    except BaseException as e:
+        items.put(RuntimeError(f"{type(e).__name__}: {e}"))
+
+
+class ParallelVideoSource(BaseDataSource):
+    """
+    Decodes up to `workers` video sources concurrently in worker processes.
+    Frames are streamed back through one bounded queue per video and yielded
+    in source order, so output filenames are the same as with sequential decoding.
+    """
+
+    def __init__(
+        self, sources: List[BaseDataSource], workers: int, queue_size: int = 32
+    ):
+        self.sources = sources
+        self.workers = workers
+        self.queue_size = queue_size
+
+    def _iter(self) -> Iterator[ImageItem]:
+        context = multiprocessing.get_context("spawn")
+        running: List[tuple[multiprocessing.Process, multiprocessing.Queue]] = []
+        next_source = 0
+
+        def start_next():
+            nonlocal next_source
+            items = context.Queue(maxsize=self.queue_size)
+            process = context.Process(
+                target=_decode_to_queue,
+                args=(self.sources[next_source], items),
+                daemon=True,
+            )
+            process.start()
+            running.append((process, items))
+            next_source += 1
+
+        try:
+            while next_source < len(self.sources) or running:
+                while len(running) < self.workers and next_source < len(self.sources):
+                    start_next()
+
+                # Drain the oldest video first, later ones keep decoding until their queue is full
+                process, items = running[0]
+                while True:
+                    try:
+                        item = items.get(timeout=1)
+                    except queue.Empty:
+                        if not process.is_alive() and items.empty():
+                            raise RuntimeError(
+                                f"Video decoding worker exited with code {process.exitcode}"
+                            )
+                        continue
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+
+                process.join()
+                running.pop(0)
+        finally:
+            for process, _ in running:
+                if process.is_alive():
+                    process.terminate()
@@ -4,13 +4,25 @@ import os
 import argparse
 import time
 import requests
-import subprocess
 import logging
 import sys
 import signal
-import re
+import atexit
+import tempfile
 from rich.logging import RichHandler
 
+from dataset_shards import COMPRESSIONS, DEFAULT_SHARD_SIZE_MB, pack_dataset
+from pod_polling import (
+    HTTP_TIMEOUT,
+    AdaptiveInterval,
+    PhaseTimer,
+    PodReadiness,
+    create_session,
+)
+from pod_sync import PodSync
+from remote_shell import SshShell, to_local_path, to_rsync_path
+from training_log import TrainingLogTailer, format_progress
+
 # Example usage
 # python .\start-runpod.py --terminate --checkpoint-url "https://huggingface.co/LyliaEngine/Pony_Diffusion_V6_XL/resolve/main/ponyDiffusionV6XL_v6StartWithThisOne.safetensors" --use-wsl --rsync-from "/mnt/t/stablediffusion/training/transfer"
 
@@ -106,6 +118,33 @@ parser.add_argument(
     dest="rsync_from",
     help="Run rsync to copy local files to pod",
 )
+parser.add_argument(
+    "--ship-shards",
+    dest="ship_shards",
+    action="store_true",
+    help="With --rsync-from, pack the folder into tar shards, transfer the shards and unpack them on the pod "
+    "instead of transferring every file individually",
+    default=False,
+)
+parser.add_argument(
+    "--shard-size-mb",
+    dest="shard_size_mb",
+    help="Size of each shard used by --ship-shards",
+    default=str(DEFAULT_SHARD_SIZE_MB),
+)
+parser.add_argument(
+    "--shard-compression",
+    dest="shard_compression",
+    help="Compression of the shards used by --ship-shards, zstd requires zstandard locally and zstd on the pod",
+    choices=list(COMPRESSIONS),
+    default="none",
+)
+parser.add_argument(
+    "--shard-dir",
+    dest="shard_dir",
+    help="Local folder where --ship-shards writes the shards",
+    default=os.path.join(tempfile.gettempdir(), "start-runpod-shards"),
+)
 parser.add_argument(
     "-w",
     "--use-wsl",
@@ -120,6 +159,19 @@ parser.add_argument(
     dest="rsync_to",
     help="Run rsync to copy pod files to specified local folder",
 )
+parser.add_argument(
+    "--delta-sync",
+    dest="delta_sync",
+    action="store_true",
+    help="Copy pod files with a content-hash manifest instead of rsync, only new or changed files are transferred",
+    default=False,
+)
+parser.add_argument(
+    "--sync-streams",
+    dest="sync_streams",
+    help="Number of files copied in parallel by --delta-sync",
+    default="4",
+)
 parser.add_argument(
     "-m",
     "--monitor-training",
@@ -128,6 +180,12 @@ parser.add_argument(
     help="Monitor training continuously",
     default=False,
 )
+parser.add_argument(
+    "--metrics-file",
+    dest="metrics_file",
+    help="With --monitor-training, append epoch, step, loss and it/s of the training to this CSV file "
+    "(or NDJSON file when ending with .ndjson)",
+)
 parser.add_argument(
     "-c",
     "--continuous-rsync",
@@ -171,8 +229,15 @@ parser.add_argument(
     "-s",
     "--iter-sec",
     dest="iter_sec",
-    help="Wait for X seconds before each training status check iteration",
-    default="10",
+    help="Wait for at most X seconds between training status checks, checks are more frequent "
+    "when training starts or stops and near the expected end of training",
+    default="60",
+)
+parser.add_argument(
+    "--min-iter-sec",
+    dest="min_iter_sec",
+    help="Wait for at least X seconds between status checks",
+    default="2",
 )
 parser.add_argument(
     "-a",
@@ -208,6 +273,7 @@ ssh_key: str = args.ssh_key
 use_wsl: bool = args.use_wsl
 rsync_from: str = args.rsync_from
 monitor_training: bool = args.monitor_training
+metrics_file: str = args.metrics_file
 rsync_to: str = args.rsync_to
 terminate_after_training: bool = args.terminate_after_training
 immediate: bool = args.immediate
@@ -216,7 +282,14 @@ continuous_rsync: bool = args.continuous_rsync
 wait_for_training_start: bool = args.wait_for_training_start
 wait_for_sec: int = int(args.wait_for_sec)
 iter_sec: int = int(args.iter_sec)
+min_iter_sec: int = int(args.min_iter_sec)
 submit_training_files: bool = args.submit_training_files
+ship_shards: bool = args.ship_shards
+shard_size_mb: float = float(args.shard_size_mb)
+shard_compression: str = args.shard_compression
+shard_dir: str = args.shard_dir
+delta_sync: bool = args.delta_sync
+sync_streams: int = int(args.sync_streams)
 
 load_dotenv()
 
@@ -224,7 +297,35 @@ runpod.api_key = os.getenv("RUNPOD_API_KEY")
 
 command_prefix = "wsl " if use_wsl else ""
 
-epoch_progress_regex = re.compile("epoch ([0-9]+)/([0-9]+)")
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+UNPACK_SHARDS_SCRIPT = os.path.join(SCRIPT_DIR, "runpod", "unpack-shards.sh")
+REMOTE_TRAINING_DIR = "/home/ht/training"
+REMOTE_SHARD_DIR = "/home/ht/training/.shards"
+
+# Reused across monitoring iterations so that the manifest stays open
+pod_sync: PodSync | None = None
+# All remote commands share one multiplexed SSH connection
+ssh_shell: SshShell | None = None
+# Keeps the offset of the training log between progress checks
+training_log: TrainingLogTailer | None = None
+# Keeps connections to the pod alive between status checks
+session = create_session()
+# Readiness checks slow down to this interval while the pod boots
+READINESS_MAX_INTERVAL = 15
+
+
+def get_ssh_shell(ssh_public_port: int, ip: str) -> SshShell:
+    global ssh_shell
+    host = f"kasm-user@{ip}"
+    # A restarted pod gets a new address, its old master connection is dead
+    if ssh_shell is not None and (ssh_shell.host, ssh_shell.port) != (host, ssh_public_port):
+        atexit.unregister(ssh_shell.close)
+        ssh_shell.close()
+        ssh_shell = None
+    if ssh_shell is None:
+        ssh_shell = SshShell(host, ssh_public_port, ssh_key, command_prefix)
+        atexit.register(ssh_shell.close)
+    return ssh_shell
 
 
 def transfer_files_to_pod(ssh_public_port: int, ip: str):
@@ -234,23 +335,79 @@ def transfer_files_to_pod(ssh_public_port: int, ip: str):
         logger.info("SSH key not specified via --ssh-key, cannot transfer files")
         return
 
+    if ship_shards:
+        transfer_shards_to_pod(ssh_public_port, ip)
+        return
+
+    shell = get_ssh_shell(ssh_public_port, ip)
     os.system(
-        f"{command_prefix}rsync -avzP -e 'ssh -p {ssh_public_port} -i {ssh_key} -o \"StrictHostKeyChecking=no\"' "
+        f"{command_prefix}rsync -avzP -e '{shell.rsync_shell()}' "
         f"{rsync_from} kasm-user@{ip}:/home/ht/training/"
     )
 
 
-def transfer_files_from_pod(ssh_public_port: int, ip: str):
+def transfer_shards_to_pod(ssh_public_port: int, ip: str):
+    start = time.perf_counter()
+    local_shard_dir = os.path.join(shard_dir, pod_name)
+    index = pack_dataset(
+        to_local_path(rsync_from, use_wsl), local_shard_dir, shard_size_mb, shard_compression
+    )
+    packed = time.perf_counter()
+
+    # Compressing uncompressed shards on the wire still helps with captions,
+    # shards left over by an earlier failed unpack are deleted
+    rsync_options = "-avzP --delete" if shard_compression == "none" else "-avP --delete"
+    shell = get_ssh_shell(ssh_public_port, ip)
+    os.system(
+        f"{command_prefix}rsync {rsync_options} -e '{shell.rsync_shell()}' "
+        f"{to_rsync_path(local_shard_dir, use_wsl)}/ kasm-user@{ip}:{REMOTE_SHARD_DIR}/"
+    )
+    transferred = time.perf_counter()
+
+    remote_command = f"bash -s -- {REMOTE_SHARD_DIR} {REMOTE_TRAINING_DIR}"
+    logger.info(remote_command)
+    with open(UNPACK_SHARDS_SCRIPT, "rb") as script:
+        result = shell.run(
+            remote_command, check=False, stdin=script, capture_output=False
+        )
+    if result.returncode != 0:
+        logger.error(f"Failed to unpack shards, got return code {result.returncode}")
+        return
+
+    files = sum(len(shard["files"]) for shard in index["shards"])
+    logger.info(
+        f"Shipped {files} files in {len(index['shards'])} shards in {time.perf_counter() - start:.1f}s "
+        f"(pack {packed - start:.1f}s, transfer {transferred - packed:.1f}s, "
+        f"unpack {time.perf_counter() - transferred:.1f}s)"
+    )
+
+
+def transfer_files_from_pod(ssh_public_port: int, ip: str, final: bool = False):
     logger.info("Transfering files from pod to local folder")
 
     if not ssh_key:
         logger.error("SSH key not specified via --ssh-key, cannot transfer files")
         return
 
+    if delta_sync:
+        global pod_sync
+        if pod_sync is None:
+            pod_sync = PodSync(
+                get_ssh_shell(ssh_public_port, ip),
+                REMOTE_TRAINING_DIR,
+                to_local_path(rsync_to, use_wsl),
+                streams=sync_streams,
+            )
+        # Follows the pod to its new address after a restart
+        pod_sync.shell = get_ssh_shell(ssh_public_port, ip)
+        pod_sync.sync(final)
+        return
+
     # Include all subfolders of /home/ht/training
     # Except for LoRA_Easy_Training_Scripts
+    shell = get_ssh_shell(ssh_public_port, ip)
     os.system(
-        f"{command_prefix}rsync -avzP -e 'ssh -p {ssh_public_port} -i {ssh_key} -o \"StrictHostKeyChecking=no\"' "
+        f"{command_prefix}rsync -avzP -e '{shell.rsync_shell()}' "
         "--exclude='LoRA_Easy_Training_Scripts' --include='/*/' --include='/*/**' --exclude='*' "
         f"kasm-user@{ip}:/home/ht/training/ {rsync_to}"
     )
@@ -273,6 +430,8 @@ def wait_for_training(pod: dict, ssh_public_port: int, ip: str):
 
     prev_is_training: bool | None = None
     training_started: bool = False
+    interval = AdaptiveInterval(min_iter_sec, iter_sec)
+    phase = PhaseTimer("Training started")
 
     training_input_files = (
         get_training_input_files(ssh_public_port, ip) if submit_training_files else []
@@ -286,13 +445,20 @@ def wait_for_training(pod: dict, ssh_public_port: int, ip: str):
 
     while True:
         responded = False
+        phase.checks += 1
         try:
-            res = requests.get(f"{pod_training_url}/is_training")
+            res = session.get(f"{pod_training_url}/is_training", timeout=HTTP_TIMEOUT)
             if res.status_code == 200:
                 res_json = res.json()
                 is_training: bool = res_json["training"]
                 responded = True
 
+                if is_training and not prev_is_training:
+                    # Poll again soon to follow the progress of the new training
+                    interval.reset()
+                if is_training and phase.name == "Training started":
+                    phase.done()
+                    phase = PhaseTimer("Training stopped")
                 if is_training:
                     training_started = True
             else:
@@ -320,13 +486,19 @@ def wait_for_training(pod: dict, ssh_public_port: int, ip: str):
                     time.sleep(wait_for_sec)
 
                 logger.info("Training stopped")
+                if phase.name == "Training stopped":
+                    phase.done()
 
                 if rsync_to:
-                    transfer_files_from_pod(ssh_public_port, ip)
+                    # Training is over, files written in its last seconds are complete
+                    transfer_files_from_pod(ssh_public_port, ip, final=True)
 
                 if not is_training and len(training_input_files):
                     training_file = training_input_files.pop()
                     submit_training_input_file(ssh_public_port, ip, training_file)
+                    # Statuses read before the submit must not count towards the next stop
+                    prev_is_training = None
+                    phase = PhaseTimer("Training started")
                 else:
                     if terminate_after_training:
                         terminate_pod(pod_id)
@@ -353,7 +525,17 @@ def wait_for_training(pod: dict, ssh_public_port: int, ip: str):
 
             prev_is_training = None
 
-        time.sleep(iter_sec)
+        # Slow mid-epoch, faster when the end of training is near
+        remaining = (
+            training_log.latest.remaining_sec
+            if responded and is_training and training_log and training_log.latest
+            else None
+        )
+        wait = interval.next(remaining)
+        if responded and not is_training and (not wait_for_training_start or training_started):
+            # The poll confirming that training stopped is never sooner than --iter-sec
+            wait = max(wait, iter_sec)
+        time.sleep(wait)
 
 
 def get_or_create_pod():
@@ -405,25 +587,11 @@ def get_or_create_pod():
 def get_training_input_files(ssh_public_port: int, ip: str):
     logger.info("Getting list of input files to submit for training")
 
-    command = list()
-    command.extend([command_prefix] if command_prefix else [])
-    command.extend(
-        [
-            "ssh",
-            f"kasm-user@{ip}",
-            "-p",
-            f"{ssh_public_port}",
-            "-i",
-            f"{ssh_key}",
-            "find",
-            "/home/ht/training",
-            "-name",
-            "backend_input.json",
-        ]
-    )
-    logger.info(" ".join(command))
+    shell = get_ssh_shell(ssh_public_port, ip)
+    remote_command = "find /home/ht/training -name backend_input.json"
+    logger.info(remote_command)
 
-    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    result = shell.run(remote_command, check=False)
     if result.returncode != 0:
         logger.error(
             "Failed to get list of backend_input.json files to submit for training, "
@@ -445,25 +613,16 @@ def get_training_input_files(ssh_public_port: int, ip: str):
 def submit_training_input_file(ssh_public_port: int, ip: str, file_path: str):
     logger.info(f"Validating training file {file_path}")
 
-    command = list()
-    command.extend([command_prefix] if command_prefix else [])
-    command.extend(
-        [
-            "ssh",
-            f"kasm-user@{ip}",
-            "-p",
-            f"{ssh_public_port}",
-            "-i",
-            f"{ssh_key}",
-            f"jq '.args.general_args.gradient_checkpointing=\"false\"' {file_path} | "
-            # f"cat {file_path} | "
-            'curl --fail --no-progress-meter -X POST -H "Content-Type: application/json" '
-            '--data @- "http://localhost:8000/validate"',
-        ]
+    shell = get_ssh_shell(ssh_public_port, ip)
+    remote_command = (
+        f"jq '.args.general_args.gradient_checkpointing=\"false\"' {file_path} | "
+        # f"cat {file_path} | "
+        'curl --fail --no-progress-meter -X POST -H "Content-Type: application/json" '
+        '--data @- "http://localhost:8000/validate"'
     )
-    logger.info(" ".join(command))
+    logger.info(remote_command)
 
-    result = subprocess.run(command, check=True)
+    result = shell.run(remote_command, check=False, capture_output=False)
     if result.returncode != 0:
         logger.error(
             f"Failed to validate training file, got return code {result.returncode}"
@@ -472,58 +631,33 @@ def submit_training_input_file(ssh_public_port: int, ip: str, file_path: str):
 
     logger.info(f"Starting training for file {file_path}")
 
-    command = list()
-    command.extend([command_prefix] if command_prefix else [])
-    command.extend(
-        [
-            "ssh",
-            f"kasm-user@{ip}",
-            "-p",
-            f"{ssh_public_port}",
-            "-i",
-            f"{ssh_key}",
-            'curl --fail --no-progress-meter "http://localhost:8000/train?train_mode=lora&sdxl=True"',
-        ]
-    )
-    logger.info(" ".join(command))
+    remote_command = 'curl --fail --no-progress-meter "http://localhost:8000/train?train_mode=lora&sdxl=True"'
+    logger.info(remote_command)
 
-    result = subprocess.run(command, check=True)
+    result = shell.run(remote_command, check=False, capture_output=False)
     if result.returncode != 0:
         logger.error(f"Failed to start training, got return code {result.returncode}")
         exit(1)
 
 
 def print_training_progress(ssh_public_port: int, ip: str):
-    command = list()
-    command.extend([command_prefix] if command_prefix else [])
-    command.extend(
-        [
-            "ssh",
-            f"kasm-user@{ip}",
-            "-p",
-            f"{ssh_public_port}",
-            "-i",
-            f"{ssh_key}",
-            'tac /home/ht/training/LoRA_Easy_Training_Scripts/run_out.txt | grep -E -m1 "epoch ([0-9]+)/([0-9]+)"',
-        ]
-    )
-    logger.info(" ".join(command))
-
-    result = subprocess.run(command, check=False, capture_output=True, text=True)
-    if result.returncode != 0:
-        logger.warning(
-            f"Training still ongoing but failed to retrieve progress, got return code {result.returncode}"
+    global training_log
+    if training_log is None:
+        training_log = TrainingLogTailer(
+            get_ssh_shell(ssh_public_port, ip), metrics_path=metrics_file
         )
-        return
+        atexit.register(training_log.close)
+    training_log.shell = get_ssh_shell(ssh_public_port, ip)
 
-    match = epoch_progress_regex.search(result.stdout)
-    if not match:
+    metrics = training_log.poll()
+    if metrics is None:
+        logger.warning("Training still ongoing but failed to retrieve progress")
+        return
+    if metrics.epoch is None and metrics.step is None:
         logger.warning("Failed to parse training progress")
         return
 
-    epoch_current = match.group(1)
-    epoch_total = match.group(2)
-    logger.info(f"Training at epoch {epoch_current}/{epoch_total}")
+    logger.info(f"Training at {format_progress(metrics)}")
 
 
 if __name__ == "__main__":
@@ -553,30 +687,14 @@ if __name__ == "__main__":
     logger.info("Username: kasm_user")
     logger.info(f"Password: {password}")
 
-    while True:
-        try:
-            # Refresh pod information
-            pod = runpod.get_pod(pod_id)
-            ssh_ports = []
-            if pod["runtime"] and pod["runtime"]["ports"]:
-                ssh_ports = [
-                    port
-                    for port in pod["runtime"]["ports"]
-                    if port["privatePort"] == 22
-                ]
-
-            res = requests.get(pod_vnc_url)
-            # Wait for both VNC and SSH to be ready
-            if res.status_code == 200 and ssh_ports:
-                break
-            logger.info("Pod is not ready yet, waiting 5 seconds")
-        except requests.exceptions.RequestException:
-            logger.info("Pod is not ready yet, waiting 5 seconds")
-
-        time.sleep(5)
-
-    ip: str = ssh_ports[0]["ip"]
-    ssh_public_port: int = ssh_ports[0]["publicPort"]
+    # Wait for both VNC and SSH to be ready
+    readiness = PodReadiness(
+        pod_id, pod_vnc_url, pod_training_url, session, runpod.get_pod
+    )
+    ssh_port = readiness.wait(AdaptiveInterval(min_iter_sec, READINESS_MAX_INTERVAL))
+
+    ip: str = ssh_port["ip"]
+    ssh_public_port: int = ssh_port["publicPort"]
 
     logger.info(f"Desktop url: {pod_vnc_url}")
     logger.info(f"Public IP: {ip}")
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Mapping, Optional
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TAG_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "sd-training-tools", "tag-cache.sqlite3"
+)
+DEFAULT_TAG_CACHE_MAX_SIZE_MB = 512
+
+
+def hash_image(image: Image.Image) -> str:
+    # Hash decoded pixels rather than file bytes so that video frames and re-encoded files share entries
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def tagger_fingerprint(method: str, kwargs: Mapping[str, Any]) -> str:
+    # Tags depend on the model and on every threshold passed to it
+    return json.dumps({"method": method, **kwargs}, sort_keys=True, default=str)
+
+
+class TagCache:
+    """
+    Persistent tag cache keyed by image content hash and tagger fingerprint (model + thresholds).
+    Least recently used entries are evicted once the total payload exceeds max_size_mb.
+    Several processes may share the cache: reads never write, the last use of
+    hits is recorded on commit, so callers commit often to keep write
+    transactions short.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_TAG_CACHE_PATH,
+        max_size_mb: float = DEFAULT_TAG_CACHE_MAX_SIZE_MB,
+    ):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._size: Optional[int] = None
+        # Hits whose last_used is updated on the next commit
+        self._touched: list[tuple[float, str, str]] = []
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Connect lazily so that the cache can be pickled/deepcopied before use
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tags ("
+                "image_hash TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "tags TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (image_hash, fingerprint))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tags_last_used ON tags (last_used)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tags"
+            ).fetchone()[0]
+        return self._size
+
+    def get(self, image_hash: str, fingerprint: str) -> Optional[dict[str, float]]:
+        row = self.conn.execute(
+            "SELECT tags FROM tags WHERE image_hash = ? AND fingerprint = ?",
+            (image_hash, fingerprint),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched.append((time.time(), image_hash, fingerprint))
+        return json.loads(row[0])
+
+    def put(self, image_hash: str, fingerprint: str, tags: Mapping[str, float]):
+        payload = json.dumps(dict(tags), ensure_ascii=False)
+        size = len(image_hash) + len(fingerprint) + len(payload.encode("utf-8"))
+        previous = self.conn.execute(
+            "SELECT size FROM tags WHERE image_hash = ? AND fingerprint = ?",
+            (image_hash, fingerprint),
+        ).fetchone()
+        current_size = self.size
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tags (image_hash, fingerprint, tags, size, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (image_hash, fingerprint, payload, size, time.time()),
+        )
+        self._size = current_size + size - (previous[0] if previous else 0)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its max size
+        target = int(self.max_size * 0.9)
+        rows = self.conn.execute(
+            "SELECT image_hash, fingerprint, size FROM tags ORDER BY last_used ASC"
+        )
+        to_delete = []
+        size = self.size
+        for image_hash, fingerprint, entry_size in rows:
+            if size <= target:
+                break
+            to_delete.append((image_hash, fingerprint))
+            size -= entry_size
+        self.conn.executemany(
+            "DELETE FROM tags WHERE image_hash = ? AND fingerprint = ?", to_delete
+        )
+        self.conn.commit()
+        self.evictions += len(to_delete)
+        self._size = size
+
+    def commit(self):
+        if self._conn is None:
+            return
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE tags SET last_used = ? WHERE image_hash = ? AND fingerprint = ?",
+                self._touched,
+            )
+            self._touched = []
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self.commit()
+            self._conn.close()
+            self._conn = None
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+        logger.info(
+            f"Tag cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+            f"{self.evictions} evictions, {self.size / 1024 / 1024:.1f}MB used of "
+            f"{self.max_size / 1024 / 1024:.0f}MB ({self.path})"
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_touched"] = []
+        return state
@@ -0,0 +1,410 @@
+import logging
+import os
+import re
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterable, List, Mapping, Optional, Union
+import numpy as np
+from waifuc.export import BaseExporter
+from waifuc.model import ImageItem
+
+from vocabulary import normalize_tag
+
+logger = logging.getLogger(__name__)
+
+
+class TagIndex:
+    """
+    Inverted index of image tags: one posting list of (image, score) per tag,
+    stored in sqlite and clustered by tag so that reading the images of a tag
+    is a single range scan. Queries turn posting lists into bitmaps over image
+    ids and combine them with NumPy.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._tag_ids: dict[str, int] = {}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "id INTEGER PRIMARY KEY, "
+                "path TEXT NOT NULL UNIQUE, "
+                "mtime_ns INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tags ("
+                "id INTEGER PRIMARY KEY, "
+                "name TEXT NOT NULL UNIQUE)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "tag_id INTEGER NOT NULL, "
+                "image_id INTEGER NOT NULL, "
+                "score REAL NOT NULL, "
+                "PRIMARY KEY (tag_id, image_id)) WITHOUT ROWID"
+            )
+            # Used to replace the postings of a re-indexed image
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS postings_image ON postings (image_id)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def tag_id(self, tag: str, create: bool = False) -> Optional[int]:
+        name = normalize_tag(tag)
+        tag_id = self._tag_ids.get(name)
+        if tag_id is None:
+            row = self.conn.execute(
+                "SELECT id FROM tags WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                row = (
+                    self.conn.execute(
+                        "INSERT INTO tags (name) VALUES (?)", (name,)
+                    ).lastrowid,
+                )
+            tag_id = self._tag_ids[name] = row[0]
+        return tag_id
+
+    def changed_files(self, files: Iterable[str]) -> List[str]:
+        # Files that are not indexed yet or were modified since they were indexed
+        indexed = dict(self.conn.execute("SELECT path, mtime_ns FROM images"))
+        return [
+            file
+            for file in files
+            if indexed.get(os.path.abspath(file)) != os.stat(file).st_mtime_ns
+        ]
+
+    def add(self, path: str, tags: Mapping[str, float]):
+        path = os.path.abspath(path)
+        mtime_ns = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+        row = self.conn.execute(
+            "SELECT id FROM images WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            image_id = self.conn.execute(
+                "INSERT INTO images (path, mtime_ns) VALUES (?, ?)", (path, mtime_ns)
+            ).lastrowid
+        else:
+            image_id = row[0]
+            self.conn.execute(
+                "UPDATE images SET mtime_ns = ? WHERE id = ?", (mtime_ns, image_id)
+            )
+            self.conn.execute("DELETE FROM postings WHERE image_id = ?", (image_id,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO postings (tag_id, image_id, score) VALUES (?, ?, ?)",
+            [
+                (self.tag_id(tag, create=True), image_id, float(score))
+                for tag, score in tags.items()
+            ],
+        )
+
+    def prune(self, directory: str):
+        """
+        Removes the images under directory that were deleted since they were indexed.
+        """
+        directory = os.path.join(os.path.abspath(directory), "")
+        deleted = [
+            (image_id,)
+            for image_id, path in self.conn.execute("SELECT id, path FROM images")
+            if path.startswith(directory) and not os.path.exists(path)
+        ]
+        self.conn.executemany("DELETE FROM postings WHERE image_id = ?", deleted)
+        self.conn.executemany("DELETE FROM images WHERE id = ?", deleted)
+        self.conn.commit()
+        if deleted:
+            logger.info(f"Removed {len(deleted)} deleted images from {self.path}")
+
+    def image_ids(self) -> np.ndarray:
+        return np.fromiter(
+            (row[0] for row in self.conn.execute("SELECT id FROM images")),
+            dtype=np.int64,
+        )
+
+    def bitmap(self, size: int, tag: str, threshold: float) -> np.ndarray:
+        # Images with the tag scored at least threshold, as a mask over image ids
+        result = np.zeros(size, dtype=bool)
+        tag_id = self.tag_id(tag)
+        if tag_id is None:
+            return result
+        ids = np.fromiter(
+            (
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT image_id FROM postings WHERE tag_id = ? AND score >= ?",
+                    (tag_id, threshold),
+                )
+            ),
+            dtype=np.int64,
+        )
+        result[ids[ids < size]] = True
+        return result
+
+    def query(
+        self, expression: Union[str, "Query"], default_threshold: float = 0.6
+    ) -> List[str]:
+        """
+        Paths of the images matching a boolean tag expression, see parse_query.
+        """
+        if isinstance(expression, str):
+            expression = parse_query(expression)
+        ids = self.image_ids()
+        size = int(ids.max()) + 1 if len(ids) else 0
+        universe = np.zeros(size, dtype=bool)
+        universe[ids] = True
+        matches = np.flatnonzero(
+            expression.evaluate(self, size, default_threshold) & universe
+        )
+        return self.paths(matches)
+
+    def paths(self, image_ids: Iterable[int]) -> List[str]:
+        paths = dict(self.conn.execute("SELECT id, path FROM images"))
+        return [paths[int(image_id)] for image_id in image_ids]
+
+    def scores(self, path: str, tags: Iterable[str]) -> dict[str, float]:
+        tags = list(tags)
+        tag_ids = [self.tag_id(tag) for tag in tags]
+        rows = dict(
+            self.conn.execute(
+                "SELECT p.tag_id, p.score FROM postings p "
+                "JOIN images i ON i.id = p.image_id WHERE i.path = ?",
+                (path,),
+            )
+        )
+        return {
+            tag: rows[tag_id] for tag, tag_id in zip(tags, tag_ids) if tag_id in rows
+        }
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+
+@dataclass
+class TagTerm:
+    tag: str
+    # Uses the default threshold of the query when None
+    threshold: Optional[float] = None
+
+    def evaluate(self, index: TagIndex, size: int, default_threshold: float):
+        threshold = default_threshold if self.threshold is None else self.threshold
+        return index.bitmap(size, self.tag, threshold)
+
+    def tags(self) -> List[str]:
+        return [self.tag]
+
+
+@dataclass
+class Not:
+    operand: "Query"
+
+    def evaluate(self, index: TagIndex, size: int, default_threshold: float):
+        return ~self.operand.evaluate(index, size, default_threshold)
+
+    def tags(self) -> List[str]:
+        return self.operand.tags()
+
+
+@dataclass
+class And:
+    operands: List["Query"]
+
+    def evaluate(self, index: TagIndex, size: int, default_threshold: float):
+        result = self.operands[0].evaluate(index, size, default_threshold)
+        for operand in self.operands[1:]:
+            if not result.any():
+                break
+            result &= operand.evaluate(index, size, default_threshold)
+        return result
+
+    def tags(self) -> List[str]:
+        return [tag for operand in self.operands for tag in operand.tags()]
+
+
+@dataclass
+class Or:
+    operands: List["Query"]
+
+    def evaluate(self, index: TagIndex, size: int, default_threshold: float):
+        result = self.operands[0].evaluate(index, size, default_threshold)
+        for operand in self.operands[1:]:
+            result |= operand.evaluate(index, size, default_threshold)
+        return result
+
+    def tags(self) -> List[str]:
+        return [tag for operand in self.operands for tag in operand.tags()]
+
+
+Query = Union[TagTerm, Not, And, Or]
+
+# Escaped parentheses are part of the tag, e.g. star_\(symbol\)
+_TOKEN = re.compile(
+    r'\s*(?:(?P<op>[&|!()])|"(?P<quoted>[^"]*)"|(?P<tag>(?:\\[()]|[^&|!()"<>=])+))'
+    r'(?:\s*(?P<comparison>>=?)\s*(?P<threshold>[0-9]*\.?[0-9]+))?'
+)
+
+
+def _tokenize(expression: str) -> List[Union[str, TagTerm]]:
+    tokens: List[Union[str, TagTerm]] = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                f"Unexpected character at {position} in query: {expression}"
+            )
+        position = match.end()
+        if match["op"]:
+            if match["threshold"]:
+                raise ValueError(f"Threshold after {match['op']!r} in query: {expression}")
+            tokens.append(match["op"])
+            continue
+
+        tag = (match["quoted"] if match["quoted"] is not None else match["tag"]).strip()
+        if not tag:
+            raise ValueError(f"Empty tag in query: {expression}")
+        threshold = None
+        if match["threshold"]:
+            threshold = float(match["threshold"])
+            if match["comparison"] == ">":
+                # Scores are floats, nudge the threshold so that >= implements >
+                threshold = float(np.nextafter(threshold, np.inf))
+        tokens.append(TagTerm(tag, threshold))
+    return tokens
+
+
+def parse_query(expression: str) -> Query:
+    """
+    Parses a boolean tag expression: tags combined with & (and), | (or),
+    ! (not) and parentheses, & binding tighter than |. A tag can be followed
+    by its own score threshold, e.g. `(green hair>0.8 | blue hair) & 1girl & !monochrome`.
+    Tags containing operators can be quoted, e.g. `"star (symbol)"`.
+    """
+    tokens = _tokenize(expression)
+    position = 0
+
+    def peek() -> Union[str, TagTerm, None]:
+        return tokens[position] if position < len(tokens) else None
+
+    def take() -> Union[str, TagTerm, None]:
+        nonlocal position
+        token = peek()
+        position += 1
+        return token
+
+    def parse_or() -> Query:
+        operands = [parse_and()]
+        while peek() == "|":
+            take()
+            operands.append(parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and() -> Query:
+        operands = [parse_not()]
+        while peek() == "&":
+            take()
+            operands.append(parse_not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_not() -> Query:
+        if peek() == "!":
+            take()
+            return Not(parse_not())
+        return parse_primary()
+
+    def parse_primary() -> Query:
+        token = take()
+        if isinstance(token, TagTerm):
+            return token
+        if token == "(":
+            query = parse_or()
+            if take() != ")":
+                raise ValueError(f"Missing ) in query: {expression}")
+            return query
+        raise ValueError(f"Expected a tag or ( in query: {expression}")
+
+    query = parse_or()
+    if position < len(tokens):
+        raise ValueError(f"Unexpected {tokens[position]!r} in query: {expression}")
+    return query
+
+
+def build_query(
+    all_of: Iterable[str] = (),
+    any_of: Iterable[str] = (),
+    none_of: Iterable[str] = (),
+) -> Optional[Query]:
+    # Same semantics as the --tag-*-of options
+    operands: List[Query] = [TagTerm(tag) for tag in all_of]
+    any_of = [TagTerm(tag) for tag in any_of]
+    if any_of:
+        operands.append(Or(any_of))
+    operands.extend(Not(TagTerm(tag)) for tag in none_of)
+    if not operands:
+        return None
+    return operands[0] if len(operands) == 1 else And(operands)
+
+
+class TagIndexExporter(BaseExporter):
+    """
+    Adds the tags of every exported item to the index, keyed by the path of its source file.
+    """
+
+    def __init__(
+        self,
+        index: TagIndex,
+        commit_every: int = 500,
+        ignore_error_when_export: bool = False,
+    ):
+        BaseExporter.__init__(self, ignore_error_when_export)
+        self.index = index
+        self.commit_every = commit_every
+        self._exported = 0
+
+    def pre_export(self):
+        pass
+
+    def post_export(self):
+        self.index.commit()
+        logger.info(f"Indexed {self._exported} images in {self.index.path}")
+
+    def export_item(self, item: ImageItem):
+        if "path" not in item.meta:
+            return
+        self.index.add(item.meta["path"], item.meta.get("tags") or {})
+        self._exported += 1
+        if self._exported % self.commit_every == 0:
+            self.index.commit()
+
+    def reset(self):
+        self._exported = 0
+
+    def __deepcopy__(self, memo):
+        # source.export creates a deepcopy of the exporter so we need to override __deepcopy__ to reuse the same index
+        return TagIndexExporter(
+            self.index, self.commit_every, self.ignore_error_when_export
+        )
@@ -0,0 +1,579 @@
+import fnmatch
+import json
+import logging
+import os
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Iterable, Optional
+
+from vocabulary import CompiledVocabulary
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_PATH = os.path.join(SCRIPT_DIR, "process-tags.config.jsonc")
+
+UNTAGGED_LABEL = "_none"
+TAG_SCORE_THRESHOLD = 0.65
+# Same as sources.IMAGE_EXTENSIONS, without pulling in the video decoding dependencies
+CAPTION_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
+
+TWO_WORD_TAG = re.compile(r"^([^ ]+) ([^ ]+)$")
+FOLDER_TAG = re.compile(r"(-?[0-9]?[^0-9_\- ,][^0-9_,]+)(?:_[0-9]+)?\b")
+FOLDER_NAME = re.compile(r"([^0-9]*[^0-9_]+)(?:_[0-9]+)?")
+
+
+def normalize_tag(tag: str) -> str:
+    # Captions escape parentheses, e.g. "star \(symbol\)"
+    return (
+        tag.strip()
+        .lower()
+        .replace(")", "\\)")
+        .replace("(", "\\(")
+        .replace("\\\\", "\\")
+    )
+
+
+def split_tags(text: Optional[str]) -> list[str]:
+    return [tag for tag in map(normalize_tag, (text or "").split(",")) if tag]
+
+
+def unescape_tag(tag: str) -> str:
+    return tag.replace("\\)", ")").replace("\\(", "(")
+
+
+def load_jsonc(path: str):
+    """
+    Parses JSON with // and /* */ comments and trailing commas.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    # Strings are matched first so that comment markers inside them are kept
+    token = re.compile(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/', re.DOTALL)
+    text = token.sub(lambda m: m.group(0) if m.group(0).startswith('"') else "", text)
+    text = re.sub(r",(\s*[\]}])", r"\1", text)
+    return json.loads(text)
+
+
+@dataclass
+class TagConfig:
+    categories: dict[str, list[str]]
+    clothing_colors: list[str]
+    clothing_styles: list[str]
+    tags_to_keep: set[str]
+    tags_without_color: set[str]
+    tags_to_warn: dict[str, float]
+    unwanted_tags: list[str]
+    redundant_tags: dict[str, str]
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CONFIG_PATH) -> "TagConfig":
+        config = load_jsonc(path)
+        categories = {
+            category["name"].lower(): [tag.lower() for tag in category["tags"]]
+            for category in config.get("tagCategories", [])
+        }
+        return cls(
+            categories=categories,
+            clothing_colors=config.get("clothingColors", []),
+            clothing_styles=config.get("clothingStyles", []),
+            # Category tags are always kept
+            tags_to_keep={tag.lower() for tag in config.get("tagsToKeep", [])}
+            | set(chain.from_iterable(categories.values())),
+            tags_without_color={
+                tag.lower() for tag in config.get("tagsWithoutColor", [])
+            },
+            tags_to_warn={
+                tag.lower(): threshold
+                for tag, threshold in config.get("tagsToWarn", {}).items()
+            },
+            unwanted_tags=[tag.lower() for tag in config.get("unwantedTags", [])],
+            redundant_tags={
+                normalize_tag(tag): normalize_tag(redundant)
+                for tag, redundant in config.get("redundantTags", {}).items()
+            },
+        )
+
+
+class TagVocabulary:
+    """
+    Interns tags to integer ids so that captions are processed as sets and
+    Counters of ints, and per-tag lookups (redundant tags, category matches)
+    are computed once per distinct tag instead of once per caption.
+    """
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.tags: list[str] = []
+
+    def intern(self, tag: str) -> int:
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            tag_id = self.ids[tag] = len(self.tags)
+            self.tags.append(tag)
+        return tag_id
+
+    def get(self, tag: str) -> Optional[int]:
+        return self.ids.get(tag)
+
+    def matching(self, pattern: re.Pattern) -> set[int]:
+        return {tag_id for tag_id, tag in enumerate(self.tags) if pattern.search(tag)}
+
+    def __getitem__(self, tag_id: int) -> str:
+        return self.tags[tag_id]
+
+    def __len__(self):
+        return len(self.tags)
+
+
+@dataclass(eq=False)
+class Caption:
+    path: str
+    original: str
+    tags: list[int]
+    tag_set: set[int] = field(default_factory=set)
+    added: set[int] = field(default_factory=set)
+    removed: set[int] = field(default_factory=set)
+
+    @property
+    def directory(self) -> str:
+        return os.path.dirname(self.path)
+
+    def add(self, tag_id: int, prepend: bool = False, track: bool = True):
+        if prepend:
+            if tag_id in self.tag_set:
+                self.tags.remove(tag_id)
+            self.tags.insert(0, tag_id)
+        elif tag_id in self.tag_set:
+            return
+        else:
+            self.tags.append(tag_id)
+        self.tag_set.add(tag_id)
+        if track:
+            self.added.add(tag_id)
+
+    def remove_all(self, tag_ids: Iterable[int]):
+        to_remove = self.tag_set.intersection(tag_ids)
+        if to_remove:
+            self.tags = [tag_id for tag_id in self.tags if tag_id not in to_remove]
+            self.tag_set -= to_remove
+            self.removed |= to_remove
+
+
+def list_caption_files(root: str, recursive: bool = False) -> list[str]:
+    """
+    Caption files with an image of the same name, skipping hidden files and folders.
+    """
+    files = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        images = {
+            os.path.splitext(filename)[0].lower()
+            for filename in filenames
+            if os.path.splitext(filename)[1].lower() in CAPTION_IMAGE_EXTENSIONS
+        }
+        for filename in sorted(filenames):
+            stem, extension = os.path.splitext(filename)
+            if (
+                extension.lower() == ".txt"
+                and not filename.startswith(".")
+                and stem.lower() in images
+            ):
+                files.append(os.path.join(directory, filename))
+        if not recursive:
+            break
+    return files
+
+
+def read_caption_file(path: str) -> str:
+    with open(path, encoding="utf-8-sig") as f:
+        return f.read()
+
+
+class TagProcessor:
+    """
+    Applies the operations of process-tags.ps1 to every caption of a dataset:
+    captions are loaded in bulk, tags are interned and each operation is
+    resolved to tag ids once before being applied to all captions.
+    """
+
+    def __init__(self, root: str, config: TagConfig):
+        self.root = os.path.abspath(root)
+        self.config = config
+        self.vocabulary = TagVocabulary()
+        self.captions: list[Caption] = []
+
+    def ids(self, tags: Iterable[str]) -> list[int]:
+        return [self.vocabulary.intern(tag) for tag in tags]
+
+    def load(self, recursive: bool = False, process_multiline: bool = False):
+        files = list_caption_files(self.root, recursive)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            contents = list(executor.map(read_caption_file, files))
+
+        for path, content in zip(files, contents):
+            if not process_multiline and "\n" in content:
+                continue
+            caption = Caption(path, content, [])
+            self.apply_tags(caption, split_tags(content), track=False)
+            self.captions.append(caption)
+        logger.info(f"Loaded {len(self.captions)} captions from {self.root}")
+
+    def apply_tags(
+        self,
+        caption: Caption,
+        tags: Iterable[str],
+        prepend: bool = False,
+        track: bool = True,
+    ):
+        # "-tag" removes the tag, like in process-tags.ps1
+        for tag in tags:
+            if tag.startswith("-"):
+                removed = normalize_tag(tag[1:])
+                if removed:
+                    caption.remove_all([self.vocabulary.intern(removed)])
+            else:
+                caption.add(self.vocabulary.intern(tag), prepend, track)
+
+    def add_tags(self, tags: Iterable[str], prepend: bool = False):
+        tags = split_tags(",".join(tags))
+        for caption in self.captions:
+            self.apply_tags(caption, tags, prepend)
+
+    def remove_tags(self, tags: Iterable[str]):
+        tag_ids = set(self.ids(split_tags(",".join(tags))))
+        for caption in self.captions:
+            caption.remove_all(tag_ids)
+
+    def replace_tags(self, replacements: Iterable[str]):
+        # Syntax: "OldTag:NewTag"
+        pairs = []
+        for replacement in chain.from_iterable(r.split(",") for r in replacements):
+            old, _, new = replacement.partition(":")
+            old, new = normalize_tag(old), normalize_tag(new)
+            if old and new:
+                pairs.append((self.vocabulary.intern(old), self.vocabulary.intern(new)))
+
+        for caption in self.captions:
+            for old_id, new_id in pairs:
+                if old_id in caption.tag_set:
+                    caption.remove_all([old_id])
+                    caption.add(new_id)
+
+    def tag_folder_names(self):
+        # Folder names like "red dress_12/standing" add the tags "red dress" and "standing"
+        folder_tags: dict[str, list[str]] = {}
+        for caption in self.captions:
+            directory = caption.directory
+            if (
+                os.path.basename(directory).startswith("_")
+                or os.path.abspath(directory) == self.root
+            ):
+                continue
+            if directory not in folder_tags:
+                parts = os.path.relpath(directory, self.root).split(os.sep)
+                folder_tags[directory] = split_tags(
+                    ",".join(
+                        match.group(1)
+                        for part in parts
+                        for match in FOLDER_TAG.finditer(part)
+                    )
+                )
+            self.apply_tags(caption, folder_tags[directory])
+
+    def remove_redundant_tags(self):
+        # Tags made redundant by a more specific tag, e.g. "dress" by "red dress",
+        # and "swimsuit" by "bikini" or "red bikini"
+        redundant = {
+            self.vocabulary.intern(tag): self.vocabulary.intern(redundant_tag)
+            for tag, redundant_tag in self.config.redundant_tags.items()
+        }
+        suffixes: dict[int, int] = {}
+        for tag_id in range(len(self.vocabulary)):
+            match = TWO_WORD_TAG.match(self.vocabulary[tag_id])
+            if match and match.group(2) not in self.config.tags_to_keep:
+                suffixes[tag_id] = self.vocabulary.intern(match.group(2))
+
+        for caption in self.captions:
+            caption.remove_all(
+                {suffixes[tag_id] for tag_id in caption.tags if tag_id in suffixes}
+            )
+            caption.remove_all(
+                {
+                    redundant[suffixes[tag_id]]
+                    for tag_id in caption.tags
+                    if tag_id in suffixes and suffixes[tag_id] in redundant
+                }
+            )
+            caption.remove_all(
+                {redundant[tag_id] for tag_id in caption.tags if tag_id in redundant}
+            )
+
+    def remove_unwanted_tags(self):
+        self.remove_tags(self.config.unwanted_tags)
+
+    def count_tags(self) -> Counter:
+        return Counter(
+            chain.from_iterable(caption.tag_set for caption in self.captions)
+        )
+
+    def sort_tags_by_count(self, keep_tags: int = 0):
+        # The first keep_tags tags stay in place, e.g. trigger words
+        counts = self.count_tags()
+        for caption in self.captions:
+            size = len(caption.tags)
+            caption.tags = [
+                tag_id
+                for _, tag_id in sorted(
+                    enumerate(caption.tags),
+                    key=lambda entry: (
+                        entry[0] + 1 if entry[0] < keep_tags else size,
+                        -counts[entry[1]],
+                        self.vocabulary[entry[1]],
+                    ),
+                )
+            ]
+
+    def sort_tags_by_frequency(
+        self, vocabulary: CompiledVocabulary, keep_tags: int = 0
+    ):
+        # Global danbooru frequency rather than frequency in this dataset, unknown tags last
+        ranks = {
+            tag_id: vocabulary.ranks[compiled_id]
+            for tag_id, compiled_id in enumerate(vocabulary.ids(self.vocabulary.tags))
+            if compiled_id >= 0
+        }
+        unknown = len(vocabulary)
+        for caption in self.captions:
+            caption.tags = caption.tags[:keep_tags] + sorted(
+                caption.tags[keep_tags:], key=lambda tag_id: ranks.get(tag_id, unknown)
+            )
+
+    def text(self, caption: Caption) -> str:
+        return ", ".join(self.vocabulary[tag_id] for tag_id in caption.tags)
+
+    def changed_captions(self) -> list[Caption]:
+        return [
+            caption
+            for caption in self.captions
+            if caption.original != self.text(caption)
+        ]
+
+    def save(self) -> int:
+        changed = self.changed_captions()
+        for caption in changed:
+            with open(caption.path, "w", encoding="utf-8", newline="") as f:
+                f.write(self.text(caption))
+            caption.original = self.text(caption)
+        logger.info(f"Wrote {len(changed)} of {len(self.captions)} captions")
+        return len(changed)
+
+    def category_tags(
+        self, category: str, include_prefixes: bool = False
+    ) -> list[str]:
+        tags = self.config.categories.get(category.lower())
+        if tags is None:
+            # Comma separated tags, "*" and "?" wildcards match existing tags
+            tags = []
+            for tag in (tag.strip().lower() for tag in category.split(",")):
+                if "*" in tag or "?" in tag:
+                    tags.extend(
+                        existing
+                        for existing in (self.vocabulary[i] for i in self.count_tags())
+                        if fnmatch.fnmatchcase(existing, tag)
+                    )
+                elif tag:
+                    tags.append(tag)
+
+        if category.lower() == "clothing" and include_prefixes:
+            styles = self.config.clothing_styles
+            colors = self.config.clothing_colors
+            tags = (
+                tags
+                + [f"{style} {tag}" for tag in tags for style in styles]
+                + [f"{color} {tag}" for tag in tags for color in colors]
+            )
+        return tags
+
+    def captions_by_category(
+        self, category: str, include_prefixes: bool = False, exact_match: bool = False
+    ) -> list[tuple[str, list[Caption]]]:
+        """
+        Captions matching each tag of the category, followed by the captions
+        matching none of them under UNTAGGED_LABEL.
+        """
+        categorized = []
+        matched: set[int] = set()
+        for tag in self.category_tags(category, include_prefixes):
+            if exact_match:
+                tag_ids = {
+                    tag_id
+                    for tag_id, existing in enumerate(self.vocabulary.tags)
+                    if existing == tag
+                }
+            else:
+                tag_ids = self.vocabulary.matching(
+                    re.compile(rf"\b{re.escape(tag)}\b", re.IGNORECASE)
+                )
+            captions = [
+                caption
+                for caption in self.captions
+                if not caption.tag_set.isdisjoint(tag_ids)
+            ]
+            matched.update(id(caption) for caption in captions)
+            categorized.append((tag, captions))
+
+        uncategorized = [
+            caption for caption in self.captions if id(caption) not in matched
+        ]
+        return categorized + [(UNTAGGED_LABEL, uncategorized)]
+
+    def category_score(self, category: str) -> float:
+        # Ratio of captions with at least one tag of the category
+        if not self.captions:
+            return 0
+        uncategorized = self.captions_by_category(category)[-1][1]
+        return (len(self.captions) - len(uncategorized)) / len(self.captions)
+
+    def organize_by_category(
+        self, category: str, dry_run: bool = False
+    ) -> list[tuple[str, str]]:
+        """
+        Moves captions and their images to a folder named after the category
+        tags they have, e.g. "school uniform, kimono", or to the root folder.
+        Returns the (source, destination) folder of every moved caption.
+        """
+        by_category = [
+            (tag, set(map(id, captions)))
+            for tag, captions in self.captions_by_category(
+                category, include_prefixes=True, exact_match=True
+            )
+            if tag != UNTAGGED_LABEL
+        ]
+        moves = []
+        for caption in self.captions:
+            tags = [tag for tag, captions in by_category if id(caption) in captions]
+            directory = (
+                os.path.join(self.root, unescape_tag(", ".join(tags)))
+                if tags
+                else self.root
+            )
+            if os.path.abspath(directory) == os.path.abspath(caption.directory):
+                continue
+            moves.append((caption.directory, directory))
+            if dry_run:
+                continue
+
+            os.makedirs(directory, exist_ok=True)
+            # Move associated files, i.e. images with the same name as the caption
+            stem = os.path.splitext(os.path.basename(caption.path))[0]
+            for filename in os.listdir(caption.directory):
+                if os.path.splitext(filename)[0] == stem:
+                    os.replace(
+                        os.path.join(caption.directory, filename),
+                        os.path.join(directory, filename),
+                    )
+            caption.path = os.path.join(directory, os.path.basename(caption.path))
+
+        if not dry_run:
+            remove_empty_directories(self.root)
+        return moves
+
+    def suffix_file_count(self, dry_run: bool = False) -> list[tuple[str, str]]:
+        """
+        Renames folders to end with the number of captions they contain, e.g. "standing_12".
+        Returns the (old, new) path of every renamed folder.
+        """
+        by_directory: dict[str, list[Caption]] = defaultdict(list)
+        for caption in self.captions:
+            by_directory[caption.directory].append(caption)
+
+        renames = []
+        # Deepest folders first so that renaming a folder never moves one not renamed yet
+        for directory, captions in sorted(
+            by_directory.items(), key=lambda entry: entry[0].count(os.sep), reverse=True
+        ):
+            name = os.path.basename(directory)
+            if os.path.abspath(directory) == self.root or name.startswith("_"):
+                continue
+            match = FOLDER_NAME.search(name)
+            if not match:
+                continue
+            new_directory = os.path.join(
+                os.path.dirname(directory), f"{match.group(1).strip()}_{len(captions)}"
+            )
+            if new_directory == directory:
+                continue
+            renames.append((directory, new_directory))
+            if dry_run:
+                continue
+
+            os.rename(directory, new_directory)
+            for caption in captions:
+                caption.path = os.path.join(
+                    new_directory, os.path.basename(caption.path)
+                )
+        return renames
+
+    def suggestions(
+        self, keep_tags: int, booru_tags: CompiledVocabulary
+    ) -> dict[str, list[str]]:
+        """
+        Tags that should probably be removed or changed, by reason.
+        """
+        counts = self.count_tags()
+        total = len(self.captions)
+        all_tags = {self.vocabulary[tag_id] for tag_id in counts}
+        added = set(chain.from_iterable(caption.added for caption in self.captions))
+        kept = set(
+            chain.from_iterable(caption.tags[:keep_tags] for caption in self.captions)
+        )
+        candidates = [
+            (self.vocabulary[tag_id], count)
+            for tag_id, count in counts.items()
+            if tag_id not in added and tag_id not in kept
+        ]
+        keep_patterns = [
+            re.compile(rf"\b{re.escape(tag)}\b", re.IGNORECASE)
+            for tag in self.config.tags_to_keep
+        ]
+        colorless = "monochrome" in all_tags or "greyscale" in all_tags
+
+        return {
+            "Suggested to untag (part of unwanted list)": [
+                tag for tag in self.config.unwanted_tags if tag in all_tags
+            ],
+            "Suggested to untag (unknown or has < 500 booru count)": [
+                tag for tag, _ in candidates if booru_tags.get(tag) is None
+            ],
+            "Suggested to untag (has < 1k booru count)": [
+                tag for tag, _ in candidates if booru_tags.get(tag, 1000) < 1000
+            ],
+            "Suggested to untag (present in > 80% of files)": [
+                tag
+                for tag, count in candidates
+                if count > total * 0.8
+                and not any(pattern.search(tag) for pattern in keep_patterns)
+            ],
+            "Suggested to untag or delete (above recommended threshold)": [
+                tag
+                for tag, count in candidates
+                if tag in self.config.tags_to_warn
+                and count > total * self.config.tags_to_warn[tag]
+            ],
+            "Suggested to change (too broad)": [
+                tag
+                for tag, _ in candidates
+                if tag in self.config.tags_without_color and not colorless
+            ],
+        }
+
+
+def remove_empty_directories(root: str):
+    directories = sorted((entry[0] for entry in os.walk(root)), reverse=True)
+    for directory in directories:
+        if directory != root and not os.listdir(directory):
+            os.rmdir(directory)
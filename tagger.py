@@ -0,0 +1,156 @@
+from typing import Iterable, List
+import numpy as np
+from PIL import Image
+from imgutils.tagging import drop_overlap_tags
+from imgutils.tagging.wd14 import (
+    _get_wd14_labels,
+    _get_wd14_model,
+    _prepare_image_for_tagging,
+)
+
+# Same method names as waifuc's TaggingAction
+WD14_MODEL_NAMES = {
+    "wd14_vit": "ViT",
+    "wd14_convnext": "ConvNext",
+    "wd14_convnextv2": "ConvNextV2",
+    "wd14_swinv2": "SwinV2",
+    "wd14_moat": "MOAT",
+    "wd14_v3_swinv2": "SwinV2_v3",
+    "wd14_v3_convnext": "ConvNext_v3",
+    "wd14_v3_vit": "ViT_v3",
+}
+
+# Cheap deterministic tagger standing in for the ONNX models, used by benchmark-pipeline.py
+STUB_METHOD = "stub"
+STUB_LABELS = [
+    "1girl",
+    "solo",
+    "red_background",
+    "green_background",
+    "blue_background",
+    "simple_background",
+    "dark",
+    "blurry",
+]
+
+
+def is_wd14_method(method: str) -> bool:
+    return method in WD14_MODEL_NAMES
+
+
+def predict_wd14_batch(images: Iterable[Image.Image], model_name: str) -> np.ndarray:
+    """
+    Runs the WD14 model once over the stacked batch and returns one row of label probabilities per image.
+    """
+    model = _get_wd14_model(model_name)
+    model_input = model.get_inputs()[0]
+    batch_dim, target_size, _, _ = model_input.shape
+    label_name = model.get_outputs()[0].name
+
+    batch = np.concatenate(
+        [_prepare_image_for_tagging(image, target_size) for image in images]
+    )
+    if isinstance(batch_dim, int) and batch_dim == 1:
+        # Model was exported with a static batch size
+        return np.concatenate(
+            [
+                model.run([label_name], {model_input.name: batch[i : i + 1]})[0]
+                for i in range(len(batch))
+            ]
+        )
+    return model.run([label_name], {model_input.name: batch})[0]
+
+
+def get_stub_scores(image: Image.Image) -> np.ndarray:
+    """
+    Scores of STUB_LABELS derived from the average color of the image.
+    """
+    r, g, b = image.convert("RGB").resize((1, 1)).getpixel((0, 0))
+    brightness = (r + g + b) / 765
+    color = max(range(3), key=lambda i: (r, g, b)[i])
+    scores = np.array([0.95, 0.9, 0, 0, 0, 0.6, 1 - brightness, 0.1], dtype=np.float32)
+    scores[2 + color] = 0.5 + max(r, g, b) / 510
+    return scores
+
+
+def get_stub_tags(
+    image: Image.Image, general_threshold: float = 0.35, **kwargs
+) -> dict[str, float]:
+    """
+    Tags derived from the average color of the image, in the same format as the WD14 taggers.
+    """
+    return scores_to_tags(get_stub_scores(image), STUB_METHOD, general_threshold)
+
+
+def get_tagger_labels(method: str) -> tuple[list[str], list[int], list[int]]:
+    """
+    Label names of the tagger outputs, with the indexes of the general and character labels.
+    """
+    if method == STUB_METHOD:
+        return STUB_LABELS, list(range(len(STUB_LABELS))), []
+    tag_names, _, general_indexes, character_indexes = _get_wd14_labels(
+        WD14_MODEL_NAMES[method]
+    )
+    return list(tag_names), list(general_indexes), list(character_indexes)
+
+
+def predict_scores_batch(images: List[Image.Image], method: str) -> np.ndarray:
+    # Raw probabilities of every label, one row per image
+    if method == STUB_METHOD:
+        return np.stack([get_stub_scores(image) for image in images])
+    return predict_wd14_batch(images, WD14_MODEL_NAMES[method])
+
+
+def scores_to_tags(
+    scores: np.ndarray, method: str, general_threshold: float = 0.35, **kwargs
+) -> dict[str, float]:
+    if method == STUB_METHOD:
+        return {
+            tag: float(score)
+            for tag, score in zip(STUB_LABELS, scores)
+            if score > general_threshold
+        }
+    return wd14_prediction_to_tags(
+        scores, WD14_MODEL_NAMES[method], general_threshold, **kwargs
+    )
+
+
+def wd14_prediction_to_tags(
+    pred: np.ndarray,
+    model_name: str,
+    general_threshold: float = 0.35,
+    character_threshold: float = 0.85,
+    drop_overlap: bool = False,
+) -> dict[str, float]:
+    # Mirrors imgutils' get_wd14_tags post-processing so that batched and per-item tagging give the same tags
+    tag_names, _, general_indexes, character_indexes = _get_wd14_labels(model_name)
+    general = {
+        tag_names[i]: float(pred[i])
+        for i in general_indexes
+        if pred[i] > general_threshold
+    }
+    if drop_overlap:
+        general = drop_overlap_tags(general)
+    characters = {
+        tag_names[i]: float(pred[i])
+        for i in character_indexes
+        if pred[i] > character_threshold
+    }
+    return {**general, **characters}
+
+
+def get_wd14_tags_batch(
+    images: List[Image.Image],
+    method: str,
+    general_threshold: float = 0.35,
+    character_threshold: float = 0.85,
+    drop_overlap: bool = False,
+) -> List[dict[str, float]]:
+    model_name = WD14_MODEL_NAMES[method]
+    preds = predict_wd14_batch(images, model_name)
+    return [
+        wd14_prediction_to_tags(
+            pred, model_name, general_threshold, character_threshold, drop_overlap
+        )
+        for pred in preds
+    ]
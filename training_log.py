@@ -0,0 +1,230 @@
+import csv
+import json
+import logging
+import os
+import re
+import shlex
+import time
+from dataclasses import asdict, dataclass, fields
+from typing import Optional, Union
+
+from remote_shell import LocalShell, SshShell
+
+logger = logging.getLogger(__name__)
+
+REMOTE_LOG_PATH = "/home/ht/training/LoRA_Easy_Training_Scripts/run_out.txt"
+# Upper bound of what a single poll transfers, the rest is read on the next polls
+MAX_READ_BYTES = 1024 * 1024
+
+epoch_regex = re.compile(rb"epoch ([0-9]+)/([0-9]+)")
+# tqdm progress bar of sd-scripts, e.g. "steps:  12%|█▏   | 120/1000 [02:03<15:00,  1.02s/it, avr_loss=0.0923]"
+steps_regex = re.compile(
+    rb"steps:.*?\|\s*([0-9]+)/([0-9]+)\s*\[([0-9:]+)[^,\]]*,\s*([0-9.]+)(it/s|s/it)(?:[^\]]*?loss=([0-9.eE+-]+))?"
+)
+
+
+@dataclass
+class TrainingMetrics:
+    time: float
+    epoch: Optional[int] = None
+    epoch_total: Optional[int] = None
+    step: Optional[int] = None
+    step_total: Optional[int] = None
+    loss: Optional[float] = None
+    it_per_sec: Optional[float] = None
+    remaining_sec: Optional[float] = None
+    # Elapsed time of the tqdm progress bar
+    elapsed_sec: Optional[float] = None
+
+
+def parse_duration(duration: bytes) -> float:
+    # tqdm durations, e.g. "02:03" or "1:02:03"
+    seconds = 0.0
+    for part in duration.split(b":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02}m" if hours else f"{minutes}m{seconds:02}s"
+
+
+def format_progress(metrics: TrainingMetrics) -> str:
+    progress = []
+    if metrics.epoch is not None:
+        progress.append(f"epoch {metrics.epoch}/{metrics.epoch_total}")
+    if metrics.step is not None:
+        progress.append(f"step {metrics.step}/{metrics.step_total}")
+    if metrics.loss is not None:
+        progress.append(f"loss {metrics.loss:.4f}")
+    if metrics.it_per_sec:
+        progress.append(f"{metrics.it_per_sec:.2f}it/s")
+    if metrics.remaining_sec is not None:
+        progress.append(f"~{format_duration(metrics.remaining_sec)} remaining")
+    return ", ".join(progress)
+
+
+class MetricsWriter:
+    """
+    Appends training metrics to a CSV file, or to an NDJSON file when the path ends with .ndjson or .jsonl.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_csv = not path.endswith((".ndjson", ".jsonl"))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_header = self.is_csv and (
+            not os.path.exists(path) or os.path.getsize(path) == 0
+        )
+        self.file = open(path, "a", encoding="utf-8", newline="")
+        if self.is_csv:
+            self.writer = csv.DictWriter(
+                self.file, fieldnames=[field.name for field in fields(TrainingMetrics)]
+            )
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, metrics: TrainingMetrics):
+        if self.is_csv:
+            self.writer.writerow(asdict(metrics))
+        else:
+            self.file.write(json.dumps(asdict(metrics)) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TrainingLogTailer:
+    """
+    Follows the training log of the pod from a byte offset, so that each poll
+    transfers only what was appended since the previous one, at most
+    MAX_READ_BYTES, instead of searching the whole log. tqdm redraws its
+    progress bar with carriage returns, every redraw of a new step is parsed
+    into a TrainingMetrics and appended to the metrics file if any. Steps read
+    in the same poll are timestamped from the elapsed time of the progress
+    bar, the last one at the time of the poll. The remaining time is
+    estimated from a moving average of the step rate.
+    """
+
+    def __init__(
+        self,
+        shell: Union[SshShell, LocalShell],
+        remote_path: str = REMOTE_LOG_PATH,
+        metrics_path: Optional[str] = None,
+        max_read_bytes: int = MAX_READ_BYTES,
+        smoothing: float = 0.3,
+    ):
+        self.shell = shell
+        self.remote_path = remote_path
+        self.max_read_bytes = max_read_bytes
+        self.smoothing = smoothing
+        self.writer = MetricsWriter(metrics_path) if metrics_path else None
+        self.offset = 0
+        # Incomplete last line of the previous read, possibly a split UTF-8 character
+        self.pending = b""
+        self.latest: Optional[TrainingMetrics] = None
+        self.it_per_sec: Optional[float] = None
+
+    def read(self) -> Optional[bytes]:
+        path = shlex.quote(self.remote_path)
+        # The log starts over when the next training file is submitted
+        result = self.shell.run(
+            f"size=$(stat -c %s {path} 2>/dev/null) || exit 1; "
+            f"start={self.offset}; [ $size -lt $start ] && start=0; "
+            f"echo $start; tail -c +$((start + 1)) {path} | head -c {self.max_read_bytes}",
+            check=False,
+            text=False,
+        )
+        if result.returncode != 0:
+            return None
+        start, _, data = result.stdout.partition(b"\n")
+        start = int(start)
+        if start != self.offset:
+            logger.info("Training log was restarted, following the new log")
+            self.pending = b""
+            self.latest = None
+            self.it_per_sec = None
+        self.offset = start + len(data)
+        return data
+
+    def parse(self, data: bytes) -> list[TrainingMetrics]:
+        lines = re.split(rb"[\r\n]", self.pending + data)
+        self.pending = lines.pop()
+        now = time.time()
+        metrics = []
+        for line in lines:
+            latest = self.latest or TrainingMetrics(now)
+            match = epoch_regex.search(line)
+            if match:
+                latest = TrainingMetrics(
+                    now,
+                    int(match.group(1)),
+                    int(match.group(2)),
+                    latest.step,
+                    latest.step_total,
+                    latest.loss,
+                    latest.it_per_sec,
+                    latest.remaining_sec,
+                    latest.elapsed_sec,
+                )
+                self.latest = latest
+                continue
+
+            match = steps_regex.search(line)
+            if not match:
+                continue
+            step = int(match.group(1))
+            if step == latest.step or step == 0:
+                continue
+            rate = float(match.group(4))
+            if match.group(5) == b"s/it":
+                rate = 1 / rate if rate else 0.0
+            self.it_per_sec = (
+                rate
+                if self.it_per_sec is None
+                else self.smoothing * rate + (1 - self.smoothing) * self.it_per_sec
+            )
+            step_total = int(match.group(2))
+            latest = TrainingMetrics(
+                now,
+                latest.epoch,
+                latest.epoch_total,
+                step,
+                step_total,
+                float(match.group(6)) if match.group(6) else latest.loss,
+                rate,
+                (step_total - step) / self.it_per_sec if self.it_per_sec else None,
+                parse_duration(match.group(3)),
+            )
+            self.latest = latest
+            metrics.append(latest)
+
+        if metrics:
+            last_elapsed = metrics[-1].elapsed_sec
+            for entry in metrics:
+                # A new progress bar in the same read starts over from 0
+                entry.time = min(now, now - (last_elapsed - entry.elapsed_sec))
+        return metrics
+
+    def poll(self) -> Optional[TrainingMetrics]:
+        """
+        Reads what was appended to the log, records the new steps and returns the latest metrics.
+        """
+        data = self.read()
+        if data is None:
+            return None
+        metrics = self.parse(data)
+        if self.writer and metrics:
+            for entry in metrics:
+                self.writer.write(entry)
+            self.writer.flush()
+        return self.latest
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
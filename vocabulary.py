@@ -0,0 +1,261 @@
+import bisect
+import csv
+import logging
+import mmap
+import os
+import struct
+from typing import Iterable, Optional, Sequence
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BOORU_TAGS_PATH = os.path.join(SCRIPT_DIR, "danbooru-tags-500+.csv")
+DEFAULT_VOCABULARY_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "sd-training-tools", "danbooru-tags.vocab"
+)
+# Taken from https://old.reddit.com/r/comfyui/comments/1amo41u/updated_danbooru_tag_list_and_counts_for/
+BOORU_TAGS_URL = (
+    "https://gist.githubusercontent.com/bem13/0bc5091819f0594c53f0d96972c8b6ff/raw/"
+    "b0aacd5ea4634ed4a9f320d344cc1fe81a60db5a/danbooru_tags_post_count.csv"
+)
+
+MAGIC = b"SDTVOCAB"
+VERSION = 3
+# magic, version, tag count, string table size, modification time of the danbooru tag list, tagger label count
+HEADER = struct.Struct("<8sIIQdI4x")
+# Every array starts at a multiple of this many bytes, so that the int64 post counts are aligned
+ALIGNMENT = 8
+
+# Flags of each tag
+IN_BOORU_LIST = 1
+IN_TAGGER_LABELS = 2
+
+
+def _padding(size: int) -> int:
+    return -size % ALIGNMENT
+
+
+def normalize_tag(tag: str) -> str:
+    """
+    Lookup key of a tag: "Star_\\(symbol\\)", "star (symbol)" and "star_(symbol)" are the same tag.
+    """
+    return (
+        tag.strip().lower().replace("_", " ").replace("\\(", "(").replace("\\)", ")")
+    )
+
+
+def download_booru_tags(path: str = DEFAULT_BOORU_TAGS_PATH):
+    logger.info(f"Downloading danbooru tags to {path}")
+    response = requests.get(BOORU_TAGS_URL, timeout=60)
+    response.raise_for_status()
+    rows = [
+        (name.replace("_", " "), int(count))
+        for name, count in csv.reader(response.text.splitlines())
+        if int(count) >= 500
+    ]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["name", "post_count"])
+        writer.writerows(rows)
+
+
+def read_booru_tags(path: str = DEFAULT_BOORU_TAGS_PATH) -> dict[str, int]:
+    if not os.path.exists(path):
+        download_booru_tags(path)
+    with open(path, encoding="utf-8", newline="") as f:
+        return {row["name"]: int(row["post_count"]) for row in csv.DictReader(f)}
+
+
+def compile_vocabulary(
+    output_path: str,
+    booru_tags: dict[str, int],
+    labels: Iterable[str] = (),
+    booru_tags_mtime: float = 0.0,
+):
+    """
+    Writes the binary vocabulary: a header, then the string table offsets,
+    post counts, frequency ranks and flags as little-endian arrays aligned
+    to ALIGNMENT bytes, then the UTF-8 string table. Tags are sorted by normalized name so that lookups
+    are a binary search over the memory-mapped file. The header records the
+    modification time of the danbooru tag list and the number of tagger
+    labels, so that load_vocabulary knows when and how it can recompile it.
+    """
+    label_count = 0
+    counts: dict[str, int] = {}
+    flags: dict[str, int] = {}
+    for tag, count in booru_tags.items():
+        key = normalize_tag(tag)
+        counts[key] = max(counts.get(key, 0), count)
+        flags[key] = flags.get(key, 0) | IN_BOORU_LIST
+    for tag in labels:
+        label_count += 1
+        key = normalize_tag(tag)
+        counts.setdefault(key, 0)
+        flags[key] = flags.get(key, 0) | IN_TAGGER_LABELS
+
+    keys = sorted(counts, key=lambda key: key.encode("utf-8"))
+    encoded = [key.encode("utf-8") for key in keys]
+    offsets = np.zeros(len(keys) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(key) for key in encoded])
+    post_counts = np.array([counts[key] for key in keys], dtype="<i8")
+    # Rank 0 is the most frequent tag, ties are broken by name
+    ranks = np.empty(len(keys), dtype="<u4")
+    ranks[np.argsort(-post_counts, kind="stable")] = np.arange(len(keys))
+    tag_flags = np.array([flags[key] for key in keys], dtype="u1")
+    strings = b"".join(encoded)
+
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC, VERSION, len(keys), len(strings), booru_tags_mtime, label_count
+            )
+        )
+        position = HEADER.size
+        for array in (offsets, post_counts, ranks, tag_flags):
+            f.write(b"\0" * _padding(position))
+            position += _padding(position)
+            f.write(array.tobytes())
+            position += array.nbytes
+        f.write(strings)
+    os.replace(temp_path, output_path)
+    logger.info(f"Compiled {len(keys)} tags to {output_path}")
+
+
+class _Keys(Sequence[bytes]):
+    # Sorted tag names read straight from the string table, for bisect
+    def __init__(self, offsets: memoryview, strings: memoryview):
+        self.offsets = offsets
+        self.strings = strings
+
+    def __getitem__(self, index: int) -> bytes:
+        return bytes(self.strings[self.offsets[index] : self.offsets[index + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class CompiledVocabulary:
+    """
+    Memory-mapped tag vocabulary compiled from the danbooru tag list and
+    tagger labels. Opening it only maps the file, tags are looked up by
+    binary search and identified by their index in the sorted string table.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self._mmap)[:2]
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a tag vocabulary of version {VERSION}")
+        _, _, count, strings_size, self.booru_tags_mtime, self.label_count = (
+            HEADER.unpack_from(self._mmap)
+        )
+
+        offset = HEADER.size
+
+        def array(dtype: str, length: int) -> np.ndarray:
+            nonlocal offset
+            offset += _padding(offset)
+            result = np.frombuffer(self._mmap, dtype=dtype, count=length, offset=offset)
+            offset += result.nbytes
+            return result
+
+        self.offsets = array("<u4", count + 1)
+        self.post_counts = array("<i8", count)
+        self.ranks = array("<u4", count)
+        self.flags = array("u1", count)
+        self._strings = memoryview(self._mmap)[offset : offset + strings_size]
+        # Indexing a memoryview is much faster than indexing a numpy array for single items
+        self._offsets = memoryview(self.offsets).cast("B").cast("I")
+        self._keys = _Keys(self._offsets, self._strings)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def id(self, tag: str) -> Optional[int]:
+        key = normalize_tag(tag).encode("utf-8")
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return index
+        return None
+
+    def ids(self, tags: Iterable[str]) -> np.ndarray:
+        # -1 for unknown tags
+        return np.array(
+            [-1 if (tag_id := self.id(tag)) is None else tag_id for tag in tags],
+            dtype=np.int64,
+        )
+
+    def tag(self, tag_id: int) -> str:
+        return self._keys[tag_id].decode("utf-8")
+
+    def __contains__(self, tag: str) -> bool:
+        return self.id(tag) is not None
+
+    def post_count(self, tag: str) -> int:
+        tag_id = self.id(tag)
+        return 0 if tag_id is None else int(self.post_counts[tag_id])
+
+    def get(self, tag: str, default: Optional[int] = None) -> Optional[int]:
+        # Post count of known danbooru tags, like a dict read from the CSV
+        tag_id = self.id(tag)
+        if tag_id is None or not self.flags[tag_id] & IN_BOORU_LIST:
+            return default
+        return int(self.post_counts[tag_id])
+
+    def sort_by_frequency(self, tags: Iterable[str]) -> list[str]:
+        """
+        Sorts tags from the most to the least frequent on danbooru, unknown tags last in their original order.
+        """
+        tags = list(tags)
+        ranks = [
+            len(self) if (tag_id := self.id(tag)) is None else int(self.ranks[tag_id])
+            for tag in tags
+        ]
+        return [tags[i] for i in sorted(range(len(tags)), key=ranks.__getitem__)]
+
+    def close(self):
+        # Arrays viewing the mapping must be released before closing it
+        self.offsets = self.post_counts = self.ranks = self.flags = None
+        self._keys = None
+        self._offsets.release()
+        self._strings.release()
+        self._mmap.close()
+
+
+def load_vocabulary(
+    path: str = DEFAULT_VOCABULARY_PATH,
+    booru_tags_path: str = DEFAULT_BOORU_TAGS_PATH,
+) -> CompiledVocabulary:
+    """
+    Opens the compiled vocabulary, compiling it first if it is missing or the danbooru tag list changed.
+    A vocabulary compiled with tagger labels is never recompiled, since the labels would be lost.
+    """
+    if not os.path.exists(booru_tags_path):
+        download_booru_tags(booru_tags_path)
+    booru_tags_mtime = os.path.getmtime(booru_tags_path)
+    if os.path.exists(path):
+        try:
+            vocabulary = CompiledVocabulary(path)
+        except ValueError as e:
+            logger.warning(f"{e}, compiling it again")
+        else:
+            if vocabulary.booru_tags_mtime == booru_tags_mtime:
+                return vocabulary
+            if vocabulary.label_count:
+                logger.warning(
+                    f"{booru_tags_path} changed since {path} was compiled with {vocabulary.label_count} tagger labels, "
+                    "run compile-vocabulary.py with --labels again to update it"
+                )
+                return vocabulary
+            vocabulary.close()
+    compile_vocabulary(path, read_booru_tags(booru_tags_path), booru_tags_mtime=booru_tags_mtime)
+    return CompiledVocabulary(path)